@@ -0,0 +1,296 @@
+"""Load generator for chat and call signaling.
+
+Starts the app in a subprocess on a scratch database (or targets --url),
+connects N simulated Socket.IO clients in pairs and drives:
+
+  * /chat   join, then text messages (every --image-every'th one an image)
+  * /call   join -> call:ring -> call:accept -> rtc:offer/answer/candidate
+
+and writes one JSON document with msgs/s, end-to-end latency percentiles,
+per-step call latency, DB write latency and RSS, so runs can be diffed
+across commits. DB write latency is the server's own
+``konusma_db_query_seconds{op="INSERT"}`` histogram, scraped from /metrics
+before and after the run, so it reflects writes made under load:
+
+    python -m bench.loadgen --clients 100 --messages 50 --out bench_results.json
+"""
+import argparse
+import base64
+import json
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import psutil
+import requests
+import socketio
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+PNG = "data:image/png;base64," + base64.b64encode(b"\x89PNG\r\n\x1a\n" + b"\0" * 2048).decode()
+
+
+def percentiles(samples):
+    if not samples:
+        return {"count": 0}
+    xs = sorted(samples)
+
+    def pick(p):
+        return round(xs[min(len(xs) - 1, int(p / 100.0 * len(xs)))] * 1000, 3)
+    return {"count": len(xs), "p50_ms": pick(50), "p95_ms": pick(95), "p99_ms": pick(99),
+            "max_ms": round(xs[-1] * 1000, 3)}
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def start_server(workdir, async_mode):
+    port = free_port()
+    env = dict(os.environ,
+               PORT=str(port),
+               DATABASE_URL=f"sqlite:///{workdir}/bench.sqlite3",
+               MEDIA_DIR=f"{workdir}/media",
+               ASYNC_MODE=async_mode,
+               FLASK_ENV="development",
+               REQUIRE_ROOM_KEY="true",
+               MAX_ROOM_MEMBERS="2",
+               SOCKET_THROTTLE_ENABLED="false",
+               TELEGRAM_BOT_TOKEN="")
+    proc = subprocess.Popen([sys.executable, "-m", "server.app"], cwd=ROOT, env=env,
+                            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    url = f"http://127.0.0.1:{port}"
+    deadline = time.time() + 30
+    while time.time() < deadline:
+        try:
+            if requests.get(f"{url}/health", timeout=1).ok:
+                return proc, url
+        except requests.RequestException:
+            time.sleep(0.2)
+    proc.kill()
+    raise RuntimeError("server did not come up")
+
+
+class Pair:
+    """Two clients sharing one chat: ``a`` sends, ``b`` receives and times."""
+
+    def __init__(self, url, idx, stats):
+        self.url = url
+        self.cid = f"bench-{os.getpid()}-{idx}"
+        self.stats = stats
+        self.room_key = None
+        self.key_ready = threading.Event()
+        self.sent = {}
+        self.call_events = {}
+        self.a = socketio.Client(reconnection=False)
+        self.b = socketio.Client(reconnection=False)
+        self.b.on("chat:message", self._on_message, namespace="/chat")
+        self.a.on("room:key", self._on_key, namespace="/chat")
+        for c in (self.a, self.b):
+            for ev in ("call:incoming", "call:accepted", "rtc:offer", "rtc:answer", "rtc:candidate"):
+                c.on(ev, self._call_handler(ev), namespace="/call")
+
+    def _on_key(self, data):
+        self.room_key = data.get("room_key")
+        self.key_ready.set()
+
+    def _on_message(self, m):
+        now = time.perf_counter()
+        text = m.get("text") or ""
+        seq = text.split(" ", 2)[1] if text.startswith("bench ") else None
+        t0 = self.sent.pop(seq, None) if seq else self.sent.pop(("img", m.get("type")), None)
+        if t0 is not None:
+            self.stats.add("e2e", now - t0)
+        self.stats.incr("received")
+
+    def _call_handler(self, ev):
+        def handler(data):
+            evt = self.call_events.get(ev)
+            if evt is not None:
+                evt.set()
+        return handler
+
+    def connect(self):
+        for c in (self.a, self.b):
+            c.connect(self.url, namespaces=["/chat", "/call"], wait_timeout=20)
+        self.a.emit("join", {"chat_id": self.cid, "name": "BenchA"}, namespace="/chat")
+        self.b.emit("join", {"chat_id": self.cid, "name": "BenchB"}, namespace="/chat")
+        return self.key_ready.wait(20)
+
+    def chat(self, n, image_every):
+        for i in range(n):
+            if image_every and i % image_every == image_every - 1:
+                self.sent[("img", "image")] = time.perf_counter()
+                self.a.emit("send", {"chat_id": self.cid, "type": "image", "text": PNG, "name": "BenchA"}, namespace="/chat")
+            else:
+                self.sent[str(i)] = time.perf_counter()
+                self.a.emit("send", {"chat_id": self.cid, "type": "text", "text": f"bench {i} x", "name": "BenchA"}, namespace="/chat")
+            self.stats.incr("sent")
+
+    def _step(self, name, client, event, payload, expect, timeout=10):
+        self.call_events[expect] = threading.Event()
+        t0 = time.perf_counter()
+        client.emit(event, payload, namespace="/call")
+        if self.call_events[expect].wait(timeout):
+            self.stats.add(f"call.{name}", time.perf_counter() - t0)
+            return True
+        self.stats.incr(f"call.{name}.timeout")
+        return False
+
+    def call(self):
+        room = {"room": self.cid, "room_key": self.room_key, "chat_id": self.cid}
+        self.a.emit("join", room, namespace="/call")
+        self.b.emit("join", room, namespace="/call")
+        time.sleep(0.2)
+        base = {"room": self.cid, "chat_id": self.cid}
+        ok = (self._step("ring", self.a, "call:ring", dict(base, **{"from": "BenchA"}), "call:incoming")
+              and self._step("accept", self.b, "call:accept", base, "call:accepted")
+              and self._step("offer", self.a, "rtc:offer", dict(base, sdp={"type": "offer", "sdp": "v=0\r\n"}), "rtc:offer")
+              and self._step("answer", self.b, "rtc:answer", dict(base, sdp={"type": "answer", "sdp": "v=0\r\n"}), "rtc:answer")
+              and self._step("candidate", self.a, "rtc:candidate",
+                             dict(base, candidate={"candidate": "candidate:1 1 udp 2122260223 10.0.0.1 5000 typ host",
+                                                   "sdpMid": "0", "sdpMLineIndex": 0}), "rtc:candidate"))
+        self.stats.incr("call.completed" if ok else "call.failed")
+        self.a.emit("call:end", base, namespace="/call")
+
+    def close(self):
+        for c in (self.a, self.b):
+            try:
+                c.disconnect()
+            except Exception:
+                pass
+
+
+class Stats:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.samples = {}
+        self.counters = {}
+
+    def add(self, key, value):
+        with self.lock:
+            self.samples.setdefault(key, []).append(value)
+
+    def incr(self, key, n=1):
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + n
+
+
+def run_parallel(pairs, fn):
+    threads = [threading.Thread(target=fn, args=(p,)) for p in pairs]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+
+def scrape_histogram(url, name, label, token=None):
+    """Cumulative ``{le: count}`` of one histogram series on ``url``/metrics."""
+    headers = {"Authorization": f"Bearer {token}"} if token else {}
+    resp = requests.get(f"{url}/metrics", headers=headers, timeout=5)
+    resp.raise_for_status()
+    out = {}
+    for line in resp.text.splitlines():
+        if line.startswith(name + "_bucket{") and label in line:
+            out[float(line.split('le="')[1].split('"')[0])] = float(line.rsplit(" ", 1)[1])
+    return out
+
+
+def histogram_percentiles(before, after):
+    """Percentiles of the observations between two scrapes. Values are bucket
+    upper bounds, so they are as coarse as the server's buckets."""
+    les = sorted(after)
+    counts = [after[le] - before.get(le, 0) for le in les]
+    total = counts[-1] if counts else 0
+    if not total:
+        return {"count": 0}
+
+    def pick(p):
+        for le, c in zip(les, counts):
+            if c >= p / 100.0 * total:
+                return None if le == float("inf") else round(le * 1000, 3)
+    return {"count": int(total), "p50_ms": pick(50), "p95_ms": pick(95), "p99_ms": pick(99),
+            "source": "server /metrics konusma_db_query_seconds{op=INSERT}, bucket upper bounds"}
+
+
+def git_rev():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, capture_output=True, text=True).stdout.strip()
+    except OSError:
+        return None
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("--url", help="target an already running server instead of starting one")
+    ap.add_argument("--clients", type=int, default=20, help="simulated clients (used in pairs)")
+    ap.add_argument("--messages", type=int, default=50, help="messages per sending client")
+    ap.add_argument("--image-every", type=int, default=10, help="every Nth message is an image (0 = never)")
+    ap.add_argument("--async-mode", default="eventlet", choices=["threading", "eventlet", "gevent"])
+    ap.add_argument("--metrics-token", default=os.getenv("METRICS_TOKEN", ""), help="bearer token for /metrics on --url")
+    ap.add_argument("--out", default="bench_results.json")
+    args = ap.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix="konusma-bench-")
+    proc = None
+    url = args.url
+    if not url:
+        proc, url = start_server(workdir, args.async_mode)
+    server_ps = psutil.Process(proc.pid) if proc else None
+
+    stats = Stats()
+    pairs = [Pair(url, i, stats) for i in range(max(args.clients // 2, 1))]
+    db_series = ("konusma_db_query_seconds", 'op="INSERT"', args.metrics_token)
+    db_before = scrape_histogram(url, *db_series)
+    try:
+        t0 = time.perf_counter()
+        run_parallel(pairs, Pair.connect)
+        connect_s = time.perf_counter() - t0
+
+        expected = len(pairs) * args.messages
+        t0 = time.perf_counter()
+        run_parallel(pairs, lambda p: p.chat(args.messages, args.image_every))
+        deadline = time.time() + 30
+        while stats.counters.get("received", 0) < expected and time.time() < deadline:
+            time.sleep(0.05)
+        chat_s = time.perf_counter() - t0
+
+        run_parallel(pairs, Pair.call)
+        server_rss = server_ps.memory_info().rss if server_ps else None
+        db = histogram_percentiles(db_before, scrape_histogram(url, *db_series))
+    finally:
+        for p in pairs:
+            p.close()
+        if proc:
+            proc.terminate()
+            proc.wait(10)
+
+    received = stats.counters.get("received", 0)
+    result = {
+        "commit": git_rev(),
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+        "config": {"clients": len(pairs) * 2, "messages_per_sender": args.messages,
+                   "image_every": args.image_every, "async_mode": args.async_mode if proc else None,
+                   "url": args.url},
+        "connect_s": round(connect_s, 3),
+        "chat": {"sent": stats.counters.get("sent", 0), "received": received,
+                 "duration_s": round(chat_s, 3), "msgs_per_s": round(received / chat_s, 1) if chat_s else None,
+                 "e2e_latency": percentiles(stats.samples.get("e2e", []))},
+        "call": {"completed": stats.counters.get("call.completed", 0), "failed": stats.counters.get("call.failed", 0),
+                 "steps": {k[5:]: percentiles(v) for k, v in stats.samples.items() if k.startswith("call.")}},
+        "db_write_latency": db,
+        "rss_mb": {"server": round(server_rss / 2**20, 1) if server_rss else None,
+                   "loadgen": round(psutil.Process().memory_info().rss / 2**20, 1)},
+    }
+    with open(args.out, "w") as f:
+        json.dump(result, f, indent=2)
+    print(json.dumps(result, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -1 +1,24 @@
 # Server package
+import os
+
+# Green-thread modes must patch the stdlib before anything else imports socket,
+# threading or time, so it happens here rather than in app.py.
+ASYNC_MODE = os.getenv("ASYNC_MODE", "threading").lower()
+
+if ASYNC_MODE == "eventlet":
+    import eventlet
+    eventlet.monkey_patch()
+elif ASYNC_MODE == "gevent":
+    from gevent import monkey
+    monkey.patch_all()
+
+if ASYNC_MODE in ("eventlet", "gevent"):
+    try:
+        # make psycopg2 (PostgreSQL) yield to the hub instead of blocking it
+        if ASYNC_MODE == "eventlet":
+            from psycogreen.eventlet import patch_psycopg
+        else:
+            from psycogreen.gevent import patch_psycopg
+        patch_psycopg()
+    except ImportError:
+        pass
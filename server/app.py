@@ -1,4 +1,4 @@
-from flask import Flask, render_template, request, jsonify
+from flask import Flask, render_template, request, jsonify, session, g, Response, stream_with_context
 from flask_socketio import SocketIO
 from flask_limiter import Limiter
 from flask_limiter.util import get_remote_address
@@ -6,6 +6,7 @@ from flask_wtf.csrf import CSRFProtect
 from dotenv import load_dotenv
 import logging
 import os
+from functools import wraps
 from .config import cfg
 
 load_dotenv()
@@ -16,14 +17,21 @@ logging.basicConfig(
     format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
 )
 logger = logging.getLogger(__name__)
-from .storage import init_db, list_chats, get_messages, delete_chat, get_room_key
-from .signaling import ChatNS, CallNS
+from .storage import init_db, list_chats, get_messages, delete_chat, get_room_key, mark_chat_read, list_test_schedules, add_test_schedule, update_test_schedule, delete_test_schedule
+from .signaling import ChatNS, CallNS, AdminNS, admin_feed
 from .scheduler import start_scheduler, refresh_jobs
-from .telegram_bot import tg_bp
+from .telegram_bot import tg_bp, send_text
+from .media import media_bp
 from .testsuite import run_tests
 from .repair import run_repair, plan_safe, apply_safe
-import threading
+from .search import search_messages, MAX_RESULTS as SEARCH_MAX_RESULTS
+from .state import shared
+from .jobs import job_runner, JobQueueFull
+from . import bulk, export, metrics, retention
+import re
+import secrets
 import time
+from zoneinfo import ZoneInfo
 import datetime as dt
 import json
 
@@ -50,11 +58,20 @@ limiter = Limiter(
     app=app,
     key_func=get_remote_address,
     default_limits=[f"{cfg.RATE_LIMIT_HOURLY}/hour", f"{cfg.RATE_LIMIT_DAILY}/day"],
-    storage_uri="memory://"
+    storage_uri=cfg.RATELIMIT_STORAGE_URI or (cfg.STATE_BACKEND_URL if cfg.STATE_BACKEND_URL.startswith("redis") else "memory://")
 )
 
 ALLOWED = [o.strip() for o in cfg.ALLOWED_ORIGINS.split(',') if o.strip()]
 
+def admin_required(fn):
+    """401 unless the session passed the admin OTP check, as AdminNS.on_connect requires."""
+    @wraps(fn)
+    def wrapper(*args, **kwargs):
+        if not session.get('admin'):
+            return jsonify({"error": "Unauthorized"}), 401
+        return fn(*args, **kwargs)
+    return wrapper
+
 @app.after_request
 def cors(resp):
     o = request.headers.get('Origin')
@@ -66,6 +83,19 @@ def cors(resp):
         resp.headers['Access-Control-Allow-Origin'] = '*'
     return resp
 
+@app.before_request
+def _start_timer():
+    g.t0 = time.perf_counter()
+
+@app.after_request
+def _record_timing(resp):
+    t0 = g.pop('t0', None)
+    if t0 is not None:
+        # route pattern, not the raw path, keeps label cardinality bounded
+        rule = request.url_rule.rule if request.url_rule else 'unmatched'
+        metrics.HTTP_REQUEST_SECONDS.observe(time.perf_counter() - t0, request.method, rule, str(resp.status_code))
+    return resp
+
 @app.after_request
 def security(resp):
     resp.headers.setdefault('X-Content-Type-Options', 'nosniff')
@@ -85,9 +115,13 @@ def security(resp):
         "frame-ancestors 'none';")
     return resp
 
-socketio = SocketIO(app, cors_allowed_origins=ALLOWED if '*' not in ALLOWED else '*', async_mode='threading')
+# With a shared state backend, every worker also needs the same message queue so
+# emits to a room reach sockets connected to other processes.
+MESSAGE_QUEUE = cfg.SOCKETIO_MESSAGE_QUEUE or (cfg.STATE_BACKEND_URL if cfg.STATE_BACKEND_URL.startswith("redis") else None)
+socketio = SocketIO(app, cors_allowed_origins=ALLOWED if '*' not in ALLOWED else '*', async_mode=cfg.ASYNC_MODE, message_queue=MESSAGE_QUEUE)
 
 app.register_blueprint(tg_bp, url_prefix="/tg")
+app.register_blueprint(media_bp, url_prefix="/media")
 
 @app.get("/")
 def index():
@@ -109,8 +143,8 @@ def health():
     logger.info("Health check requested")
     return {"ok": True, "status": "healthy"}
 
-# OTP System
-_OTP_STORE = {}
+# OTP System (kept in the shared state backend so any worker can verify it)
+OTP_TTL = 300
 
 @app.post("/api/admin/request-otp")
 @limiter.limit("3 per minute")
@@ -118,13 +152,13 @@ _OTP_STORE = {}
 def request_otp():
     import random
     otp = ''.join([str(random.randint(0, 9)) for _ in range(6)])
-    _OTP_STORE['current'] = otp
-    _OTP_STORE['timestamp'] = time.time()
+    shared.put('admin_otp', otp, OTP_TTL)
     
     try:
         from .telegram_bot import send_text
-        send_text(f"🔐 Admin OTP Kodu:\n\n{otp}\n\nGeçerlilik: 5 dakika")
-        logger.info(f"OTP generated and sent to Telegram")
+        if not send_text(f"🔐 Admin OTP Kodu:\n\n{otp}\n\nGeçerlilik: 5 dakika"):
+            raise RuntimeError("telegram queue unavailable")
+        logger.info(f"OTP queued for Telegram")
         return jsonify({"ok": True, "message": "OTP Telegram'a gönderildi"})
     except Exception as e:
         logger.error(f"OTP send error: {e}")
@@ -137,15 +171,13 @@ def verify_otp():
     data = request.get_json(silent=True) or {}
     otp = data.get('otp', '').strip()
     
-    if 'current' not in _OTP_STORE:
-        return jsonify({"ok": False, "error": "OTP bulunamadı. Lütfen yeni OTP isteyin."}), 400
-    
-    if time.time() - _OTP_STORE.get('timestamp', 0) > 300:
-        del _OTP_STORE['current']
-        return jsonify({"ok": False, "error": "OTP süresi doldu. Lütfen yeni OTP isteyin."}), 400
+    current = shared.get('admin_otp')
+    if current is None:
+        return jsonify({"ok": False, "error": "OTP bulunamadı veya süresi doldu. Lütfen yeni OTP isteyin."}), 400
     
-    if otp == _OTP_STORE['current']:
-        del _OTP_STORE['current']
+    if otp and secrets.compare_digest(otp, current) and shared.pop('admin_otp') == current:
+        session.permanent = True
+        session['admin'] = True
         logger.info("OTP verified successfully")
         return jsonify({"ok": True, "message": "Giriş başarılı"})
     else:
@@ -154,35 +186,199 @@ def verify_otp():
 
 @app.get("/api/chats")
 def get_chats():
-    chats = list_chats()
-    return jsonify([{"id": c[0], "cid": c[1], "name": c[2], "created": c[3].isoformat()} for c in chats])
+    chats, next_cursor = list_chats(
+        before_id=request.args.get("before_id", type=int),
+        search=(request.args.get("q") or "").strip()[:100] or None,
+        limit=request.args.get("limit", 50, type=int),
+    )
+    resp = jsonify([{
+        "id": c[0], "cid": c[1], "name": c[2], "created": c[3].isoformat(), "unread": c[4],
+        "last": {"role": c[5], "type": c[6], "text": c[7], "time": c[8].isoformat()} if c[8] else None,
+    } for c in chats])
+    if next_cursor is not None:
+        resp.headers["X-Next-Cursor"] = str(next_cursor)
+    return resp
+
+@app.get("/api/search")
+@admin_required
+def api_search():
+    q = (request.args.get("q") or "").strip()[:200]
+    offset = request.args.get("offset", 0, type=int)
+    limit = request.args.get("limit", 20, type=int)
+    t0 = time.perf_counter()
+    hits = search_messages(q, limit=limit, offset=offset,
+                           include_closed=request.args.get("closed", "").lower() == "true")
+    resp = jsonify([{
+        "message_id": h[0], "chat_id": h[1], "cid": h[2], "name": h[3], "role": h[4],
+        "time": h[5].isoformat() if h[5] else None, "snippet": h[6], "rank": h[7],
+    } for h in hits])
+    resp.headers["X-Search-Duration-Ms"] = f"{(time.perf_counter() - t0) * 1000:.1f}"
+    if len(hits) == max(1, min(limit, SEARCH_MAX_RESULTS)):
+        resp.headers["X-Next-Offset"] = str(max(offset, 0) + len(hits))
+    return resp
+
+@app.post("/api/chats/<int:chat_id>/read")
+@csrf.exempt
+def api_chat_read(chat_id):
+    return jsonify({"ok": True, "last_read_id": mark_chat_read(chat_id)})
 
 @app.get("/api/chats/<int:chat_id>/messages")
 def get_chat_messages(chat_id):
-    msgs = get_messages(chat_id)
-    return jsonify([{"role": m[0], "type": m[1], "text": m[2], "media": m[3], "time": m[4].isoformat()} for m in msgs])
+    args = request.args
+    try:
+        before_id = args.get("before_id", type=int)
+        after_id = args.get("after_id", type=int)
+        since = dt.datetime.fromisoformat(args["since"]) if args.get("since") else None
+        if since is not None and since.tzinfo is not None:
+            since = since.astimezone(dt.timezone.utc).replace(tzinfo=None)
+        limit = args.get("limit", 100, type=int)
+    except ValueError:
+        return jsonify({"error": "bad_cursor"}), 400
+    msgs, has_more = get_messages(chat_id, before_id=before_id, after_id=after_id, since=since, limit=limit)
+    resp = jsonify([{"id": m[0], "role": m[1], "type": m[2], "text": m[3], "media": m[4], "time": m[5].isoformat()} for m in msgs])
+    resp.headers["X-Has-More"] = "true" if has_more else "false"
+    return resp
+
+def _export_response(records, name, fmt=None):
+    fmt = fmt or request.args.get("format", "ndjson")
+    if fmt not in export.FORMATS:
+        return jsonify({"error": "bad_format", "formats": sorted(export.FORMATS)}), 400
+    gz = request.args.get("gzip", "").lower() in ("1", "true")
+    filename = f"{name}.{fmt}" + (".gz" if gz else "")
+    return Response(export.stream(records, fmt, gz), mimetype="application/gzip" if gz else export.FORMATS[fmt],
+                    headers={"Content-Disposition": f'attachment; filename="{filename}"', "X-Accel-Buffering": "no"})
+
+@app.get("/api/chats/<int:chat_id>/export")
+@admin_required
+def export_chat(chat_id):
+    cid = export.chat_cid(chat_id)
+    if cid is None:
+        return jsonify({"error": "not_found"}), 404
+    return _export_response(export.message_rows(chat_id=chat_id, after_id=request.args.get("after_id", type=int)),
+                            "chat-" + re.sub(r"[^A-Za-z0-9_.-]", "_", cid)[:64])
+
+@app.get("/api/export")
+@admin_required
+def export_all():
+    return _export_response(export.message_rows(after_id=request.args.get("after_id", type=int)),
+                            "messages-" + dt.datetime.utcnow().strftime("%Y%m%d-%H%M%S"))
 
 @app.delete("/api/chats/<int:chat_id>")
 @csrf.exempt
 def del_chat(chat_id):
-    delete_chat(chat_id)
+    cid = delete_chat(chat_id)
+    if cid:
+        admin_feed.publish('chat:closed', {'id': chat_id, 'cid': cid})
     return {"ok": True}
 
+def _feed_closed(rows):
+    for r in rows:
+        admin_feed.publish('chat:closed', {'id': r.id, 'cid': r.cid})
+
+def _feed_restored(rows):
+    for r in rows:
+        admin_feed.publish('chat:created', {'id': r.id, 'cid': r.cid, 'name': r.customer_name,
+                                            'created': r.created_at.isoformat() if r.created_at else None})
+
+@app.post("/api/chats/bulk/<op>")
+@csrf.exempt
+@admin_required
+def api_chat_bulk(op):
+    body = request.get_json(silent=True) or {}
+    cids = body.get("cids", [])
+    try:
+        if op == "delete":
+            return jsonify({"ok": True, **bulk.close_chats(cids, on_chunk=_feed_closed)})
+        if op == "restore":
+            return jsonify({"ok": True, **bulk.restore_chats(cids, on_chunk=_feed_restored)})
+        if op == "reassign":
+            return jsonify({"ok": True, **bulk.reassign_messages(cids, str(body.get("target") or ""), on_chunk=_feed_closed)})
+        if op == "export":
+            bulk.clean_cids(cids)
+            return _export_response(bulk.export_chats(cids), "chats", fmt="ndjson")
+    except bulk.BulkError as e:
+        return jsonify({"ok": False, "error": str(e)}), 400
+    return jsonify({"ok": False, "error": "unknown_op"}), 404
+
 @app.post("/api/chats/bulk-delete")
 @csrf.exempt
+@admin_required
 def api_chat_bulk_delete():
-    ids = (request.json or {}).get("cids", [])
-    if not ids:
-        return jsonify({"ok": True, "deleted": 0})
-    from .storage import SessionLocal, ChatSession
-    with SessionLocal() as s:
-        q = s.query(ChatSession).filter(ChatSession.cid.in_(ids))
-        count = 0
-        for c in q.all():
-            c.active = False
-            count += 1
-        s.commit()
-    return jsonify({"ok": True, "deleted": count})
+    try:
+        res = bulk.close_chats((request.get_json(silent=True) or {}).get("cids", []), on_chunk=_feed_closed)
+    except bulk.BulkError as e:
+        return jsonify({"ok": False, "error": str(e)}), 400
+    return jsonify({"ok": True, "deleted": res["changed"]})
+
+def _test_job(params, progress):
+    progress(5, "running checks")
+    res = run_tests(retry_failed=bool(params.get("retryFailed")), app=app if params.get("inProcess", True) is not False else None)
+    if params.get("notify"):
+        summary = ", ".join(f"{cat} {v['passed']}/{v['total']}" for cat, v in res.items() if v["total"])
+        send_text(f"🧪 Scheduled test run {params.get('slot', '')}\n{summary}")
+    return res
+
+def _repair_job(params, progress):
+    progress(5, "planning")
+    plan = plan_safe()
+    if params.get("dryRun", True):
+        return {"plan": plan, "applied": False}
+    progress(10, "applying")
+    result = apply_safe(progress=lambda done, total: progress(10 + 85 * done // total, f"backfilled {done}/{total}"))
+    return {"plan": plan, "applied": True, "result": result}
+
+# run_tests fans its checks out on its own (green) thread pool, which only works on the hub
+job_runner.register("test", _test_job, {"retryFailed": False, "inProcess": True, "notify": False}, offload=False)
+job_runner.register("repair", _repair_job, {"dryRun": True})
+# deletes chats and messages, so it only exists where the operator turned retention on
+if cfg.RETENTION_ENABLED:
+    job_runner.register("retention", lambda params, progress: retention.run(progress, dry_run=bool(params.get("dryRun"))), {"dryRun": False})
+
+def _submit_job(kind, params):
+    try:
+        job, dedup = job_runner.submit(kind, params)
+    except JobQueueFull as e:
+        return jsonify({"error": str(e)}), 429
+    return jsonify(dict(job, deduplicated=dedup)), 202, {"Location": f"/api/jobs/{job['id']}"}
+
+@app.post("/api/jobs")
+@limiter.limit("20 per minute")
+@csrf.exempt
+@admin_required
+def api_job_create():
+    data = request.get_json(silent=True) or {}
+    kind = data.get("kind")
+    if kind not in job_runner.kinds:
+        return jsonify({"error": "unknown kind"}), 400
+    params = data.get("params") or {}
+    if not isinstance(params, dict):
+        return jsonify({"error": "params must be an object"}), 400
+    return _submit_job(kind, params)
+
+@app.get("/api/jobs")
+@admin_required
+def api_job_list():
+    return jsonify({"items": job_runner.history(request.args.get("kind"), request.args.get("limit", 50, type=int))})
+
+@app.get("/api/jobs/<job_id>")
+@admin_required
+def api_job_get(job_id):
+    job = job_runner.get(job_id)
+    if not job:
+        return jsonify({"error": "not_found"}), 404
+    return jsonify(job)
+
+@app.get("/api/jobs/<job_id>/events")
+@limiter.exempt
+@admin_required
+def api_job_events(job_id):
+    """Server-sent events: one ``data:`` line per progress change."""
+    if not job_runner.get(job_id, with_result=False):
+        return jsonify({"error": "not_found"}), 404
+    def gen():
+        for job in job_runner.stream(job_id):
+            yield f"data: {json.dumps(job, default=str)}\n\n"
+    return Response(stream_with_context(gen()), mimetype="text/event-stream", headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
 
 @app.post("/api/test/run")
 @limiter.limit("10 per minute")
@@ -190,9 +386,19 @@ def api_chat_bulk_delete():
 def api_test_run():
     data = request.get_json(silent=True) or {}
     retry_failed = bool(data.get("retryFailed"))
-    logger.info(f"Running tests (retry_failed={retry_failed})")
-    out = run_tests(retry_failed=retry_failed)
-    return jsonify(out)
+    # in-process by default: probing BASE_URL from a request thread loops back through the network
+    in_process = data.get("inProcess", True) is not False
+    if data.get("async"):
+        # background runs are readable through the admin-only /api/jobs routes
+        if not session.get('admin'):
+            return jsonify({"error": "Unauthorized"}), 401
+        return _submit_job("test", {"retryFailed": retry_failed, "inProcess": in_process})
+    logger.info(f"Running tests (retry_failed={retry_failed}, in_process={in_process})")
+    t0 = time.perf_counter()
+    out = run_tests(retry_failed=retry_failed, app=app if in_process else None)
+    resp = jsonify(out)
+    resp.headers["X-Test-Duration-Ms"] = str(round((time.perf_counter() - t0) * 1000))
+    return resp
 
 @app.route("/api/repair/run", methods=["GET", "POST"])
 @limiter.limit("5 per minute")
@@ -203,6 +409,10 @@ def api_repair_run():
     dry = bool(data.get("dryRun", True))
     if mode != "safe":
         return jsonify({"error": "only safe mode enabled"}), 400
+    if data.get("async"):
+        if not session.get('admin'):
+            return jsonify({"error": "Unauthorized"}), 401
+        return _submit_job("repair", {"dryRun": dry})
     logger.info(f"Running repair (mode={mode}, dry={dry})")
     if dry:
         return jsonify({"plan": plan_safe(), "applied": False})
@@ -210,48 +420,67 @@ def api_repair_run():
         applied = apply_safe()
         return jsonify({"plan": plan_safe(), "applied": True, "result": applied})
 
-_TEST_SCHEDULE = []
-_SCHED_STOP = False
-
-def _schedule_loop():
-    last_run = set()
-    while not _SCHED_STOP:
-        now = dt.datetime.now().strftime("%H:%M")
-        if now in _TEST_SCHEDULE and now not in last_run:
-            res = run_tests()
-            try:
-                from .telegram_bot import notify_telegram
-                notify_telegram('system', 'text', "🧪 Test run\n" + json.dumps(res)[:3500], None, 'System')
-            except Exception:
-                pass
-            last_run.add(now)
-        if dt.datetime.now().second == 0:
-            last_run = {t for t in last_run if t == now}
-        time.sleep(1)
-
-threading.Thread(target=_schedule_loop, daemon=True).start()
+_HHMM = re.compile(r"^([01]\d|2[0-3]):[0-5]\d$")
+
+def _schedule_payload():
+    items = [r.to_dict() for r in list_test_schedules()]
+    return {"ok": True, "times": [i["time_hhmm"] for i in items if i["enabled"]], "items": items}
+
+def _schedule_fields(data):
+    t, tz = data.get("time"), data.get("tz")
+    if t is not None and not (isinstance(t, str) and _HHMM.match(t)):
+        raise ValueError("time must be HH:MM")
+    if tz is not None:
+        try:
+            ZoneInfo(tz)
+        except Exception:
+            raise ValueError("unknown tz")
+    enabled = data.get("enabled")
+    return t, (bool(enabled) if enabled is not None else None), tz
 
 @app.get("/api/test/schedule")
 def api_test_schedule_get():
-    return jsonify({"times": _TEST_SCHEDULE})
+    return jsonify(_schedule_payload())
 
 @app.post("/api/test/schedule")
 @csrf.exempt
 def api_test_schedule_post():
-    data = request.get_json(silent=True) or {}
-    t = data.get("time")
-    if t and t not in _TEST_SCHEDULE:
-        _TEST_SCHEDULE.append(t)
-    return jsonify({"ok": True, "times": _TEST_SCHEDULE})
+    try:
+        t, enabled, tz = _schedule_fields(request.get_json(silent=True) or {})
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    if not t:
+        return jsonify({"error": "time required"}), 400
+    tz = tz or cfg.TZ
+    existing = next((r for r in list_test_schedules() if r.time_hhmm == t and r.tz == tz), None)
+    if existing is None:
+        add_test_schedule(t, enabled if enabled is not None else True, tz)
+    elif enabled is not None or not existing.enabled:
+        update_test_schedule(existing.id, enabled=True if enabled is None else enabled)
+    refresh_jobs()
+    return jsonify(_schedule_payload())
+
+@app.patch("/api/test/schedule/<int:rid>")
+@csrf.exempt
+def api_test_schedule_patch(rid):
+    try:
+        t, enabled, tz = _schedule_fields(request.get_json(silent=True) or {})
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    if not update_test_schedule(rid, time_hhmm=t, enabled=enabled, tz=tz):
+        return jsonify({"error": "not_found"}), 404
+    refresh_jobs()
+    return jsonify(_schedule_payload())
 
 @app.delete("/api/test/schedule/<t>")
 @csrf.exempt
 def api_test_schedule_del(t):
-    try:
-        _TEST_SCHEDULE.remove(t)
-    except ValueError:
-        pass
-    return jsonify({"ok": True, "times": _TEST_SCHEDULE})
+    """Delete by row id, or every schedule at ``HH:MM``."""
+    for r in list_test_schedules():
+        if str(r.id) == t or r.time_hhmm == t:
+            delete_test_schedule(r.id)
+    refresh_jobs()
+    return jsonify(_schedule_payload())
 
 @app.get("/v1/api/ice-servers")
 def ice_servers():
@@ -267,6 +496,18 @@ def api_chat_get(cid):
         return jsonify({"error": "not_found"}), 404
     return jsonify({"room_key": rk})
 
+metrics.Gauge("konusma_call_rooms", "Live call rooms", fn=lambda: shared.stats()["rooms"])
+metrics.Gauge("konusma_call_sockets", "Sockets joined to at least one call room", fn=lambda: shared.stats()["sockets"])
+
+@app.get("/metrics")
+@limiter.exempt
+def metrics_endpoint():
+    if not cfg.METRICS_ENABLED:
+        return jsonify({"error": "Not available"}), 404
+    if cfg.METRICS_TOKEN and not secrets.compare_digest(request.headers.get("Authorization", ""), f"Bearer {cfg.METRICS_TOKEN}"):
+        return jsonify({"error": "Unauthorized"}), 401
+    return metrics.render(), 200, {"Content-Type": "text/plain; version=0.0.4; charset=utf-8"}
+
 @app.get("/debug/memory")
 @limiter.exempt
 def debug_memory():
@@ -276,8 +517,8 @@ def debug_memory():
     
     try:
         import psutil
-        from .signaling import ROOM_STATE
         
+        rooms = shared.rooms(limit=100)
         process = psutil.Process()
         memory = process.memory_info()
         
@@ -285,9 +526,10 @@ def debug_memory():
             "rss_mb": round(memory.rss / 1024 / 1024, 2),
             "vms_mb": round(memory.vms / 1024 / 1024, 2),
             "percent": round(process.memory_percent(), 2),
-            "room_state_size": len(ROOM_STATE),
-            "rooms": list(ROOM_STATE.keys()),
-            "room_details": {k: {"members": len(v.get('members', set())), "accepted": v.get('accepted', False)} for k, v in ROOM_STATE.items()}
+            "room_state_size": shared.stats()["rooms"],
+            "room_stats": shared.stats(),
+            "rooms": list(rooms.keys()),
+            "room_details": {k: {"members": len(v['members']), "accepted": v['accepted']} for k, v in rooms.items()}
         })
     except ImportError:
         return jsonify({"error": "psutil not installed"}), 500
@@ -297,13 +539,22 @@ def debug_memory():
 
 socketio.on_namespace(ChatNS('/chat', socketio))
 socketio.on_namespace(CallNS('/call', socketio))
+socketio.on_namespace(AdminNS('/admin', socketio))
 
 def main():
     logger.info("Starting application...")
     init_db()
     start_scheduler()
-    logger.info(f"Server running on port {os.environ.get('PORT', '10000')}")
-    socketio.run(app, host="0.0.0.0", port=int(os.environ.get("PORT", "10000")), allow_unsafe_werkzeug=True)
+    port = int(os.environ.get("PORT", "10000"))
+    logger.info(f"Server running on port {port} (async_mode={socketio.async_mode})")
+    if socketio.async_mode == 'threading':
+        # werkzeug dev server, one OS thread per client; use ASYNC_MODE=eventlet in production
+        socketio.run(app, host="0.0.0.0", port=port, allow_unsafe_werkzeug=True)
+    elif socketio.async_mode == 'eventlet':
+        # eventlet.wsgi caps concurrent clients at max_size (1024 by default)
+        socketio.run(app, host="0.0.0.0", port=port, max_size=cfg.MAX_CONNECTIONS)
+    else:
+        socketio.run(app, host="0.0.0.0", port=port, spawn=cfg.MAX_CONNECTIONS)
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,146 @@
+"""Bulk chat operations for the admin panel: close, restore, reassign, export.
+
+Requests name chats by cid. The list is de-duplicated and cut into chunks of
+BULK_CHUNK_SIZE; each chunk is one set-based statement (``UPDATE ... WHERE cid
+IN (...) RETURNING``) in its own short transaction, so a 100k-cid request never
+builds one giant statement, never loads ORM objects and never holds a lock for
+long. Only the statements run on the native pool; callers get counts back
+and may pass ``on_chunk`` to see the affected rows of each chunk (the admin
+feed uses it), called back on the caller's (hub) thread between chunks;
+nothing else is accumulated."""
+from __future__ import annotations
+from datetime import datetime
+from sqlalchemy import select, update, and_, or_
+from .config import cfg
+from .utils import offloaded
+from .storage import SessionLocal, ChatSession, Message, invalidate_chat_cache
+
+class BulkError(ValueError):
+    pass
+
+def clean_cids(cids) -> list:
+    """Validated, de-duplicated cids in request order."""
+    if not isinstance(cids, list) or not all(isinstance(c, str) for c in cids):
+        raise BulkError("cids_must_be_list_of_strings")
+    if len(cids) > cfg.BULK_MAX_IDS:
+        raise BulkError("too_many_cids")
+    return list(dict.fromkeys(c for c in cids if c))
+
+def _chunks(items):
+    n = max(cfg.BULK_CHUNK_SIZE, 1)
+    for i in range(0, len(items), n):
+        yield items[i:i + n]
+
+@offloaded
+def _set_active_chunk(chunk, active):
+    stmt = (update(ChatSession)
+            .where(ChatSession.cid.in_(chunk), ChatSession.active == (not active))
+            .values(active=active, closed_at=None if active else datetime.utcnow())
+            .returning(ChatSession.id, ChatSession.cid, ChatSession.customer_name, ChatSession.created_at))
+    with SessionLocal() as s:
+        rows = s.execute(stmt).all()
+        s.commit()
+    return rows
+
+def _set_active(cids, active, on_chunk=None) -> dict:
+    cids = clean_cids(cids)
+    changed = 0
+    for chunk in _chunks(cids):
+        rows = _set_active_chunk(chunk, active)
+        invalidate_chat_cache(cids=chunk)
+        changed += len(rows)
+        if on_chunk and rows:
+            on_chunk(rows)
+    return {"requested": len(cids), "changed": changed}
+
+def close_chats(cids, on_chunk=None) -> dict:
+    """Mark active chats closed (the admin "delete")."""
+    return _set_active(cids, False, on_chunk)
+
+def restore_chats(cids, on_chunk=None) -> dict:
+    """Reopen closed chats."""
+    return _set_active(cids, True, on_chunk)
+
+@offloaded
+def _target(target_cid):
+    with SessionLocal() as s:
+        return s.execute(select(ChatSession.id, ChatSession.active).where(ChatSession.cid == target_cid)).first()
+
+@offloaded
+def _reassign_chunk(chunk, target):
+    with SessionLocal() as s:
+        ids = s.execute(select(ChatSession.id).where(ChatSession.cid.in_(chunk))).scalars().all()
+        if not ids:
+            return [], 0, []
+        moved = s.execute(update(Message).where(Message.chat_id.in_(ids)).values(chat_id=target)).rowcount
+        rows = s.execute(update(ChatSession)
+                         .where(ChatSession.id.in_(ids), ChatSession.active == True)
+                         .values(active=False, closed_at=datetime.utcnow())
+                         .returning(ChatSession.id, ChatSession.cid, ChatSession.customer_name, ChatSession.created_at)).all()
+        s.commit()
+    return ids, moved, rows
+
+def reassign_messages(cids, target_cid, on_chunk=None) -> dict:
+    """Move every message of the ``cids`` chats into ``target_cid`` and close
+    the now-empty sources, e.g. to merge a customer's duplicate sessions.
+    The target must be an active chat: moving history into a closed one would
+    hide it from the panel and hand it to retention."""
+    cids = clean_cids(cids)
+    target = _target(target_cid)
+    if target is None:
+        raise BulkError("target_not_found")
+    if not target.active:
+        raise BulkError("target_inactive")
+    moved = closed = 0
+    for chunk in _chunks([c for c in cids if c != target_cid]):
+        ids, n, rows = _reassign_chunk(chunk, target.id)
+        if not ids:
+            continue
+        invalidate_chat_cache(chat_ids=ids)
+        moved += n
+        closed += len(rows)
+        if on_chunk and rows:
+            on_chunk(rows)
+    return {"requested": len(cids), "moved": moved, "closed": closed, "target": target_cid}
+
+EXPORT_PAGE_ROWS = 1000
+
+@offloaded
+def _export_chats_page(cids):
+    with SessionLocal() as s:
+        return s.execute(select(ChatSession.id, ChatSession.cid, ChatSession.customer_name,
+                                ChatSession.created_at, ChatSession.active, ChatSession.closed_at)
+                         .where(ChatSession.cid.in_(cids)).order_by(ChatSession.id)).all()
+
+@offloaded
+def _export_messages_page(chat_ids, after):
+    # keyset on (chat_id, id), so each page is a short query off the hub
+    last_chat, last_id = after
+    with SessionLocal() as s:
+        return s.execute(select(Message.id, Message.chat_id, Message.role, Message.type, Message.text,
+                                Message.media_url, Message.deleted, Message.created_at)
+                         .where(Message.chat_id.in_(chat_ids),
+                                or_(Message.chat_id > last_chat, and_(Message.chat_id == last_chat, Message.id > last_id)))
+                         .order_by(Message.chat_id, Message.id).limit(EXPORT_PAGE_ROWS)).all()
+
+def export_chats(cids):
+    """Yield one dict per chat followed by its messages, chunk by chunk;
+    messages are read in pages rather than loaded at once."""
+    cids = clean_cids(cids)
+    for chunk in _chunks(cids):
+        chats = _export_chats_page(chunk)
+        by_id = {c.id: c.cid for c in chats}
+        for c in chats:
+            yield {"kind": "chat", "id": c.id, "cid": c.cid, "name": c.customer_name, "active": bool(c.active),
+                   "created_at": c.created_at.isoformat() if c.created_at else None,
+                   "closed_at": c.closed_at.isoformat() if c.closed_at else None}
+        after = (0, 0)
+        while by_id:
+            msgs = _export_messages_page(list(by_id), after)
+            for m in msgs:
+                yield {"kind": "message", "id": m.id, "cid": by_id[m.chat_id], "role": m.role, "type": m.type,
+                       "text": m.text, "media_url": m.media_url, "deleted": bool(m.deleted),
+                       "created_at": m.created_at.isoformat() if m.created_at else None}
+            if len(msgs) < EXPORT_PAGE_ROWS:
+                break
+            after = (msgs[-1].chat_id, msgs[-1].id)
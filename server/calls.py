@@ -0,0 +1,146 @@
+"""Call signaling helpers for CallNS: payload validation, ICE candidate
+batching and per-call phase timing.
+
+Offers, answers and candidates are rebuilt from known fields with size caps
+before being forwarded, so peers never receive arbitrary client payloads.
+With RTC_CANDIDATE_BATCH_MS > 0, trickle candidates are held per (room,
+sender) and forwarded as one ``rtc:candidates`` array per window (or as soon
+as RTC_CANDIDATE_BATCH_MAX are waiting); the accepted-call check then runs
+once per batch instead of once per candidate.
+
+Phase timestamps live in the ``shared`` key/value store, so a ring handled
+by one worker and an accept handled by another still yield one sample."""
+import logging
+import threading
+import time
+from .config import cfg
+from .state import shared
+from .metrics import Counter, Histogram, REJECTIONS
+
+logger = logging.getLogger(__name__)
+
+CALL_PHASE_SECONDS = Histogram("konusma_call_phase_seconds", "Call setup phase durations", ("phase",),
+                               buckets=(.05, .1, .25, .5, 1, 2, 5, 10, 20, 30, 60))
+CALLS = Counter("konusma_calls_total", "Call outcomes", ("outcome",))
+RTC_CANDIDATES = Counter("konusma_rtc_candidates_total", "ICE candidates relayed", ("mode",))
+
+SDP_TYPES = {'offer': ('offer',), 'answer': ('answer', 'pranswer')}
+PHASE_TTL = 300
+
+class PayloadError(ValueError):
+    pass
+
+def clean_sdp(kind, sdp):
+    """``{'type', 'sdp'}`` from a client session description, or PayloadError."""
+    if not isinstance(sdp, dict):
+        raise PayloadError('sdp must be an object')
+    type_, body = sdp.get('type'), sdp.get('sdp')
+    if type_ not in SDP_TYPES[kind]:
+        raise PayloadError(f'sdp type must be {"/".join(SDP_TYPES[kind])}')
+    if not isinstance(body, str) or not body.startswith('v='):
+        raise PayloadError('sdp body missing')
+    if len(body.encode('utf-8')) > cfg.RTC_MAX_SDP_BYTES:
+        raise PayloadError('sdp too large')
+    return {'type': type_, 'sdp': body}
+
+def _opt_str(v, limit):
+    if v is None:
+        return None
+    if not isinstance(v, str) or len(v) > limit:
+        raise PayloadError('bad candidate field')
+    return v
+
+def clean_candidate(c):
+    """The RTCIceCandidateInit fields of ``c``, or PayloadError."""
+    if not isinstance(c, dict):
+        raise PayloadError('candidate must be an object')
+    cand = c.get('candidate')
+    if not isinstance(cand, str) or len(cand) > cfg.RTC_MAX_CANDIDATE_BYTES:
+        raise PayloadError('bad candidate')
+    idx = c.get('sdpMLineIndex')
+    if idx is not None and (not isinstance(idx, int) or isinstance(idx, bool) or not 0 <= idx < 64):
+        raise PayloadError('bad sdpMLineIndex')
+    return {'candidate': cand, 'sdpMid': _opt_str(c.get('sdpMid'), 64), 'sdpMLineIndex': idx,
+            'usernameFragment': _opt_str(c.get('usernameFragment'), 256)}
+
+PHASES = ('ring', 'offer')
+
+def forget(room):
+    """Drop ``room``'s open phase marks once the call cannot complete."""
+    for phase in PHASES:
+        shared.pop(f"call:{room}:{phase}")
+
+def mark(room, phase):
+    shared.put(f"call:{room}:{phase}", str(time.time()), PHASE_TTL)
+
+def measure(room, start, phase, keep=False):
+    """Observe the time since ``mark(room, start)`` as ``phase``, once."""
+    key = f"call:{room}:{start}"
+    t0 = shared.get(key) if keep else shared.pop(key)
+    if t0 is None:
+        return None
+    took = max(0.0, time.time() - float(t0))
+    CALL_PHASE_SECONDS.observe(took, phase)
+    return took
+
+class CandidateBatcher:
+    def __init__(self):
+        self.sio = None
+        self.namespace = None
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._task = None
+
+    @property
+    def enabled(self):
+        return cfg.RTC_CANDIDATE_BATCH_MS > 0
+
+    def bind(self, sio, namespace):
+        self.sio = sio
+        self.namespace = namespace
+
+    def add(self, room, sid, candidate):
+        key = (room, sid)
+        with self._lock:
+            batch = self._pending.setdefault(key, [])
+            batch.append(candidate)
+            full = len(batch) >= cfg.RTC_CANDIDATE_BATCH_MAX
+            if full:
+                del self._pending[key]
+            if self._task is None and self.sio is not None:
+                self._task = self.sio.start_background_task(self._loop)
+        if full:
+            self._send(room, sid, batch)
+
+    def discard(self, sid):
+        with self._lock:
+            for key in [k for k in self._pending if k[1] == sid]:
+                del self._pending[key]
+
+    def flush(self):
+        with self._lock:
+            if not self._pending:
+                return
+            batch = list(self._pending.items())
+            self._pending.clear()
+        for (room, sid), cands in batch:
+            self._send(room, sid, cands)
+
+    def _send(self, room, sid, cands):
+        if not shared.room_accepted(room):
+            logger.warning(f"rtc.blocked room={room} event=candidates n={len(cands)}")
+            REJECTIONS.inc('rtc_blocked')
+            return
+        RTC_CANDIDATES.inc('batched', n=len(cands))
+        self.sio.emit('rtc:candidates', {'chat_id': room, 'candidates': cands}, to=room, skip_sid=sid,
+                      namespace=self.namespace)
+
+    def _loop(self):
+        while True:
+            self.sio.sleep(cfg.RTC_CANDIDATE_BATCH_MS / 1000.0)
+            try:
+                self.flush()
+            except Exception as e:
+                logger.error(f"rtc.batch flush error: {e}")
+
+candidate_batcher = CandidateBatcher()
@@ -6,17 +6,79 @@ class Cfg:
     SECRET_KEY: str = os.getenv("SECRET_KEY", "change-me")
     TZ: str = os.getenv("TZ", "Europe/Istanbul")
     DATABASE_URL: str = os.getenv("DATABASE_URL", "sqlite:///./data.sqlite3")
+    DB_POOL_SIZE: int = int(os.getenv("DB_POOL_SIZE", "10"))
+    DB_MAX_OVERFLOW: int = int(os.getenv("DB_MAX_OVERFLOW", "20"))
+    DB_POOL_TIMEOUT: int = int(os.getenv("DB_POOL_TIMEOUT", "30"))
+    DB_POOL_RECYCLE: int = int(os.getenv("DB_POOL_RECYCLE", "1800"))
+    DB_POOL_PRE_PING: bool = os.getenv("DB_POOL_PRE_PING", "true").lower() == "true"
+    SQLITE_WAL: bool = os.getenv("SQLITE_WAL", "true").lower() == "true"
+    SQLITE_SYNCHRONOUS: str = os.getenv("SQLITE_SYNCHRONOUS", "NORMAL").upper()
+    SQLITE_BUSY_TIMEOUT_MS: int = int(os.getenv("SQLITE_BUSY_TIMEOUT_MS", "5000"))
+    CHAT_CACHE_SIZE: int = int(os.getenv("CHAT_CACHE_SIZE", "10000"))
+    CHAT_CACHE_TTL: int = int(os.getenv("CHAT_CACHE_TTL", "300"))
+    # on by default under green threads: the writer commits off the hub in one batch
+    MESSAGE_GROUP_COMMIT: bool = (os.getenv("MESSAGE_GROUP_COMMIT") or ("true" if os.getenv("ASYNC_MODE", "threading").lower() in ("eventlet", "gevent") else "false")).lower() == "true"
+    MESSAGE_BATCH_MS: int = int(os.getenv("MESSAGE_BATCH_MS", "20"))
+    MESSAGE_BATCH_SIZE: int = int(os.getenv("MESSAGE_BATCH_SIZE", "200"))
+    MEDIA_DIR: str = os.getenv("MEDIA_DIR", "./media")
+    MEDIA_MAX_BYTES: int = int(os.getenv("MEDIA_MAX_BYTES", str(10 * 1024 * 1024)))
+    UPLOAD_CHUNK_BYTES: int = int(os.getenv("UPLOAD_CHUNK_BYTES", str(256 * 1024)))
+    UPLOAD_MAX_INFLIGHT: int = int(os.getenv("UPLOAD_MAX_INFLIGHT", str(64 * 1024 * 1024)))
+    UPLOAD_MAX_INFLIGHT_PER_SID: int = int(os.getenv("UPLOAD_MAX_INFLIGHT_PER_SID", str(20 * 1024 * 1024)))
+    UPLOAD_TTL: int = int(os.getenv("UPLOAD_TTL", "600"))
     ALLOWED_ORIGINS: str = os.getenv("ALLOWED_ORIGINS", "*")
     TELEGRAM_BOT_TOKEN: str = os.getenv("TELEGRAM_BOT_TOKEN", "")
     TELEGRAM_ADMIN_CHAT_ID: str = os.getenv("TELEGRAM_ADMIN_CHAT_ID", "")
     TELEGRAM_WEBHOOK_URL: str = os.getenv("TELEGRAM_WEBHOOK_URL", "")
+    TELEGRAM_QUEUE_SIZE: int = int(os.getenv("TELEGRAM_QUEUE_SIZE", "1000"))
+    TELEGRAM_WORKERS: int = int(os.getenv("TELEGRAM_WORKERS", "2"))
+    TELEGRAM_COALESCE_MS: int = int(os.getenv("TELEGRAM_COALESCE_MS", "500"))
+    TELEGRAM_MAX_RETRIES: int = int(os.getenv("TELEGRAM_MAX_RETRIES", "3"))
     REQUIRE_ROOM_KEY: bool = os.getenv("REQUIRE_ROOM_KEY", "false").lower() == "true"
     MAX_ROOM_MEMBERS: int = int(os.getenv("MAX_ROOM_MEMBERS", "10"))
+    ROOM_IDLE_TTL: int = int(os.getenv("ROOM_IDLE_TTL", str(6 * 3600)))
+    ADMIN_PUSH_MS: int = int(os.getenv("ADMIN_PUSH_MS", "250"))
     ENABLE_CALLS: bool = os.getenv("ENABLE_CALLS", "true").lower() == "true"
     TURN_URL: str = os.getenv("TURN_URL", "")
     TURN_USERNAME: str = os.getenv("TURN_USERNAME", "")
     TURN_CREDENTIAL: str = os.getenv("TURN_CREDENTIAL", "")
     RATE_LIMIT_HOURLY: int = int(os.getenv("RATE_LIMIT_HOURLY", "300"))
     RATE_LIMIT_DAILY: int = int(os.getenv("RATE_LIMIT_DAILY", "2000"))
+    ASYNC_MODE: str = os.getenv("ASYNC_MODE", "threading").lower()
+    MAX_CONNECTIONS: int = int(os.getenv("MAX_CONNECTIONS", "10000"))
+    STATE_BACKEND_URL: str = os.getenv("STATE_BACKEND_URL", "memory://")
+    SOCKETIO_MESSAGE_QUEUE: str = os.getenv("SOCKETIO_MESSAGE_QUEUE", "")
+    RATELIMIT_STORAGE_URI: str = os.getenv("RATELIMIT_STORAGE_URI", "")
+    RTC_CANDIDATE_BATCH_MS: int = int(os.getenv("RTC_CANDIDATE_BATCH_MS", "0"))
+    RTC_CANDIDATE_BATCH_MAX: int = int(os.getenv("RTC_CANDIDATE_BATCH_MAX", "32"))
+    RTC_MAX_SDP_BYTES: int = int(os.getenv("RTC_MAX_SDP_BYTES", "16384"))
+    RTC_MAX_CANDIDATE_BYTES: int = int(os.getenv("RTC_MAX_CANDIDATE_BYTES", "1024"))
+    SOCKET_THROTTLE_ENABLED: bool = os.getenv("SOCKET_THROTTLE_ENABLED", "true").lower() == "true"
+    SOCKET_LIMITS_SID: str = os.getenv("SOCKET_LIMITS_SID", "*=20:40,join=0.5:5,send=2:10,call:ring=0.2:3,rtc:candidate=50:100,upload:chunk=40:80")
+    SOCKET_LIMITS_ROOM: str = os.getenv("SOCKET_LIMITS_ROOM", "send=5:20,call:ring=0.5:3,rtc:candidate=100:200")
+    TEST_CHECK_TIMEOUT: float = float(os.getenv("TEST_CHECK_TIMEOUT", "5"))
+    TEST_SUITE_TIMEOUT: float = float(os.getenv("TEST_SUITE_TIMEOUT", "15"))
+    TEST_MAX_WORKERS: int = int(os.getenv("TEST_MAX_WORKERS", "8"))
+    RETENTION_ENABLED: bool = os.getenv("RETENTION_ENABLED", "false").lower() == "true"
+    RETENTION_INTERVAL: int = int(os.getenv("RETENTION_INTERVAL", "3600"))
+    RETENTION_CLOSED_CHAT_DAYS: int = int(os.getenv("RETENTION_CLOSED_CHAT_DAYS", "30"))
+    RETENTION_MESSAGE_DAYS: int = int(os.getenv("RETENTION_MESSAGE_DAYS", "0"))
+    RETENTION_DELETED_MESSAGE_DAYS: int = int(os.getenv("RETENTION_DELETED_MESSAGE_DAYS", "7"))
+    RETENTION_ARCHIVE: bool = os.getenv("RETENTION_ARCHIVE", "true").lower() == "true"
+    RETENTION_ARCHIVE_DIR: str = os.getenv("RETENTION_ARCHIVE_DIR", "./archive")
+    RETENTION_BATCH_SIZE: int = int(os.getenv("RETENTION_BATCH_SIZE", "500"))
+    RETENTION_PAUSE_MS: int = int(os.getenv("RETENTION_PAUSE_MS", "100"))
+    RETENTION_MAX_BATCHES: int = int(os.getenv("RETENTION_MAX_BATCHES", "200"))
+    SCHEDULE_SYNC_SECONDS: int = int(os.getenv("SCHEDULE_SYNC_SECONDS", "60"))
+    REPAIR_BATCH_SIZE: int = int(os.getenv("REPAIR_BATCH_SIZE", "500"))
+    JOB_WORKERS: int = int(os.getenv("JOB_WORKERS", "2"))
+    JOB_MAX_PENDING: int = int(os.getenv("JOB_MAX_PENDING", "20"))
+    JOB_STALE_AFTER: int = int(os.getenv("JOB_STALE_AFTER", "900"))
+    BULK_CHUNK_SIZE: int = int(os.getenv("BULK_CHUNK_SIZE", "1000"))
+    BULK_MAX_IDS: int = int(os.getenv("BULK_MAX_IDS", "100000"))
+    SEARCH_LANGUAGE: str = os.getenv("SEARCH_LANGUAGE", "simple")
+    SEARCH_RANK_WINDOW: int = int(os.getenv("SEARCH_RANK_WINDOW", "1000"))
+    METRICS_ENABLED: bool = os.getenv("METRICS_ENABLED", "true").lower() == "true"
+    METRICS_TOKEN: str = os.getenv("METRICS_TOKEN", "")
 
 cfg = Cfg()
@@ -0,0 +1,87 @@
+"""Streaming transcript export.
+
+Rows are read in keyset pages of PAGE_ROWS off the green-thread hub, are
+encoded as NDJSON or CSV and leave in ~CHUNK_BYTES pieces, optionally through an incremental gzip
+stream, so memory stays flat however many messages are exported and the first
+bytes go out as soon as the first rows are read. Exports are ordered by
+message id; ``after_id`` resumes an interrupted download. CSV cells that a
+spreadsheet would read as a formula get a leading ``'``."""
+import csv
+import io
+import json
+import zlib
+from sqlalchemy import select
+from .storage import SessionLocal, ChatSession, Message
+from .utils import offloaded
+
+FORMATS = {"ndjson": "application/x-ndjson", "csv": "text/csv"}
+FIELDS = ("id", "cid", "name", "role", "type", "text", "media_url", "deleted", "created_at")
+PAGE_ROWS = 1000
+CHUNK_BYTES = 64 * 1024
+FORMULA_PREFIXES = ("=", "+", "-", "@", "\t", "\r")
+
+def _iso(d):
+    return d.isoformat() if d else None
+
+@offloaded
+def chat_cid(chat_id):
+    with SessionLocal() as s:
+        return s.execute(select(ChatSession.cid).where(ChatSession.id == chat_id)).scalar()
+
+@offloaded
+def _message_page(chat_id, after_id):
+    q = (select(Message.id, ChatSession.cid, ChatSession.customer_name, Message.role, Message.type, Message.text,
+                Message.media_url, Message.deleted, Message.created_at)
+         .join(ChatSession, ChatSession.id == Message.chat_id)
+         .where(Message.id > after_id)
+         .order_by(Message.id).limit(PAGE_ROWS))
+    if chat_id is not None:
+        q = q.where(Message.chat_id == chat_id)
+    with SessionLocal() as s:
+        return [{"id": i, "cid": cid, "name": name, "role": role, "type": type_, "text": text,
+                 "media_url": media_url, "deleted": bool(deleted), "created_at": _iso(created_at)}
+                for i, cid, name, role, type_, text, media_url, deleted, created_at in s.execute(q).tuples()]
+
+def message_rows(chat_id=None, after_id=None):
+    """Yield one flat dict per message (with its chat cid and name) in id order."""
+    last = after_id or 0
+    while True:
+        page = _message_page(chat_id, last)
+        yield from page
+        if len(page) < PAGE_ROWS:
+            return
+        last = page[-1]["id"]
+
+def _csv_safe(rec):
+    return {k: "'" + v if isinstance(v, str) and v.startswith(FORMULA_PREFIXES) else v for k, v in rec.items()}
+
+def encode(records, fmt="ndjson"):
+    """Text pieces of about CHUNK_BYTES for ``records`` in ``fmt``."""
+    buf = io.StringIO()
+    if fmt == "csv":
+        w = csv.DictWriter(buf, fieldnames=FIELDS, extrasaction="ignore")
+        w.writeheader()
+        write = lambda rec: w.writerow(_csv_safe(rec))
+    else:
+        write = lambda rec: buf.write(json.dumps(rec, ensure_ascii=False) + "\n")
+    for rec in records:
+        write(rec)
+        if buf.tell() >= CHUNK_BYTES:
+            yield buf.getvalue()
+            buf.seek(0)
+            buf.truncate()
+    if buf.tell():
+        yield buf.getvalue()
+
+def gzipped(pieces):
+    """gzip ``pieces`` incrementally; each piece is flushed so it can be sent right away."""
+    z = zlib.compressobj(6, zlib.DEFLATED, 31)
+    for p in pieces:
+        out = z.compress(p.encode("utf-8")) + z.flush(zlib.Z_SYNC_FLUSH)
+        if out:
+            yield out
+    yield z.flush()
+
+def stream(records, fmt="ndjson", gz=False):
+    pieces = encode(records, fmt)
+    return gzipped(pieces) if gz else (p.encode("utf-8") for p in pieces)
@@ -0,0 +1,171 @@
+"""Background jobs for test and repair runs.
+
+A POST creates a ``job_runs`` row and returns its id at once; the work runs
+on a small bounded executor (its body, like every query here, through
+``offload`` so green-thread modes keep the hub free) and reports progress
+into the same row, so any
+worker can answer polls and the table doubles as a duration history. A
+submit that matches a queued or running job of the same kind and params
+(after filling in the kind's defaults) returns that job instead of starting
+another; a unique partial index on the key of active rows makes that hold
+across workers too."""
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+import json
+import logging
+import threading
+import time
+from sqlalchemy.exc import IntegrityError
+from .config import cfg
+from .storage import SessionLocal, JobRun
+from .utils import generate_secret, offload, offloaded
+
+logger = logging.getLogger(__name__)
+
+ACTIVE = ("queued", "running")
+FINISHED = ("succeeded", "failed")
+
+class JobQueueFull(RuntimeError):
+    pass
+
+class JobRunner:
+    def __init__(self, workers, max_pending):
+        self.kinds = {}
+        self.defaults = {}
+        self.offload = {}
+        self.max_pending = max_pending
+        self._pool = ThreadPoolExecutor(max_workers=max(workers, 1), thread_name_prefix="job")
+        self._lock = threading.Lock()
+        self._pending = 0
+
+    def register(self, kind, fn, defaults=None, offload=True):
+        """``fn(params, progress)`` returns a JSON-serialisable result;
+        ``progress(percent, note)`` may be called any number of times.
+        ``defaults`` are merged under submitted params, so ``{}`` and the
+        spelled-out defaults are the same job. ``offload=False`` keeps ``fn``
+        on the hub, for bodies that spawn green threads of their own."""
+        self.kinds[kind] = fn
+        self.defaults[kind] = dict(defaults or {})
+        self.offload[kind] = offload
+
+    def submit(self, kind, params=None):
+        """Returns ``(job_dict, deduplicated)``."""
+        if kind not in self.kinds:
+            raise ValueError(f"Unknown job kind: {kind}")
+        params = {**self.defaults[kind], **(params or {})}
+        key = f"{kind}:{json.dumps(params, sort_keys=True)}"
+        with self._lock:
+            full = self._pending >= self.max_pending
+            if not full:
+                # reserve a slot; given back below unless a new job takes it
+                self._pending += 1
+        try:
+            job, dedup = self._claim(kind, key, params, full)
+        except BaseException:
+            if not full:
+                self._release()
+            raise
+        if dedup:
+            if not full:
+                self._release()
+        else:
+            self._pool.submit(self._run, job["id"], kind, params)
+        return job, dedup
+
+    @offloaded
+    def _claim(self, kind, key, params, full):
+        active = (JobRun.dedup_key == key, JobRun.status.in_(ACTIVE))
+        # rows from a crashed worker stay active; retire them so the unique index admits a new run
+        fresh = datetime.utcnow() - timedelta(seconds=cfg.JOB_STALE_AFTER)
+        with SessionLocal() as s:
+            s.query(JobRun).filter(*active, JobRun.created_at < fresh).update(
+                {"status": "failed", "note": "stale", "error": "no result within JOB_STALE_AFTER"}, synchronize_session=False)
+            dup = s.query(JobRun).filter(*active).order_by(JobRun.created_at.desc()).first()
+            if dup is not None:
+                s.commit()
+                return dup.to_dict(with_result=False), True
+            if full:
+                raise JobQueueFull("Too many jobs queued")
+            job = JobRun(id=generate_secret(12), kind=kind, dedup_key=key, params=json.dumps(params), status="queued")
+            s.add(job)
+            try:
+                s.commit()
+            except IntegrityError:
+                # another worker inserted the same active job first
+                s.rollback()
+                dup = s.query(JobRun).filter(*active).first()
+                if dup is None:
+                    raise
+                return dup.to_dict(with_result=False), True
+            return job.to_dict(with_result=False), False
+
+    def _release(self):
+        with self._lock:
+            self._pending -= 1
+
+    @offloaded
+    def _update(self, job_id, **fields):
+        with SessionLocal() as s:
+            s.query(JobRun).filter(JobRun.id == job_id).update(fields)
+            s.commit()
+
+    def _run(self, job_id, kind, params):
+        # the body and its progress writes go to the native pool, off the green-thread hub
+        try:
+            if self.offload[kind]:
+                offload(self._execute, job_id, kind, params)
+            else:
+                self._execute(job_id, kind, params)
+        finally:
+            self._release()
+
+    def _execute(self, job_id, kind, params):
+        started = datetime.utcnow()
+        t0 = time.perf_counter()
+        self._update(job_id, status="running", started_at=started, note="started")
+
+        def progress(percent, note=None):
+            self._update(job_id, progress=max(0, min(100, int(percent))), note=note)
+
+        try:
+            result = self.kinds[kind](params, progress)
+            fields = dict(status="succeeded", progress=100, note="done", result=json.dumps(result, default=str))
+        except Exception as e:
+            logger.error(f"job.{kind} {job_id} failed: {e}")
+            fields = dict(status="failed", note="error", error=str(e))
+        self._update(job_id, finished_at=datetime.utcnow(), duration_ms=int((time.perf_counter() - t0) * 1000), **fields)
+
+    @offloaded
+    def get(self, job_id, with_result=True):
+        with SessionLocal() as s:
+            job = s.get(JobRun, job_id)
+            return job.to_dict(with_result) if job else None
+
+    @offloaded
+    def history(self, kind=None, limit=50):
+        limit = max(1, min(int(limit), 500))
+        with SessionLocal() as s:
+            q = s.query(JobRun)
+            if kind:
+                q = q.filter(JobRun.kind == kind)
+            return [j.to_dict(with_result=False) for j in q.order_by(JobRun.created_at.desc()).limit(limit)]
+
+    def stream(self, job_id, interval=0.5, timeout=600):
+        """Yield the job dict each time its status/progress changes, ending
+        with the finished job (including its result)."""
+        last = None
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            job = self.get(job_id, with_result=False)
+            if job is None:
+                return
+            if job["status"] in FINISHED:
+                yield self.get(job_id)
+                return
+            state = (job["status"], job["progress"], job["note"])
+            if state != last:
+                last = state
+                yield job
+            time.sleep(interval)
+
+job_runner = JobRunner(cfg.JOB_WORKERS, cfg.JOB_MAX_PENDING)
@@ -0,0 +1,263 @@
+from flask import Blueprint, send_file, abort
+import base64
+import binascii
+import hashlib
+import logging
+import os
+import re
+import tempfile
+import threading
+import time
+from .config import cfg
+from .utils import generate_secret
+
+logger = logging.getLogger(__name__)
+
+media_bp = Blueprint("media", __name__)
+
+# Raster images and recorded audio only. Anything that can carry script
+# (SVG, HTML, XML) must never be stored, since media is served from our origin.
+ALLOWED_TYPES = {
+    "image/png": ".png", "image/jpeg": ".jpg", "image/gif": ".gif", "image/webp": ".webp",
+    "audio/webm": ".weba", "audio/ogg": ".oga", "audio/mpeg": ".mp3", "audio/mp4": ".m4a",
+    "audio/aac": ".aac", "audio/wav": ".wav", "audio/x-wav": ".wav",
+}
+_SERVE_TYPES = {ext: mime for mime, ext in ALLOWED_TYPES.items() if mime != "audio/x-wav"}
+_DATA_URL = re.compile(r"^data:(?P<mime>[\w.+-]+/[\w.+-]+)(?:;[\w=.+-]+)*;base64,", re.I)
+_NAME = re.compile(r"^(?P<sha>[0-9a-f]{64})(?P<ext>\.[a-z0-9]+)?$")
+
+class MediaError(ValueError):
+    pass
+
+def _path_for(sha, ext=""):
+    return os.path.join(cfg.MEDIA_DIR, sha[:2], sha[2:4], sha + ext)
+
+def _base_mime(mime):
+    return mime.split(";", 1)[0].strip().lower() if isinstance(mime, str) else ""
+
+def allowed(mime, kind=None):
+    base = _base_mime(mime)
+    return base in ALLOWED_TYPES and (kind is None or base.startswith(kind + "/"))
+
+def _ext_for(mime):
+    return ALLOWED_TYPES[_base_mime(mime)]
+
+def media_url(sha, ext=""):
+    return f"/media/{sha}{ext}"
+
+def store_bytes(data, mime):
+    """Write ``data`` under its SHA-256 and return the public URL. Identical
+    uploads resolve to the same file, so the second write is skipped."""
+    if not allowed(mime):
+        raise MediaError("Unsupported media type")
+    if len(data) > cfg.MEDIA_MAX_BYTES:
+        raise MediaError("Media too large")
+    sha = hashlib.sha256(data).hexdigest()
+    ext = _ext_for(mime)
+    path = _path_for(sha, ext)
+    if not os.path.exists(path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path))
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(data)
+            os.replace(tmp, path)
+        except BaseException:
+            if os.path.exists(tmp):
+                os.unlink(tmp)
+            raise
+    return media_url(sha, ext)
+
+def _publish(tmp, sha, mime):
+    ext = _ext_for(mime)
+    path = _path_for(sha, ext)
+    if os.path.exists(path):
+        os.unlink(tmp)
+    else:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        os.replace(tmp, path)
+    return media_url(sha, ext)
+
+def store_data_url(data_url):
+    """Decode a ``data:<mime>;base64,...`` URL once and store it."""
+    if not isinstance(data_url, str):
+        raise MediaError("Invalid media")
+    m = _DATA_URL.match(data_url)
+    if not m:
+        raise MediaError("Invalid media")
+    # base64 inflates by 4/3; reject before decoding anything oversized
+    if (len(data_url) - m.end()) * 3 // 4 > cfg.MEDIA_MAX_BYTES:
+        raise MediaError("Media too large")
+    try:
+        data = base64.b64decode(data_url[m.end():], validate=True)
+    except (binascii.Error, ValueError):
+        raise MediaError("Invalid media encoding")
+    return store_bytes(data, m.group("mime"))
+
+MOVE_BATCH = 100
+
+def move_inline_media(engine):
+    """Move base64 data URLs that older versions kept in ``messages.text``
+    into the blob store: ``media_url`` is set and ``text`` cleared, a batch of
+    MOVE_BATCH rows per transaction. Rows whose media is not allowed or too
+    large stay as they are. Runs as a migration step."""
+    from sqlalchemy import text
+    last = moved = kept = 0
+    while True:
+        with engine.connect() as c:
+            rows = c.execute(text("SELECT id, text FROM messages WHERE id > :last AND type IN ('image', 'audio') "
+                                  "AND media_url IS NULL AND text LIKE 'data:%' ORDER BY id LIMIT :n"),
+                             {"last": last, "n": MOVE_BATCH}).all()
+        if not rows:
+            break
+        done = []
+        for mid, data_url in rows:
+            try:
+                done.append({"id": mid, "url": store_data_url(data_url)})
+            except MediaError as e:
+                kept += 1
+                logger.warning(f"media: message {mid} left inline: {e}")
+        if done:
+            with engine.begin() as c:
+                c.execute(text("UPDATE messages SET media_url = :url, text = NULL WHERE id = :id AND media_url IS NULL"), done)
+        moved += len(done)
+        last = rows[-1].id
+    logger.info(f"media: moved {moved} inline data URLs to the blob store, {kept} left inline")
+
+class Upload:
+    __slots__ = ("id", "chat_id", "sid", "type", "mime", "size", "offset", "hasher", "tmp", "touched", "lock")
+
+    def __init__(self, chat_id, type_, mime, size, sid=None):
+        self.id = generate_secret(12)
+        self.chat_id = chat_id
+        self.sid = sid
+        self.type = type_
+        self.mime = mime
+        self.size = size
+        self.offset = 0
+        self.hasher = hashlib.sha256()
+        self.tmp = os.path.join(cfg.MEDIA_DIR, ".uploads", self.id)
+        self.touched = time.monotonic()
+        self.lock = threading.Lock()
+
+class UploadRegistry:
+    """Chunked uploads in progress. Each chunk is hashed and appended to a temp
+    file as it arrives, so memory per upload is bounded by the chunk size.
+    Outstanding bytes are capped per socket (UPLOAD_MAX_INFLIGHT_PER_SID) and
+    in total (UPLOAD_MAX_INFLIGHT). The registry lock only guards the dict;
+    file writes happen under the upload's own lock."""
+
+    def __init__(self):
+        self._uploads = {}
+        self._lock = threading.Lock()
+
+    def _inflight(self, sid=None):
+        return sum(u.size - u.offset for u in self._uploads.values() if sid is None or u.sid == sid)
+
+    def _expire(self):
+        cutoff = time.monotonic() - cfg.UPLOAD_TTL
+        for uid, u in list(self._uploads.items()):
+            if u.touched < cutoff:
+                self._discard(uid)
+
+    def _discard(self, uid):
+        u = self._uploads.pop(uid, None)
+        if u and os.path.exists(u.tmp):
+            os.unlink(u.tmp)
+
+    def _get(self, uid, chat_id):
+        u = self._uploads.get(uid)
+        if u is None or u.chat_id != chat_id:
+            raise MediaError("Unknown upload")
+        return u
+
+    def start(self, chat_id, type_, mime, size, upload_id=None, sid=None):
+        with self._lock:
+            self._expire()
+            if upload_id:
+                # resume (typically from a new sid after a reconnect): tell the
+                # client where to continue from; the upload moves to that sid
+                u = self._get(upload_id, chat_id)
+                u.touched = time.monotonic()
+                u.sid = sid
+                return u
+            if not allowed(mime, type_):
+                raise MediaError("Unsupported media type")
+            if not isinstance(size, int) or size <= 0 or size > cfg.MEDIA_MAX_BYTES:
+                raise MediaError("Media too large")
+            if self._inflight(sid) + size > cfg.UPLOAD_MAX_INFLIGHT_PER_SID:
+                raise MediaError("Too many uploads in progress")
+            if self._inflight() + size > cfg.UPLOAD_MAX_INFLIGHT:
+                raise MediaError("Server busy, retry later")
+            u = Upload(chat_id, type_, mime, size, sid)
+            self._uploads[u.id] = u
+        os.makedirs(os.path.dirname(u.tmp), exist_ok=True)
+        open(u.tmp, "wb").close()
+        return u
+
+    def chunk(self, upload_id, chat_id, offset, data):
+        if not isinstance(data, (bytes, bytearray)):
+            raise MediaError("Chunk must be binary")
+        if len(data) > cfg.UPLOAD_CHUNK_BYTES:
+            raise MediaError("Chunk too large")
+        with self._lock:
+            u = self._get(upload_id, chat_id)
+        with u.lock:
+            if offset != u.offset:
+                return u
+            if u.offset + len(data) > u.size:
+                with self._lock:
+                    self._discard(upload_id)
+                raise MediaError("Upload exceeds declared size")
+            with open(u.tmp, "ab") as f:
+                f.write(data)
+            u.hasher.update(data)
+            u.offset += len(data)
+            u.touched = time.monotonic()
+        return u
+
+    def finish(self, upload_id, chat_id):
+        with self._lock:
+            u = self._get(upload_id, chat_id)
+        with u.lock:
+            if u.offset != u.size:
+                raise MediaError("Upload incomplete")
+            with self._lock:
+                if self._uploads.pop(upload_id, None) is None:
+                    raise MediaError("Unknown upload")
+        return u, _publish(u.tmp, u.hasher.hexdigest(), u.mime)
+
+    def abort(self, upload_id, chat_id):
+        with self._lock:
+            self._get(upload_id, chat_id)
+            self._discard(upload_id)
+
+uploads = UploadRegistry()
+
+def local_path(url):
+    """Map a /media/<sha><ext> URL back to its file, or None."""
+    if not url or not url.startswith("/media/"):
+        return None
+    m = _NAME.match(url[len("/media/"):])
+    if not m:
+        return None
+    path = _path_for(m.group("sha"), m.group("ext") or "")
+    return path if os.path.exists(path) else None
+
+@media_bp.get("/<name>")
+def serve(name):
+    m = _NAME.match(name)
+    if not m:
+        abort(404)
+    path = _path_for(m.group("sha"), m.group("ext") or "")
+    if not os.path.exists(path):
+        abort(404)
+    # content addressed: the hash is a strong ETag and the file never changes.
+    # Files from before the type allow-list (e.g. .svg) are served as opaque
+    # downloads, and nothing served here may run script or be sniffed.
+    mime = _SERVE_TYPES.get(m.group("ext") or "")
+    resp = send_file(path, mimetype=mime or "application/octet-stream", as_attachment=mime is None,
+                     conditional=True, etag=m.group("sha"), max_age=31536000)
+    resp.headers["Content-Security-Policy"] = "sandbox"
+    resp.headers["X-Content-Type-Options"] = "nosniff"
+    return resp
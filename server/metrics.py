@@ -0,0 +1,165 @@
+"""In-process metrics rendered in the Prometheus text format at /metrics.
+
+Deliberately dependency free: a metric is a dict of label tuples guarded by
+one lock, and ``observe`` is a bisect plus two additions, so instrumentation
+can stay on in production. Values are per process; with several workers,
+scrape each one (or aggregate by instance label)."""
+from bisect import bisect_left
+from contextlib import contextmanager
+import time
+from .utils import native_lock
+
+# seconds; covers sub-millisecond socket handlers up to slow outbound HTTP
+DEFAULT_BUCKETS = (.0005, .001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10)
+
+_registry = []
+
+def _esc(v):
+    return str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def _fmt_labels(names, values, extra=None):
+    pairs = [f'{n}="{_esc(v)}"' for n, v in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+class _Metric:
+    kind = None
+
+    def __init__(self, name, doc, labels=()):
+        self.name = name
+        self.doc = doc
+        self.labelnames = tuple(labels)
+        self._values = {}
+        self._lock = native_lock()
+        _registry.append(self)
+
+    def _header(self):
+        return [f"# HELP {self.name} {self.doc}", f"# TYPE {self.name} {self.kind}"]
+
+    def clear(self):
+        with self._lock:
+            self._values.clear()
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def inc(self, *labels, n=1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + n
+
+    def value(self, *labels):
+        return self._values.get(labels, 0)
+
+    def render(self):
+        with self._lock:
+            items = list(self._values.items())
+        return self._header() + [f"{self.name}{_fmt_labels(self.labelnames, k)} {v}" for k, v in items]
+
+class Gauge(_Metric):
+    """Set directly, or pass ``fn`` returning a number (no labels) or a dict
+    of label tuple -> number; it is called at scrape time."""
+    kind = "gauge"
+
+    def __init__(self, name, doc, labels=(), fn=None):
+        super().__init__(name, doc, labels)
+        self.fn = fn
+
+    def set(self, value, *labels):
+        with self._lock:
+            self._values[labels] = value
+
+    def inc(self, *labels, n=1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + n
+
+    def dec(self, *labels, n=1):
+        self.inc(*labels, n=-n)
+
+    def render(self):
+        if self.fn is not None:
+            v = self.fn()
+            items = list(v.items()) if isinstance(v, dict) else [((), v)]
+        else:
+            with self._lock:
+                items = list(self._values.items())
+        return self._header() + [f"{self.name}{_fmt_labels(self.labelnames, k)} {v}" for k, v in items if v is not None]
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name, doc, labels=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, doc, labels)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, *labels):
+        i = bisect_left(self.buckets, value)
+        with self._lock:
+            st = self._values.get(labels)
+            if st is None:
+                st = self._values[labels] = [[0] * (len(self.buckets) + 1), 0.0]
+            st[0][i] += 1
+            st[1] += value
+
+    @contextmanager
+    def time(self, *labels):
+        t0 = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - t0, *labels)
+
+    def render(self):
+        with self._lock:
+            items = [(k, list(st[0]), st[1]) for k, st in self._values.items()]
+        out = self._header()
+        for k, counts, total in items:
+            acc = 0
+            for le, c in zip(self.buckets + (float("inf"),), counts):
+                acc += c
+                le = 'le="+Inf"' if le == float("inf") else f'le="{le!r}"'
+                out.append(f"{self.name}_bucket{_fmt_labels(self.labelnames, k, le)} {acc}")
+            out.append(f"{self.name}_sum{_fmt_labels(self.labelnames, k)} {total}")
+            out.append(f"{self.name}_count{_fmt_labels(self.labelnames, k)} {acc}")
+        return out
+
+def render():
+    lines = []
+    for m in _registry:
+        try:
+            lines.extend(m.render())
+        except Exception as e:
+            lines.append(f"# {m.name} unavailable: {_esc(e)}")
+    return "\n".join(lines) + "\n"
+
+# --- application metrics -------------------------------------------------
+
+SOCKET_HANDLER_SECONDS = Histogram("konusma_socketio_handler_seconds", "Socket.IO event handler latency", ("namespace", "event"))
+SOCKET_CONNECTIONS = Gauge("konusma_socketio_connections", "Connected Socket.IO clients", ("namespace",))
+HTTP_REQUEST_SECONDS = Histogram("konusma_http_request_seconds", "HTTP request latency", ("method", "endpoint", "status"))
+DB_QUERY_SECONDS = Histogram("konusma_db_query_seconds", "Database statement execution time", ("op",))
+OUTBOUND_HTTP_SECONDS = Histogram("konusma_outbound_http_seconds", "Outbound HTTP call time", ("service", "method", "outcome"))
+MESSAGES = Counter("konusma_messages_total", "Chat messages accepted", ("role", "type"))
+JOINS = Counter("konusma_joins_total", "Room joins", ("namespace",))
+REJECTIONS = Counter("konusma_rejections_total", "Rejected signaling requests", ("reason",))
+
+def instrument_engine(engine):
+    """Time every statement on ``engine`` via SQLAlchemy cursor events."""
+    from sqlalchemy import event
+
+    @event.listens_for(engine, "before_cursor_execute")
+    def _start(conn, cursor, statement, params, context, executemany):
+        conn.info.setdefault("_metrics_t0", []).append(time.perf_counter())
+
+    @event.listens_for(engine, "after_cursor_execute")
+    def _stop(conn, cursor, statement, params, context, executemany):
+        stack = conn.info.get("_metrics_t0")
+        if stack:
+            op = statement.lstrip().split(None, 1)[0].upper() if statement else "?"
+            DB_QUERY_SECONDS.observe(time.perf_counter() - stack.pop(), op)
+
+    @event.listens_for(engine, "handle_error")
+    def _error(ctx):
+        stack = ctx.connection.info.get("_metrics_t0") if ctx.connection is not None else None
+        if stack:
+            stack.pop()
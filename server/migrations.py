@@ -0,0 +1,143 @@
+"""Versioned schema migrations, applied by ``init_db``.
+
+``create_all`` only creates missing tables, so anything added to an existing
+table (indexes, columns) ships as a numbered step here. Steps are idempotent
+and additive-first: new indexes are built before old ones are dropped, and
+on PostgreSQL they are built ``CONCURRENTLY`` so writers are never blocked.
+Applied versions are recorded in ``schema_migrations``; several workers may
+start at once, and the loser of a version insert simply moves on."""
+import logging
+from datetime import datetime
+from sqlalchemy import inspect, text
+from sqlalchemy.exc import IntegrityError
+
+logger = logging.getLogger(__name__)
+
+def _pg(engine):
+    return engine.dialect.name == "postgresql"
+
+def create_index(engine, name, table, columns, unique=False, where=None):
+    concurrently = "CONCURRENTLY " if _pg(engine) else ""
+    ddl = (f"CREATE {'UNIQUE ' if unique else ''}INDEX {concurrently}IF NOT EXISTS {name} ON {table} ({', '.join(columns)})"
+           + (f" WHERE {where}" if where else ""))
+    # CONCURRENTLY cannot run inside a transaction block
+    with engine.connect().execution_options(isolation_level="AUTOCOMMIT") as c:
+        c.exec_driver_sql(ddl)
+
+def drop_index(engine, name):
+    concurrently = "CONCURRENTLY " if _pg(engine) else ""
+    with engine.connect().execution_options(isolation_level="AUTOCOMMIT") as c:
+        c.exec_driver_sql(f"DROP INDEX {concurrently}IF EXISTS {name}")
+
+def add_column(engine, table, column_ddl):
+    """``column_ddl`` like ``"archived_at TIMESTAMP NULL"``; nullable or
+    defaulted columns only, so old code keeps working during a rollout."""
+    name = column_ddl.split()[0]
+    if name in {c["name"] for c in inspect(engine).get_columns(table)}:
+        return
+    with engine.begin() as c:
+        c.exec_driver_sql(f"ALTER TABLE {table} ADD COLUMN {column_ddl}")
+
+def _baseline(engine):
+    from .storage import Base
+    Base.metadata.create_all(engine)
+
+def _message_history_indexes(engine):
+    # history pages, unread counts and last-message lookups all filter
+    # (chat_id, deleted) and walk id; `since` sync walks created_at
+    create_index(engine, "ix_messages_chat_id_deleted_id", "messages", ["chat_id", "deleted", "id"])
+    create_index(engine, "ix_messages_chat_id_created_at", "messages", ["chat_id", "created_at"])
+    drop_index(engine, "ix_messages_chat_id_id")
+
+def _active_chat_list_index(engine):
+    create_index(engine, "ix_chat_sessions_active_id", "chat_sessions", ["active", "id"])
+
+def _chat_closed_at(engine):
+    # retention ages closed chats from this
+    add_column(engine, "chat_sessions", "closed_at TIMESTAMP NULL")
+    _backfill_closed_at(engine)
+
+def _backfill_closed_at(engine):
+    # chats closed before the column existed start their retention clock at
+    # deploy time rather than being aged from created_at and purged at once
+    with engine.begin() as c:
+        n = c.execute(text("UPDATE chat_sessions SET closed_at = :now WHERE active = false AND closed_at IS NULL"),
+                      {"now": datetime.utcnow()}).rowcount
+    logger.info(f"closed_at backfilled for {n} closed chats")
+
+def _active_job_unique_key(engine):
+    # at most one queued/running job per dedup key, across workers; retire
+    # stale and duplicate active rows first or the unique build fails
+    from .config import cfg
+    from datetime import timedelta
+    with engine.begin() as c:
+        c.execute(text(
+            "UPDATE job_runs SET status = 'failed', note = 'stale', error = 'superseded before unique active key' "
+            "WHERE status IN ('queued', 'running') AND (created_at < :fresh OR EXISTS ("
+            "SELECT 1 FROM job_runs j WHERE j.dedup_key = job_runs.dedup_key AND j.status IN ('queued', 'running') "
+            "AND (j.created_at > job_runs.created_at OR (j.created_at = job_runs.created_at AND j.id > job_runs.id))))"),
+            {"fresh": datetime.utcnow() - timedelta(seconds=cfg.JOB_STALE_AFTER)})
+    create_index(engine, "ux_job_runs_active_dedup_key", "job_runs", ["dedup_key"], unique=True,
+                 where="status IN ('queued', 'running')")
+
+def _message_search(engine):
+    from .search import install
+    install(engine)
+
+def _inline_media(engine):
+    # history rows from before the blob store carry whole base64 files
+    from .media import move_inline_media
+    move_inline_media(engine)
+
+MIGRATIONS = [
+    (1, "baseline tables", _baseline),
+    (2, "message history indexes", _message_history_indexes),
+    (3, "active chat list index", _active_chat_list_index),
+    (4, "chat closed_at", _chat_closed_at),
+    (5, "message full-text search", _message_search),
+    (6, "unique active job key", _active_job_unique_key),
+    (7, "inline media to blob store", _inline_media),
+]
+
+def applied_versions(engine):
+    from .storage import SchemaMigration
+    if not inspect(engine).has_table(SchemaMigration.__tablename__):
+        return set()
+    with engine.connect() as c:
+        return {v for (v,) in c.execute(SchemaMigration.__table__.select().with_only_columns(SchemaMigration.version))}
+
+def migrate(engine):
+    """Apply pending steps in order; returns the versions applied by this call."""
+    from .storage import SchemaMigration
+    SchemaMigration.__table__.create(engine, checkfirst=True)
+    done = applied_versions(engine)
+    ran = []
+    for version, name, step in MIGRATIONS:
+        if version in done:
+            continue
+        logger.info(f"migration {version}: {name}")
+        step(engine)
+        try:
+            with engine.begin() as c:
+                c.execute(SchemaMigration.__table__.insert().values(version=version, name=name, applied_at=datetime.utcnow()))
+        except IntegrityError:
+            logger.info(f"migration {version} recorded by another worker")
+        ran.append(version)
+    return ran
+
+def current_version(engine):
+    done = applied_versions(engine)
+    return max(done) if done else 0
+
+def pending(engine):
+    done = applied_versions(engine)
+    return [(v, n) for v, n, _ in MIGRATIONS if v not in done]
+
+if __name__ == "__main__":
+    import sys
+    from .storage import engine
+    logging.basicConfig(level=logging.INFO)
+    if sys.argv[1:] == ["status"]:
+        print(f"current={current_version(engine)} pending={pending(engine)}")
+    else:
+        print(f"applied={migrate(engine)}")
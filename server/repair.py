@@ -1,46 +1,72 @@
 from __future__ import annotations
 from typing import Dict
-from .storage import SessionLocal, ChatSession
-from .signaling import ROOM_STATE
-from .utils import generate_secret
+from sqlalchemy import select, update, func, or_
+from .config import cfg
+from .storage import SessionLocal, ChatSession, invalidate_chat_cache
+from .state import shared
+from .calls import forget
+from .utils import generate_secret, offloaded
 
-def plan_safe() -> Dict:
-    empty_rooms = [r for r, st in ROOM_STATE.items() if not (st.get('members') or set())]
-    missing = 0
+def _missing_room():
+    return or_(ChatSession.room.is_(None), ChatSession.room == "",
+               ChatSession.room_key.is_(None), ChatSession.room_key == "")
+
+@offloaded
+def count_missing_room() -> int:
+    """Chats lacking room or room_key, counted in the database."""
     with SessionLocal() as s:
-        for c in s.query(ChatSession).all():
-            if not getattr(c, "room", None) or not getattr(c, "room_key", None):
-                missing += 1
+        return s.execute(select(func.count()).select_from(ChatSession).where(_missing_room())).scalar_one()
+
+@offloaded
+def backfill_rooms(batch_size=None, progress=None) -> int:
+    """Fill in missing room/room_key. Only affected rows are read, by keyset
+    on id, and each batch is one executemany UPDATE in its own transaction."""
+    batch_size = batch_size or cfg.REPAIR_BATCH_SIZE
+    total = count_missing_room()
+    done, last_id = 0, 0
+    while total:
+        with SessionLocal() as s:
+            rows = s.execute(select(ChatSession.id, ChatSession.cid, ChatSession.room, ChatSession.room_key)
+                             .where(ChatSession.id > last_id, _missing_room())
+                             .order_by(ChatSession.id).limit(batch_size)).all()
+            if not rows:
+                break
+            s.execute(update(ChatSession), [
+                {"id": r.id,
+                 "room": r.room or r.cid or f"room-{generate_secret(8)}",
+                 "room_key": r.room_key or generate_secret()}
+                for r in rows])
+            s.commit()
+        last_id = rows[-1].id
+        done += len(rows)
+        invalidate_chat_cache(chat_ids=[r.id for r in rows])
+        if progress:
+            progress(done, total)
+    return done
+
+def plan_safe() -> Dict:
+    empty_rooms = shared.empty_rooms()
+    idle_rooms = shared.idle_rooms()
+    missing = count_missing_room()
     return {
-        "room_state_cleanup": {"empty_rooms": empty_rooms},
+        "room_state_cleanup": {"empty_rooms": empty_rooms, "idle_rooms": idle_rooms},
         "db_backfill": {"missing_records": missing},
         "ice_reload": True,
         "session_purge": {"expired_example": 0}
     }
 
-def apply_safe() -> Dict:
+def apply_safe(progress=None) -> Dict:
     applied = {"room_state_cleanup":0, "db_backfill":0, "ice_reload":True, "session_purge":0}
 
-    # ROOM_STATE cleanup
-    empty_rooms = [r for r, st in list(ROOM_STATE.items()) if not (st.get('members') or set())]
+    # room state cleanup
+    empty_rooms = shared.empty_rooms()
     for r in empty_rooms:
-        ROOM_STATE.pop(r, None)
-    applied["room_state_cleanup"] = len(empty_rooms)
+        shared.room_delete(r)
+        forget(r)
+    applied["room_state_cleanup"] = len(empty_rooms) + len(shared.expire_idle())
 
     # DB backfill (idempotent)
-    with SessionLocal() as s:
-        cnt = 0
-        for c in s.query(ChatSession).all():
-            changed = False
-            if not getattr(c, "room", None):
-                c.room = getattr(c, "cid", None) or f"room-{generate_secret(8)}"
-                changed = True
-            if not getattr(c, "room_key", None):
-                c.room_key = generate_secret()
-                changed = True
-            if changed: cnt += 1
-        s.commit()
-        applied["db_backfill"] = cnt
+    applied["db_backfill"] = backfill_rooms(progress=progress)
 
     return applied
 
@@ -0,0 +1,193 @@
+"""Retention: keep ``chat_sessions``/``messages`` small.
+
+Three policies, each off when its age is 0:
+
+* closed chats   - chats closed longer than RETENTION_CLOSED_CHAT_DAYS are
+                   removed with their messages and read marker
+* old messages   - messages older than RETENTION_MESSAGE_DAYS leave the table
+* deleted rows   - soft-deleted messages older than
+                   RETENTION_DELETED_MESSAGE_DAYS are dropped
+
+Messages that leave the table are first written to gzip NDJSON files under
+RETENTION_ARCHIVE_DIR (unless RETENTION_ARCHIVE is off); soft-deleted ones
+are dropped without archiving. Work is done in batches of
+RETENTION_BATCH_SIZE, each its own transaction, with RETENTION_PAUSE_MS
+between batches and at most RETENTION_MAX_BATCHES per run, so a pass never
+holds long locks or starves live traffic.
+
+Message ids grow with created_at, so the age cutoff is turned into an id
+bound with a few primary-key probes and every scan walks the primary key."""
+from datetime import datetime, timedelta
+import gzip
+import json
+import logging
+import os
+import time
+from sqlalchemy import select, delete, func, and_
+from .config import cfg
+from .metrics import Counter
+from .storage import SessionLocal, ChatSession, Message, ChatReadMarker, invalidate_chat_cache
+
+logger = logging.getLogger(__name__)
+
+RETENTION_ROWS = Counter("konusma_retention_rows_total", "Rows removed by retention", ("action",))
+
+def _cutoff(days):
+    return datetime.utcnow() - timedelta(days=days) if days and days > 0 else None
+
+def cutoff_message_id(cutoff):
+    """Largest id whose row is older than ``cutoff`` (0 if none), found by
+    bisecting the id range with primary-key seeks."""
+    with SessionLocal() as s:
+        lo, hi = s.execute(select(func.min(Message.id), func.max(Message.id))).one()
+        if lo is None:
+            return 0
+
+        def first_at_or_after(i):
+            return s.execute(select(Message.id, Message.created_at).where(Message.id >= i)
+                             .order_by(Message.id).limit(1)).first()
+        first = first_at_or_after(lo)
+        if first.created_at >= cutoff:
+            return 0
+        best = first.id
+        lo = first.id + 1
+        while lo <= hi:
+            mid = (lo + hi) // 2
+            row = first_at_or_after(mid)
+            if row is not None and row.created_at < cutoff:
+                best = row.id
+                lo = row.id + 1
+            else:
+                hi = mid - 1
+        return best
+
+def _archive(rows, cids):
+    """Write ``rows`` to one gzip NDJSON file, durably, before they are deleted."""
+    if not cfg.RETENTION_ARCHIVE or not rows:
+        return None
+    day = datetime.utcnow()
+    d = os.path.join(cfg.RETENTION_ARCHIVE_DIR, day.strftime("%Y"), day.strftime("%m"))
+    os.makedirs(d, exist_ok=True)
+    path = os.path.join(d, f"messages-{rows[0].id}-{rows[-1].id}.ndjson.gz")
+    tmp = path + ".tmp"
+    with gzip.open(tmp, "wt", encoding="utf-8") as f:
+        for m in rows:
+            f.write(json.dumps({"id": m.id, "chat_id": m.chat_id, "cid": cids.get(m.chat_id), "role": m.role,
+                                "type": m.type, "text": m.text, "media_url": m.media_url, "deleted": bool(m.deleted),
+                                "created_at": m.created_at.isoformat() if m.created_at else None}) + "\n")
+    with open(tmp, "rb") as f:
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+    return path
+
+class _Budget:
+    def __init__(self, progress):
+        self.batches = 0
+        self.progress = progress
+
+    def spend(self, note):
+        self.batches += 1
+        if self.progress:
+            self.progress(min(99, self.batches * 100 // max(cfg.RETENTION_MAX_BATCHES, 1)), note)
+        time.sleep(cfg.RETENTION_PAUSE_MS / 1000.0)
+
+    @property
+    def left(self):
+        return self.batches < cfg.RETENTION_MAX_BATCHES
+
+def _cids(s, chat_ids):
+    return dict(s.execute(select(ChatSession.id, ChatSession.cid).where(ChatSession.id.in_(chat_ids))).all()) if chat_ids else {}
+
+def _move_messages(where, budget, label, archive=True):
+    """Archive (optionally) and delete messages matching ``where``, by id."""
+    total, last_id = 0, 0
+    while budget.left:
+        with SessionLocal() as s:
+            rows = s.execute(select(Message).where(Message.id > last_id, where)
+                             .order_by(Message.id).limit(cfg.RETENTION_BATCH_SIZE)).scalars().all()
+            if not rows:
+                break
+            if archive:
+                _archive(rows, _cids(s, {m.chat_id for m in rows}))
+            s.execute(delete(Message).where(Message.id.in_([m.id for m in rows])))
+            s.commit()
+        last_id = rows[-1].id
+        total += len(rows)
+        RETENTION_ROWS.inc(label, n=len(rows))
+        budget.spend(f"{label} {total}")
+    return total
+
+def _closed_chats_filter(cutoff):
+    # migration 4 backfills closed_at, and every close path sets it
+    return and_(ChatSession.active == False, ChatSession.closed_at < cutoff)
+
+def purge_closed_chats(cutoff, budget):
+    removed, last_id = 0, 0
+    while budget.left:
+        with SessionLocal() as s:
+            ids = s.execute(select(ChatSession.id).where(ChatSession.id > last_id, _closed_chats_filter(cutoff))
+                            .order_by(ChatSession.id).limit(cfg.RETENTION_BATCH_SIZE)).scalars().all()
+        if not ids:
+            break
+        last_id = ids[-1]
+        _move_messages(Message.chat_id.in_(ids), budget, "closed_chat_messages", archive=cfg.RETENTION_ARCHIVE)
+        if not budget.left:
+            break
+        with SessionLocal() as s:
+            # a chat whose messages did not all fit in this run's budget is kept for the next one
+            left = set(s.execute(select(Message.chat_id).where(Message.chat_id.in_(ids)).distinct()).scalars())
+            done = [i for i in ids if i not in left]
+            if done:
+                s.execute(delete(ChatReadMarker).where(ChatReadMarker.chat_id.in_(done)))
+                s.execute(delete(ChatSession).where(ChatSession.id.in_(done)))
+                s.commit()
+        invalidate_chat_cache(chat_ids=done)
+        removed += len(done)
+        RETENTION_ROWS.inc("closed_chats", n=len(done))
+        budget.spend(f"closed chats {removed}")
+    return removed
+
+def plan():
+    """Row counts each policy would touch right now (no writes)."""
+    out = {}
+    with SessionLocal() as s:
+        c = _cutoff(cfg.RETENTION_CLOSED_CHAT_DAYS)
+        if c:
+            out["closed_chats"] = s.execute(select(func.count()).select_from(ChatSession).where(_closed_chats_filter(c))).scalar_one()
+    for key, days in (("old_messages", cfg.RETENTION_MESSAGE_DAYS), ("deleted_messages", cfg.RETENTION_DELETED_MESSAGE_DAYS)):
+        c = _cutoff(days)
+        if c:
+            bound = cutoff_message_id(c)
+            q = select(func.count()).select_from(Message).where(Message.id <= bound, Message.created_at < c)
+            if key == "deleted_messages":
+                q = q.where(Message.deleted == True)
+            with SessionLocal() as s:
+                out[key] = s.execute(q).scalar_one()
+    return out
+
+def run(progress=None, dry_run=False):
+    if dry_run:
+        return {"plan": plan(), "applied": False}
+    budget = _Budget(progress)
+    t0 = time.perf_counter()
+    result = {}
+    c = _cutoff(cfg.RETENTION_DELETED_MESSAGE_DAYS)
+    if c:
+        bound = cutoff_message_id(c)
+        result["deleted_messages"] = _move_messages(and_(Message.id <= bound, Message.created_at < c, Message.deleted == True),
+                                                    budget, "deleted_messages", archive=False)
+    c = _cutoff(cfg.RETENTION_CLOSED_CHAT_DAYS)
+    if c:
+        result["closed_chats"] = purge_closed_chats(c, budget)
+    c = _cutoff(cfg.RETENTION_MESSAGE_DAYS)
+    if c:
+        bound = cutoff_message_id(c)
+        result["old_messages"] = _move_messages(and_(Message.id <= bound, Message.created_at < c), budget, "old_messages")
+    result.update(batches=budget.batches, complete=budget.left, seconds=round(time.perf_counter() - t0, 2))
+    logger.info(f"retention.run {result}")
+    return {"applied": True, "result": result}
+
+if __name__ == "__main__":
+    import sys
+    logging.basicConfig(level=logging.INFO)
+    print(json.dumps(run(dry_run="--dry-run" in sys.argv[1:]), indent=2))
@@ -1,22 +1,91 @@
+"""Scheduled test runs, driven by the ``test_schedules`` table.
+
+Every worker runs the same APScheduler jobs; when a cron fires, the worker
+that first records the (schedule, minute) row in ``schedule_fires`` submits
+the run and the others skip it, so each slot fires exactly once; the
+retention pass (RETENTION_ENABLED) is claimed the same way per interval. Jobs are
+reconciled against the table incrementally, right after CRUD calls on this
+worker and every SCHEDULE_SYNC_SECONDS to pick up changes made on others."""
 from apscheduler.schedulers.background import BackgroundScheduler
+from datetime import datetime, timedelta
 try:
     from zoneinfo import ZoneInfo
 except ImportError:
     from backports.zoneinfo import ZoneInfo
-from .testsuite import run_tests
-from .storage import list_test_schedules
+import logging
+import os
+import socket
+import threading
+from .config import cfg
+from .storage import list_test_schedules, claim_schedule_fire
+
+logger = logging.getLogger(__name__)
+
+sched = BackgroundScheduler(job_defaults={"coalesce": True, "max_instances": 1, "misfire_grace_time": 60})
+HOLDER = f"{socket.gethostname()}:{os.getpid()}"
+_installed = {}
+_lock = threading.Lock()
+
+def _job_id(schedule_id):
+    return f"test:{schedule_id}"
+
+def slot_for(hhmm, tz, now=None):
+    """The cron trigger time a run belongs to: the latest ``hhmm`` in ``tz`` at
+    or before ``now``. Workers that start the job late (up to the misfire
+    grace, possibly past midnight) still agree on it."""
+    now = now or datetime.now(ZoneInfo(tz))
+    hh, mm = map(int, hhmm.split(':'))
+    at = now.replace(hour=hh, minute=mm, second=0, microsecond=0)
+    if at > now:
+        at -= timedelta(days=1)
+    return at.strftime("%Y-%m-%dT%H:%M")
+
+def fire(schedule_id, tz, hhmm):
+    slot = slot_for(hhmm, tz)
+    if not claim_schedule_fire(schedule_id, slot, HOLDER):
+        logger.info(f"schedule.skip id={schedule_id} slot={slot} (claimed by another worker)")
+        return
+    from .jobs import job_runner
+    job, _ = job_runner.submit("test", {"schedule_id": schedule_id, "slot": slot, "notify": True})
+    logger.info(f"schedule.fired id={schedule_id} slot={slot} job={job['id']}")
+
+# schedule_fires key for the retention interval job (test schedules use their row id)
+RETENTION_LOCK_ID = -1
 
-sched = BackgroundScheduler()
+def retention_tick():
+    slot = str(int(datetime.utcnow().timestamp()) // max(cfg.RETENTION_INTERVAL, 1))
+    if not claim_schedule_fire(RETENTION_LOCK_ID, slot, HOLDER):
+        return
+    from .jobs import job_runner
+    job_runner.submit("retention", {})
 
 def refresh_jobs():
-    sched.remove_all_jobs()
-    for r in list_test_schedules():
-        if not r.enabled:
-            continue
-        hh, mm = map(int, r.time_hhmm.split(':'))
-        sched.add_job(run_tests, 'cron', hour=hh, minute=mm, timezone=ZoneInfo(r.tz), id=f"test@{r.time_hhmm}")
+    """Add, reschedule or remove only the jobs whose schedule row changed."""
+    with _lock:
+        want = {}
+        for r in list_test_schedules():
+            if r.enabled:
+                want[_job_id(r.id)] = (r.id, r.time_hhmm, r.tz)
+        for job_id in set(_installed) - set(want):
+            try:
+                sched.remove_job(job_id)
+            except Exception:
+                pass
+            del _installed[job_id]
+        for job_id, spec in want.items():
+            if _installed.get(job_id) == spec:
+                continue
+            rid, hhmm, tz = spec
+            hh, mm = map(int, hhmm.split(':'))
+            sched.add_job(fire, 'cron', args=(rid, tz, hhmm), hour=hh, minute=mm, timezone=ZoneInfo(tz),
+                          id=job_id, replace_existing=True)
+            _installed[job_id] = spec
+        return sorted(hhmm for _, hhmm, _ in want.values())
 
 def start_scheduler():
     if not sched.running:
         sched.start()
+        sched.add_job(refresh_jobs, 'interval', seconds=cfg.SCHEDULE_SYNC_SECONDS, id="schedule:sync", replace_existing=True)
+        if cfg.RETENTION_ENABLED:
+            sched.add_job(retention_tick, 'interval', seconds=cfg.RETENTION_INTERVAL, id="retention", replace_existing=True)
     refresh_jobs()
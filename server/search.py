@@ -0,0 +1,154 @@
+"""Full-text search over text messages for the admin panel.
+
+SQLite keeps an external-content FTS5 table ``messages_fts`` (rowid = message
+id) and PostgreSQL a ``search_tsv`` tsvector column with a GIN index. Both are
+maintained by triggers on ``messages``, so every insert path (``add_message``,
+the group-commit writer, the Telegram webhook) and retention deletes keep the
+index current without code changes. ``install`` creates them and indexes
+existing rows in id batches; it runs as a migration step.
+
+Queries are split into words and every word must match as a prefix; hits come
+back best-ranked first with the chat cid and the message id as a cursor into
+the chat history. Scoring every match of a common word costs a full pass over
+its postings, so only the newest SEARCH_RANK_WINDOW visible matches (deleted
+messages and, by default, closed chats are filtered before the window) are
+ranked: rare terms get exact ranking in a millisecond or two, broad ones stay
+bounded."""
+import logging
+import re
+from sqlalchemy import text, DateTime
+from .config import cfg
+from .utils import offloaded
+
+logger = logging.getLogger(__name__)
+
+MAX_RESULTS = 50
+MAX_TERMS = 8
+BACKFILL_BATCH = 5000
+
+_SQLITE_TRIGGERS = (
+    """CREATE TRIGGER IF NOT EXISTS messages_fts_ai AFTER INSERT ON messages WHEN new.type = 'text' AND new.text IS NOT NULL BEGIN
+         INSERT INTO messages_fts(rowid, text) VALUES (new.id, new.text);
+       END""",
+    """CREATE TRIGGER IF NOT EXISTS messages_fts_ad AFTER DELETE ON messages WHEN old.type = 'text' AND old.text IS NOT NULL BEGIN
+         INSERT INTO messages_fts(messages_fts, rowid, text) VALUES ('delete', old.id, old.text);
+       END""",
+    """CREATE TRIGGER IF NOT EXISTS messages_fts_au AFTER UPDATE OF text, type ON messages BEGIN
+         INSERT INTO messages_fts(messages_fts, rowid, text) SELECT 'delete', old.id, old.text WHERE old.type = 'text' AND old.text IS NOT NULL;
+         INSERT INTO messages_fts(rowid, text) SELECT new.id, new.text WHERE new.type = 'text' AND new.text IS NOT NULL;
+       END""",
+)
+
+def _install_sqlite(engine):
+    with engine.begin() as c:
+        c.exec_driver_sql("CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts USING fts5("
+                          "text, content='messages', content_rowid='id', tokenize='unicode61 remove_diacritics 2')")
+        if c.exec_driver_sql("SELECT count(*) FROM sqlite_master WHERE name = 'messages_fts_ai'").scalar():
+            return
+        # the trigger DDL takes the write lock, so nothing lands between it and
+        # reading the bound: rows above it come from the trigger, the rest below
+        for ddl in _SQLITE_TRIGGERS:
+            c.exec_driver_sql(ddl)
+        bound = c.exec_driver_sql("SELECT coalesce(max(id), 0) FROM messages").scalar()
+    lo = 0
+    while lo < bound:
+        hi = min(lo + BACKFILL_BATCH, bound)
+        with engine.begin() as c:
+            c.execute(text("INSERT INTO messages_fts(rowid, text) SELECT id, text FROM messages "
+                           "WHERE id > :lo AND id <= :hi AND type = 'text' AND text IS NOT NULL"), {"lo": lo, "hi": hi})
+        lo = hi
+    logger.info(f"search: indexed messages up to id {bound}")
+
+def _language():
+    # interpolated into SQL as a regconfig literal
+    if not re.fullmatch(r"[a-z_]+", cfg.SEARCH_LANGUAGE):
+        raise ValueError(f"bad SEARCH_LANGUAGE {cfg.SEARCH_LANGUAGE!r}")
+    return cfg.SEARCH_LANGUAGE
+
+def _install_postgresql(engine):
+    lang = _language()
+    with engine.begin() as c:
+        c.exec_driver_sql("ALTER TABLE messages ADD COLUMN IF NOT EXISTS search_tsv tsvector")
+        c.exec_driver_sql(f"""CREATE OR REPLACE FUNCTION messages_search_tsv() RETURNS trigger AS $$
+            BEGIN
+              NEW.search_tsv := CASE WHEN NEW.type <> 'text' OR NEW.text IS NULL THEN NULL ELSE to_tsvector('{lang}'::regconfig, NEW.text) END;
+              RETURN NEW;
+            END $$ LANGUAGE plpgsql""")
+        c.exec_driver_sql("DROP TRIGGER IF EXISTS messages_search_tsv ON messages")
+        c.exec_driver_sql("CREATE TRIGGER messages_search_tsv BEFORE INSERT OR UPDATE OF text, type ON messages "
+                          "FOR EACH ROW EXECUTE FUNCTION messages_search_tsv()")
+        bound = c.exec_driver_sql("SELECT coalesce(max(id), 0) FROM messages").scalar()
+    lo = 0
+    while lo < bound:
+        hi = min(lo + BACKFILL_BATCH, bound)
+        with engine.begin() as c:
+            c.execute(text(f"UPDATE messages SET search_tsv = to_tsvector('{lang}'::regconfig, text) "
+                           "WHERE id > :lo AND id <= :hi AND type = 'text' AND text IS NOT NULL AND search_tsv IS NULL"), {"lo": lo, "hi": hi})
+        lo = hi
+    with engine.connect().execution_options(isolation_level="AUTOCOMMIT") as c:
+        c.exec_driver_sql("CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_messages_search_tsv ON messages USING GIN (search_tsv)")
+    logger.info(f"search: indexed messages up to id {bound}")
+
+def install(engine):
+    if engine.dialect.name == "sqlite":
+        _install_sqlite(engine)
+    elif engine.dialect.name == "postgresql":
+        _install_postgresql(engine)
+
+def terms(q):
+    """Words of ``q``; punctuation and query operators are dropped."""
+    return re.findall(r"\w+", q or "", re.UNICODE)[:MAX_TERMS]
+
+def _sqlite_query(words):
+    return " ".join(f'"{w}"*' for w in words)
+
+def _pg_query(words):
+    return " & ".join(f"{w}:*" for w in words)
+
+@offloaded
+def search_messages(q, limit=20, offset=0, include_closed=False):
+    """Ranked hits for ``q``: ``(message_id, chat_id, cid, customer_name,
+    role, created_at, snippet, rank)``; lower rank is better on SQLite
+    (bm25), higher on PostgreSQL (ts_rank), and rows are already ordered."""
+    from .storage import engine
+    words = terms(q)
+    if not words:
+        return []
+    limit = max(1, min(int(limit), MAX_RESULTS))
+    offset = max(0, int(offset))
+    active = "" if include_closed else " AND c.active = true"
+    dialect = engine.dialect.name
+    window = max(cfg.SEARCH_RANK_WINDOW, offset + limit)
+    if dialect == "sqlite":
+        # filter inside the window, so closed chats and deleted rows cannot use it up
+        sql = ("SELECT w.id, w.chat_id, w.cid, w.customer_name, w.role, w.created_at AS created_at, w.snippet, w.rank FROM ("
+               "SELECT m.id, m.chat_id, c.cid, c.customer_name, m.role, m.created_at, "
+               "bm25(messages_fts) AS rank, snippet(messages_fts, 0, '«', '»', '…', 12) AS snippet "
+               "FROM messages_fts JOIN messages m ON m.id = messages_fts.rowid JOIN chat_sessions c ON c.id = m.chat_id "
+               f"WHERE messages_fts MATCH :q AND m.deleted = false{active} ORDER BY messages_fts.rowid DESC LIMIT :window) w "
+               "ORDER BY w.rank, w.id DESC LIMIT :limit OFFSET :offset")
+        params = {"q": _sqlite_query(words), "window": window}
+    elif dialect == "postgresql":
+        lang = _language()
+        tsq = f"to_tsquery('{lang}'::regconfig, :q)"
+        # headlines are costly, so only the page that survives LIMIT gets one
+        sql = ("SELECT h.id, h.chat_id, h.cid, h.customer_name, h.role, h.created_at, "
+               f"ts_headline('{lang}'::regconfig, h.text, {tsq}, "
+               "'StartSel=«, StopSel=», MaxFragments=1, MaxWords=24, MinWords=8'), h.rank FROM ("
+               f"SELECT w.*, ts_rank(w.search_tsv, {tsq}) AS rank FROM ("
+               "SELECT m.id, m.chat_id, c.cid, c.customer_name, m.role, m.created_at, m.text, m.search_tsv "
+               "FROM messages m JOIN chat_sessions c ON c.id = m.chat_id "
+               f"WHERE m.search_tsv @@ {tsq} AND m.deleted = false{active} ORDER BY m.id DESC LIMIT :window) w "
+               "ORDER BY rank DESC, w.id DESC LIMIT :limit OFFSET :offset) h ORDER BY h.rank DESC, h.id DESC")
+        params = {"q": _pg_query(words), "window": window}
+    else:
+        where = " AND ".join(f"lower(m.text) LIKE :w{i} ESCAPE '\\'" for i in range(len(words)))
+        sql = ("SELECT m.id, m.chat_id, c.cid, c.customer_name, m.role, m.created_at AS created_at, substr(m.text, 1, 160), 0 "
+               "FROM messages m JOIN chat_sessions c ON c.id = m.chat_id "
+               f"WHERE m.type = 'text' AND m.deleted = false{active} AND {where} "
+               "ORDER BY m.id DESC LIMIT :limit OFFSET :offset")
+        from .storage import _like_escape
+        params = {f"w{i}": f"%{_like_escape(w.lower())}%" for i, w in enumerate(words)}
+    params.update(limit=limit, offset=offset)
+    with engine.connect() as c:
+        return [tuple(r) for r in c.execute(text(sql).columns(created_at=DateTime), params)]
@@ -1,9 +1,18 @@
+from flask import request, session
 from flask_socketio import Namespace, emit, join_room, leave_room
-from .storage import get_or_create_chat, add_message, get_room_key
+from .storage import get_or_create_chat, ensure_chat, submit_message, get_room_key
 from .telegram_bot import send_text_for_room, notify_telegram
 from .config import cfg
+from .media import store_data_url, uploads, MediaError
+from .state import shared
+from .throttle import throttle
+from .calls import clean_sdp, clean_candidate, PayloadError, mark, measure, forget, candidate_batcher, CALLS, RTC_CANDIDATES
+from .metrics import SOCKET_HANDLER_SECONDS, SOCKET_CONNECTIONS, MESSAGES, JOINS, REJECTIONS
 from bleach import clean
+from datetime import datetime
 import logging
+import threading
+import time
 
 logger = logging.getLogger(__name__)
 
@@ -15,18 +24,122 @@ def validate_and_sanitize(text, max_length=500):
         raise ValueError(f"Text length must be 1-{max_length}")
     return clean(text, tags=[], strip=True)
 
-ROOM_STATE = {}
+class EventNamespace(Namespace):
+    """Routes ``a:b`` events to ``on_a_b`` methods; the stock Namespace only
+    looks up ``on_`` + event, which cannot match names containing a colon.
+    Events over their token-bucket limit are refused before dispatch."""
 
-class ChatNS(Namespace):
+    def _throttled(self, event, sid, data):
+        # runs before dispatch, i.e. outside the request context
+        room = None
+        if throttle.room_rule(event) and isinstance(data, dict):
+            # the room the event targets, joined or not: handlers like send fan
+            # out to any chat_id, so membership cannot gate the bucket
+            r = data.get('room') or data.get('chat_id')
+            if isinstance(r, str) and r:
+                room = r[:200]
+        limited = throttle.check(self.namespace, event, sid, room)
+        if limited is None:
+            return None
+        scope, wait = limited
+        REJECTIONS.inc('rate_limited')
+        err = {'code': 'rate_limited', 'event': event, 'scope': scope, 'retry_after': round(wait, 2)}
+        if throttle.should_notify(sid):
+            self.socketio.emit('error', err, to=sid, namespace=self.namespace)
+        return dict(err, ok=False, error='rate_limited')
+
+    def trigger_event(self, event, *args):
+        name = (event or '').replace(':', '_')
+        if name not in ('connect', 'disconnect') and args:
+            refused = self._throttled(event, args[0], args[1] if len(args) > 1 else None)
+            if refused is not None:
+                return refused
+        # label by handler name only for events we handle, so clients cannot mint series
+        label = event if hasattr(self, 'on_' + name) else 'unknown'
+        t0 = time.perf_counter()
+        try:
+            ret = super().trigger_event(name, *args)
+        finally:
+            SOCKET_HANDLER_SECONDS.observe(time.perf_counter() - t0, self.namespace, label)
+        if name == 'connect' and ret is not False:
+            SOCKET_CONNECTIONS.inc(self.namespace)
+        elif name == 'disconnect':
+            SOCKET_CONNECTIONS.dec(self.namespace)
+        return ret
+
+class AdminFeed:
+    """Buffers admin inbox events and pushes them to /admin subscribers every
+    ADMIN_PUSH_MS. A burst of messages in one chat goes out as a single
+    ``chat:message`` carrying the count and the latest message.
+
+    Subscribers are Socket.IO rooms rather than a dict in this process:
+    ``feed:<event>`` for everything, ``feed:<event>:<cid>`` once narrowed. The
+    emit goes through the message queue, so an event published on one worker
+    reaches admins connected to any other."""
+
+    EVENTS = ('chat:created', 'chat:message', 'chat:closed')
+
+    def __init__(self):
+        self.sio = None
+        self.namespace = None
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._task = None
+
+    def bind(self, sio, namespace):
+        self.sio = sio
+        self.namespace = namespace
+
+    def subscribe(self, sid, events=None, cids=None):
+        events = set(events or self.EVENTS) & set(self.EVENTS)
+        server = self.sio.server
+        for room in server.rooms(sid, namespace=self.namespace):
+            if room.startswith('feed:'):
+                server.leave_room(sid, room, namespace=self.namespace)
+        for event in events:
+            for room in [f'feed:{event}:{c}' for c in cids if isinstance(c, str)] if cids else [f'feed:{event}']:
+                server.enter_room(sid, room, namespace=self.namespace)
+        return sorted(events)
+
+    def publish(self, event, payload):
+        key = (event, payload['cid'])
+        with self._lock:
+            if event == 'chat:message':
+                prev = self._pending.get(key)
+                payload = dict(payload, count=(prev['count'] if prev else 0) + 1)
+            self._pending[key] = payload
+            if self._task is None and self.sio is not None:
+                self._task = self.sio.start_background_task(self._loop)
+
+    def flush(self):
+        with self._lock:
+            if not self._pending:
+                return
+            batch = list(self._pending.items())
+            self._pending.clear()
+        for (event, cid), payload in batch:
+            self.sio.emit(event, payload, to=[f'feed:{event}', f'feed:{event}:{cid}'], namespace=self.namespace)
+
+    def _loop(self):
+        while True:
+            self.sio.sleep(cfg.ADMIN_PUSH_MS / 1000.0)
+            try:
+                self.flush()
+            except Exception as e:
+                logger.error(f"admin feed flush error: {e}")
+
+admin_feed = AdminFeed()
+
+class ChatNS(EventNamespace):
     def __init__(self, ns, sio):
         super().__init__(ns)
         self.sio = sio
 
     def on_connect(self):
-        logger.info(f"Client connected to chat namespace: {self.sid}")
+        logger.info(f"Client connected to chat namespace: {request.sid}")
     
-    def on_disconnect(self):
-        logger.info(f'ChatNS disconnect: {self.sid}')
+    def on_disconnect(self, reason=None):
+        logger.info(f'ChatNS disconnect: {request.sid}')
 
     def on_join(self, data):
         try:
@@ -37,7 +150,10 @@ class ChatNS(Namespace):
                 return
             name = validate_and_sanitize(name, max_length=50)
             join_room(chat_id)
-            get_or_create_chat(chat_id, name)
+            JOINS.inc('/chat')
+            db_chat_id, created = ensure_chat(chat_id, name)
+            if created:
+                admin_feed.publish('chat:created', {'id': db_chat_id, 'cid': chat_id, 'name': name, 'created': datetime.utcnow().isoformat()})
             logger.info(f"User {name} joined chat {chat_id}")
             send_text_for_room(chat_id, f"✅ {name} chat'e girdi")
             notify_telegram(chat_id, 'text', f"👋 {name} joined chat {chat_id}", None, name)
@@ -69,17 +185,15 @@ class ChatNS(Namespace):
                 emit('error', {'msg': 'Invalid type'})
                 return
             
+            media_url = None
             if type_ == 'text':
                 text = validate_and_sanitize(text, max_length=500)
+            else:
+                media_url = store_data_url(text)
+                text = None
             
             name = validate_and_sanitize(name, max_length=50)
-            db_chat_id = get_or_create_chat(chat_id)
-            add_message(db_chat_id, role, type_, text)
-            logger.info(f"Message sent in {chat_id}: {role} - {type_}")
-            emit('chat:message', {'chat_id': chat_id, 'role': role, 'type': type_, 'text': text, 'name': name}, to=chat_id, include_self=False)
-            
-            if role == 'user':
-                notify_telegram(chat_id, type_, text, text if type_ in ['image', 'audio'] else None, name)
+            self._deliver(chat_id, role, type_, text, media_url, name)
         except ValueError as e:
             logger.warning(f"Send validation error: {e}")
             emit('error', {'msg': str(e)})
@@ -87,10 +201,107 @@ class ChatNS(Namespace):
             logger.error(f"Send error: {e}")
             emit('error', {'msg': 'Server error'})
 
-class CallNS(Namespace):
+    def _deliver(self, chat_id, role, type_, text, media_url, name):
+        db_chat_id = get_or_create_chat(chat_id)
+        sid = request.sid
+        fut = submit_message(db_chat_id, role, type_, text, media_url)
+        # fan out only once the row is durable; with group commit that is when its batch lands
+        fut.add_done_callback(lambda f: self._delivered(f, sid, db_chat_id, chat_id, role, type_, text, media_url, name))
+
+    def _delivered(self, fut, sid, db_chat_id, chat_id, role, type_, text, media_url, name):
+        # may run on the writer thread: no request context, so explicit sid/namespace
+        try:
+            if fut.exception() is not None:
+                logger.error(f"Message not saved in {chat_id}: {fut.exception()}")
+                self.socketio.emit('error', {'code': 'not_saved', 'msg': 'Message could not be saved'}, to=sid, namespace=self.namespace)
+                return
+            MESSAGES.inc(role, type_)
+            logger.info(f"Message sent in {chat_id}: {role} - {type_}")
+            self.socketio.emit('chat:message', {'chat_id': chat_id, 'role': role, 'type': type_, 'text': text or media_url, 'media': media_url, 'name': name},
+                               to=chat_id, skip_sid=sid, namespace=self.namespace)
+            admin_feed.publish('chat:message', {'id': db_chat_id, 'cid': chat_id, 'name': name,
+                                                'last': {'role': role, 'type': type_, 'text': text[:120] if text else None, 'time': datetime.utcnow().isoformat()}})
+            if role == 'user':
+                notify_telegram(chat_id, type_, text, media_url, name)
+        except Exception as e:
+            logger.error(f"Deliver error: {e}")
+
+    # Chunked media upload: upload:start -> upload:chunk* -> upload:finish.
+    # Every handler answers through the ack with the offset the server holds,
+    # so a client that reconnects can call upload:start with its upload_id and resume.
+    def on_upload_start(self, data):
+        try:
+            chat_id = data.get('chat_id')
+            type_ = data.get('type')
+            if not chat_id or (type_ not in ['image', 'audio'] and not data.get('upload_id')):
+                return {'ok': False, 'error': 'Missing fields'}
+            u = uploads.start(chat_id, type_, data.get('mime'), data.get('size'), data.get('upload_id'), sid=request.sid)
+            return {'ok': True, 'upload_id': u.id, 'offset': u.offset, 'chunk_size': cfg.UPLOAD_CHUNK_BYTES}
+        except MediaError as e:
+            logger.warning(f"Upload start rejected: {e}")
+            return {'ok': False, 'error': str(e)}
+
+    def on_upload_chunk(self, data):
+        try:
+            u = uploads.chunk(data.get('upload_id'), data.get('chat_id'), data.get('offset'), data.get('data'))
+            return {'ok': True, 'offset': u.offset}
+        except MediaError as e:
+            logger.warning(f"Upload chunk rejected: {e}")
+            return {'ok': False, 'error': str(e)}
+
+    def on_upload_finish(self, data):
+        try:
+            chat_id = data.get('chat_id')
+            role = data.get('role', 'user')
+            if role not in ['user', 'admin']:
+                return {'ok': False, 'error': 'Invalid role'}
+            name = validate_and_sanitize(data.get('name', 'Customer'), max_length=50)
+            u, url = uploads.finish(data.get('upload_id'), chat_id)
+            self._deliver(chat_id, role, u.type, None, url, name)
+            return {'ok': True, 'media': url}
+        except ValueError as e:
+            logger.warning(f"Upload finish rejected: {e}")
+            return {'ok': False, 'error': str(e)}
+        except Exception as e:
+            logger.error(f"Upload finish error: {e}")
+            return {'ok': False, 'error': 'Server error'}
+
+    def on_upload_abort(self, data):
+        try:
+            uploads.abort(data.get('upload_id'), data.get('chat_id'))
+        except MediaError:
+            pass
+        return {'ok': True}
+
+class AdminNS(EventNamespace):
+    """Push-based admin inbox. Only sessions that passed OTP may connect;
+    they receive every event until they narrow it with ``subscribe``."""
+
     def __init__(self, ns, sio):
         super().__init__(ns)
         self.sio = sio
+        admin_feed.bind(sio, ns)
+
+    def on_connect(self, auth=None):
+        if not session.get('admin'):
+            logger.warning(f"admin.rejected sid={request.sid}")
+            return False
+        admin_feed.subscribe(request.sid)
+        logger.info(f"Admin connected: {request.sid}")
+
+    def on_subscribe(self, data):
+        data = data or {}
+        cids = data.get('cids')
+        if cids is not None and (not isinstance(cids, list) or len(cids) > 1000):
+            return {'ok': False, 'error': 'Invalid cids'}
+        events = admin_feed.subscribe(request.sid, data.get('events'), cids)
+        return {'ok': True, 'events': events}
+
+class CallNS(EventNamespace):
+    def __init__(self, ns, sio):
+        super().__init__(ns)
+        self.sio = sio
+        candidate_batcher.bind(sio, ns)
 
     def on_join(self, data):
         if not cfg.ENABLE_CALLS:
@@ -104,71 +315,107 @@ class CallNS(Namespace):
         if cfg.REQUIRE_ROOM_KEY:
             if not room_key or not verify_room_key(room, room_key):
                 logger.warning(f"join.rejected room={room} reason=invalid_key")
+                REJECTIONS.inc('invalid_room_key')
                 emit('error', {'code': 'invalid_room_key'})
                 return
         
-        state = ROOM_STATE.setdefault(room, {'accepted': False, 'members': set()})
-        
-        if len(state['members']) >= cfg.MAX_ROOM_MEMBERS:
+        if not shared.room_join(room, request.sid, cfg.MAX_ROOM_MEMBERS):
             logger.warning(f"join.rejected room={room} reason=room_full")
+            REJECTIONS.inc('room_full')
             emit('error', {'code': 'room_full'})
             return
         
-        state['members'].add(self.sid)
         join_room(room)
-        logger.info(f"call.joined room={room} sid={self.sid}")
+        JOINS.inc('/call')
+        logger.info(f"call.joined room={room} sid={request.sid}")
 
     def on_call_ring(self, data):
         if not cfg.ENABLE_CALLS:
             return
         room = data.get('room') or data['chat_id']
         logger.info(f"call.ring room={room}")
+        mark(room, 'ring')
         emit('call:incoming', {'chat_id': room, 'fromName': data.get('from')}, to=room, include_self=False)
 
     def on_call_accept(self, data):
         if not cfg.ENABLE_CALLS:
             return
         room = data.get('room') or data['chat_id']
-        state = ROOM_STATE.get(room)
-        if state:
-            state['accepted'] = True
+        shared.room_set_accepted(room, True)
+        measure(room, 'ring', 'ring_to_accept', keep=True)
+        CALLS.inc('accepted')
         logger.info(f"call.accepted room={room}")
         emit('call:accepted', {'chat_id': room}, to=room)
 
     def on_call_decline(self, data):
         room = data.get('room') or data['chat_id']
+        measure(room, 'ring', 'ring_to_decline')
+        CALLS.inc('declined')
         logger.info(f"call.declined room={room}")
         emit('call:declined', {'chat_id': room}, to=room)
 
-    def on_rtc_offer(self, data):
+    def _rtc_room(self, data, event):
         if not cfg.ENABLE_CALLS:
+            return None
+        room = data.get('room') or data.get('chat_id')
+        if not room:
+            return None
+        if not shared.room_accepted(room):
+            logger.warning(f"rtc.blocked room={room} event={event}")
+            REJECTIONS.inc('rtc_blocked')
+            return None
+        return room
+
+    def _invalid(self, event, e):
+        REJECTIONS.inc('invalid_payload')
+        emit('error', {'code': 'invalid_payload', 'event': event, 'msg': str(e)})
+
+    def on_rtc_offer(self, data):
+        room = self._rtc_room(data, 'offer')
+        if room is None:
             return
-        room = data.get('room') or data['chat_id']
-        state = ROOM_STATE.get(room)
-        if not state or not state.get('accepted'):
-            logger.warning(f"rtc.blocked room={room} event=offer")
-            return
-        emit('rtc:offer', data, to=room, include_self=False)
+        try:
+            sdp = clean_sdp('offer', data.get('sdp'))
+        except PayloadError as e:
+            return self._invalid('rtc:offer', e)
+        mark(room, 'offer')
+        emit('rtc:offer', {'chat_id': room, 'sdp': sdp}, to=room, include_self=False)
 
     def on_rtc_answer(self, data):
-        if not cfg.ENABLE_CALLS:
+        room = self._rtc_room(data, 'answer')
+        if room is None:
             return
-        room = data.get('room') or data['chat_id']
-        state = ROOM_STATE.get(room)
-        if not state or not state.get('accepted'):
-            logger.warning(f"rtc.blocked room={room} event=answer")
-            return
-        emit('rtc:answer', data, to=room, include_self=False)
+        try:
+            sdp = clean_sdp('answer', data.get('sdp'))
+        except PayloadError as e:
+            return self._invalid('rtc:answer', e)
+        measure(room, 'offer', 'offer_to_answer')
+        emit('rtc:answer', {'chat_id': room, 'sdp': sdp}, to=room, include_self=False)
 
     def on_rtc_candidate(self, data):
         if not cfg.ENABLE_CALLS:
             return
-        room = data.get('room') or data['chat_id']
-        state = ROOM_STATE.get(room)
-        if not state or not state.get('accepted'):
-            logger.warning(f"rtc.blocked room={room} event=candidate")
+        room = data.get('room') or data.get('chat_id')
+        try:
+            candidate = clean_candidate(data.get('candidate'))
+        except PayloadError as e:
+            return self._invalid('rtc:candidate', e)
+        if room and candidate_batcher.enabled:
+            # the accepted-call check runs once per batch, at flush
+            candidate_batcher.add(room, request.sid, candidate)
             return
-        emit('rtc:candidate', data, to=room, include_self=False)
+        room = self._rtc_room(data, 'candidate')
+        if room is None:
+            return
+        RTC_CANDIDATES.inc('single')
+        emit('rtc:candidate', {'chat_id': room, 'candidate': candidate}, to=room, include_self=False)
+
+    def on_call_connected(self, data):
+        """Sent by each peer when its RTCPeerConnection reaches "connected";
+        the first report for a ring closes the time-to-connected sample."""
+        room = data.get('room') or data.get('chat_id')
+        if room and measure(room, 'ring', 'ring_to_connected') is not None:
+            CALLS.inc('connected')
 
     def on_call_end(self, data):
         try:
@@ -177,38 +424,30 @@ class CallNS(Namespace):
                 logger.warning('call:end missing room')
                 return
             
-            if room not in ROOM_STATE:
+            if not shared.room_set_accepted(room, False):
                 logger.warning(f'call:end for non-existent room: {room}')
                 return
             
-            state = ROOM_STATE[room]
-            state['accepted'] = False
-            
+            forget(room)
+            CALLS.inc('ended')
             emit('call:ended', {'chat_id': room}, to=room)
             logger.info(f"call.ended room={room}")
         except Exception as e:
             logger.error(f"on_call_end error: {e}")
 
-    def on_disconnect(self):
-        sid = self.sid
+    def on_disconnect(self, reason=None):
+        sid = request.sid
         logger.info(f'CallNS disconnect: {sid}')
+        candidate_batcher.discard(sid)
         
         try:
-            rooms_to_delete = []
-            
-            for room_id, state in list(ROOM_STATE.items()):
-                if sid in state.get('members', set()):
-                    state['members'].discard(sid)
-                    leave_room(room_id)
-                    logger.debug(f'Removed {sid} from room {room_id}')
-                    
-                    if not state['members']:
-                        rooms_to_delete.append(room_id)
-                        logger.info(f'Room {room_id} is now empty, marking for cleanup')
-            
-            for room_id in rooms_to_delete:
-                del ROOM_STATE[room_id]
-                logger.info(f'Deleted empty room {room_id}')
+            for room_id, remaining in shared.leave_all(sid):
+                leave_room(room_id)
+                # a ring or offer this peer never saw answered stays unanswered
+                forget(room_id)
+                logger.debug(f'Removed {sid} from room {room_id}')
+                if not remaining:
+                    logger.info(f'Deleted empty room {room_id}')
                 
         except Exception as e:
             logger.error(f"disconnect.error: {e}")
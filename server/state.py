@@ -0,0 +1,426 @@
+"""Shared runtime state: call-room membership, accept flags, short-lived
+keys (OTPs), token buckets and broadcasts between workers. ``memory://`` keeps
+everything in this process; a ``redis://`` URL (Redis or any compatible
+server) lets several workers share it."""
+import logging
+import threading
+import time
+from .config import cfg
+from .utils import native_lock
+
+logger = logging.getLogger(__name__)
+
+class Room:
+    __slots__ = ('members', 'accepted', 'touched')
+
+    def __init__(self):
+        self.members = set()
+        self.accepted = False
+        self.touched = time.monotonic()
+
+    def as_dict(self):
+        return {'accepted': self.accepted, 'members': set(self.members)}
+
+class TokenBuckets:
+    """Token buckets in this process. ``take`` refills ``key`` at ``rate``
+    tokens/s up to ``burst`` and spends ``cost``; it returns 0 when the tokens
+    were taken, otherwise the seconds until they would be. Buckets that have
+    refilled completely carry no information and are swept every minute."""
+
+    def __init__(self):
+        self._b = {}
+        self._lock = threading.Lock()
+        self._next_sweep = time.monotonic() + 60
+
+    def take(self, key, rate, burst, cost=1):
+        now = time.monotonic()
+        with self._lock:
+            if now >= self._next_sweep:
+                self._b = {k: v for k, v in self._b.items() if v[2] > now}
+                self._next_sweep = now + 60
+            hit = self._b.get(key)
+            tokens = burst if hit is None else min(burst, hit[0] + (now - hit[1]) * rate)
+            if tokens < cost:
+                return (cost - tokens) / rate
+            tokens -= cost
+            self._b[key] = (tokens, now, now + (burst - tokens) / rate)
+            return 0.0
+
+    def __len__(self):
+        return len(self._b)
+
+class MemoryState:
+    """In-process room registry with a sid -> rooms reverse index, so a
+    disconnect only touches the rooms that socket was in. Rooms idle for
+    longer than ROOM_IDLE_TTL are dropped lazily on join, and expired keys
+    are swept every minute on ``put``."""
+
+    def __init__(self, idle_ttl=None):
+        self.idle_ttl = idle_ttl if idle_ttl is not None else cfg.ROOM_IDLE_TTL
+        self._rooms = {}
+        self._by_sid = {}
+        self._kv = {}
+        self._buckets = TokenBuckets()
+        self._lock = native_lock()
+        self._next_sweep = time.monotonic() + 60
+        self._next_kv_sweep = time.time() + 60
+
+    def room_join(self, room, sid, max_members):
+        with self._lock:
+            now = time.monotonic()
+            if now >= self._next_sweep:
+                self._expire_locked(now)
+            st = self._rooms.get(room)
+            if st is None:
+                st = self._rooms[room] = Room()
+            st.touched = now
+            if sid in st.members:
+                return True
+            if len(st.members) >= max_members:
+                return False
+            st.members.add(sid)
+            self._by_sid.setdefault(sid, set()).add(room)
+            return True
+
+    def _detach(self, room, sid):
+        rooms = self._by_sid.get(sid)
+        if rooms is not None:
+            rooms.discard(room)
+            if not rooms:
+                del self._by_sid[sid]
+
+    def leave_all(self, sid):
+        """Remove ``sid`` from every room it joined; empty rooms are deleted.
+        Returns ``[(room, remaining_members), ...]``."""
+        with self._lock:
+            out = []
+            for room in self._by_sid.pop(sid, ()):
+                st = self._rooms.get(room)
+                if st is None:
+                    continue
+                st.members.discard(sid)
+                if not st.members:
+                    del self._rooms[room]
+                out.append((room, len(st.members)))
+            return out
+
+    def room_exists(self, room):
+        return room in self._rooms
+
+    def room_accepted(self, room):
+        st = self._rooms.get(room)
+        return bool(st and st.accepted)
+
+    def room_set_accepted(self, room, accepted):
+        with self._lock:
+            st = self._rooms.get(room)
+            if st is None:
+                return False
+            st.accepted = accepted
+            st.touched = time.monotonic()
+            return True
+
+    def room_delete(self, room):
+        with self._lock:
+            self._delete_locked(room)
+
+    def _delete_locked(self, room):
+        st = self._rooms.pop(room, None)
+        if st is not None:
+            for sid in st.members:
+                self._detach(room, sid)
+
+    def _expire_locked(self, now):
+        cutoff = now - self.idle_ttl
+        stale = [r for r, st in self._rooms.items() if st.touched < cutoff]
+        for r in stale:
+            self._delete_locked(r)
+        self._next_sweep = now + 60
+        return stale
+
+    def expire_idle(self):
+        with self._lock:
+            return self._expire_locked(time.monotonic())
+
+    def idle_rooms(self):
+        cutoff = time.monotonic() - self.idle_ttl
+        with self._lock:
+            return [r for r, st in self._rooms.items() if st.touched < cutoff]
+
+    def empty_rooms(self):
+        with self._lock:
+            return [r for r, st in self._rooms.items() if not st.members]
+
+    def stats(self):
+        with self._lock:
+            return {'rooms': len(self._rooms), 'sockets': len(self._by_sid),
+                    'accepted': sum(1 for st in self._rooms.values() if st.accepted)}
+
+    def rooms(self, limit=None):
+        with self._lock:
+            items = self._rooms.items() if limit is None else list(self._rooms.items())[:limit]
+            return {r: st.as_dict() for r, st in items}
+
+    def put(self, key, value, ttl):
+        now = time.time()
+        with self._lock:
+            if now >= self._next_kv_sweep:
+                # keys nobody reads again would otherwise stay forever
+                self._kv = {k: v for k, v in self._kv.items() if v[1] >= now}
+                self._next_kv_sweep = now + 60
+            self._kv[key] = (value, now + ttl)
+
+    def get(self, key):
+        hit = self._kv.get(key)
+        if hit is None:
+            return None
+        if hit[1] < time.time():
+            self._kv.pop(key, None)
+            return None
+        return hit[0]
+
+    def pop(self, key):
+        with self._lock:
+            hit = self._kv.pop(key, None)
+        return hit[0] if hit and hit[1] >= time.time() else None
+
+    def bucket_take(self, key, rate, burst, cost=1):
+        return self._buckets.take(key, rate, burst, cost)
+
+    def broadcast(self, channel, message):
+        # one process: the caller has already applied it locally
+        pass
+
+    def listen(self, channel, handler):
+        pass
+
+class RedisState:
+    """Same interface on Redis. Only plain commands, WATCH/MULTI and pub/sub are used, so
+    Redis-compatible stand-ins (Valkey, KeyDB, fakeredis) work too. Rooms are
+    kept in a sorted set scored by last activity; each sid has its own set of
+    rooms, mirroring the in-memory reverse index. Every membership write
+    refreshes the member and sid-set TTLs, and joins sweep idle rooms and
+    sids whose room set has expired at most once a minute per process."""
+
+    def __init__(self, client, prefix="konusma:", idle_ttl=None):
+        self.r = client
+        self.prefix = prefix
+        self.idle_ttl = idle_ttl if idle_ttl is not None else cfg.ROOM_IDLE_TTL
+        self._next_sweep = time.monotonic() + 60
+
+    def _k(self, *parts):
+        return self.prefix + ":".join(parts)
+
+    def _members(self, room):
+        return self._k("room", room, "members")
+
+    def _sid_rooms(self, sid):
+        return self._k("sid", sid, "rooms")
+
+    def _sweep(self):
+        now = time.monotonic()
+        if now < self._next_sweep:
+            return
+        self._next_sweep = now + 60
+        self.expire_idle()
+        sids, batch = self._k("sids"), []
+        for raw in self.r.sscan_iter(sids, count=500):
+            batch.append(raw)
+            if len(batch) >= 500:
+                self._drop_gone_sids(sids, batch)
+                batch = []
+        if batch:
+            self._drop_gone_sids(sids, batch)
+
+    def _drop_gone_sids(self, sids, batch):
+        p = self.r.pipeline()
+        for raw in batch:
+            p.exists(self._sid_rooms(raw.decode()))
+        gone = [raw for raw, alive in zip(batch, p.execute()) if not alive]
+        if gone:
+            self.r.srem(sids, *gone)
+
+    def _touch(self, p, room, sid=None):
+        p.expire(self._members(room), self.idle_ttl)
+        p.zadd(self._k("rooms"), {room: time.time()})
+        if sid is not None:
+            p.expire(self._sid_rooms(sid), self.idle_ttl)
+
+    def room_join(self, room, sid, max_members):
+        from redis.exceptions import WatchError
+        self._sweep()
+        members = self._members(room)
+        with self.r.pipeline() as p:
+            while True:
+                try:
+                    p.watch(members)
+                    if p.sismember(members, sid):
+                        p.multi()
+                        self._touch(p, room, sid)
+                        p.execute()
+                        return True
+                    if p.scard(members) >= max_members:
+                        p.unwatch()
+                        return False
+                    p.multi()
+                    p.sadd(members, sid)
+                    p.sadd(self._sid_rooms(sid), room)
+                    p.sadd(self._k("sids"), sid)
+                    self._touch(p, room, sid)
+                    p.execute()
+                    return True
+                except WatchError:
+                    continue
+
+    def leave_all(self, sid):
+        """Each room is left under WATCH on its members set, so a join racing
+        the leave either lands first (and the room survives) or retries."""
+        from redis.exceptions import WatchError
+        out = []
+        for room in [raw.decode() for raw in self.r.smembers(self._sid_rooms(sid))]:
+            members = self._members(room)
+            with self.r.pipeline() as p:
+                while True:
+                    try:
+                        p.watch(members)
+                        remaining = p.scard(members) - (1 if p.sismember(members, sid) else 0)
+                        p.multi()
+                        p.srem(members, sid)
+                        if not remaining:
+                            p.delete(members, self._k("room", room, "accepted"))
+                            p.zrem(self._k("rooms"), room)
+                        p.execute()
+                        break
+                    except WatchError:
+                        continue
+            out.append((room, remaining))
+        p = self.r.pipeline()
+        p.delete(self._sid_rooms(sid))
+        p.srem(self._k("sids"), sid)
+        p.execute()
+        return out
+
+    def room_exists(self, room):
+        return self.r.zscore(self._k("rooms"), room) is not None
+
+    def room_accepted(self, room):
+        return self.r.get(self._k("room", room, "accepted")) == b"1"
+
+    def room_set_accepted(self, room, accepted):
+        if not self.room_exists(room):
+            return False
+        p = self.r.pipeline()
+        p.set(self._k("room", room, "accepted"), b"1" if accepted else b"0", ex=self.idle_ttl)
+        self._touch(p, room)
+        p.execute()
+        return True
+
+    def room_delete(self, room):
+        sids = self.r.smembers(self._members(room))
+        p = self.r.pipeline()
+        for raw in sids:
+            p.srem(self._sid_rooms(raw.decode()), room)
+        p.delete(self._members(room), self._k("room", room, "accepted"))
+        p.zrem(self._k("rooms"), room)
+        p.execute()
+
+    def idle_rooms(self):
+        cutoff = time.time() - self.idle_ttl
+        return [raw.decode() for raw in self.r.zrangebyscore(self._k("rooms"), "-inf", cutoff)]
+
+    def expire_idle(self):
+        stale = self.idle_rooms()
+        for room in stale:
+            self.room_delete(room)
+        return stale
+
+    def empty_rooms(self):
+        rooms = [raw.decode() for raw in self.r.zrange(self._k("rooms"), 0, -1)]
+        p = self.r.pipeline()
+        for room in rooms:
+            p.scard(self._members(room))
+        return [room for room, n in zip(rooms, p.execute()) if not n]
+
+    def stats(self):
+        return {'rooms': self.r.zcard(self._k("rooms")), 'sockets': self.r.scard(self._k("sids")), 'accepted': None}
+
+    def rooms(self, limit=None):
+        rooms = [raw.decode() for raw in self.r.zrange(self._k("rooms"), 0, -1 if limit is None else limit - 1)]
+        out = {}
+        for room in rooms:
+            out[room] = {
+                'accepted': self.room_accepted(room),
+                'members': {m.decode() for m in self.r.smembers(self._members(room))},
+            }
+        return out
+
+    def put(self, key, value, ttl):
+        self.r.set(self._k("kv", key), value, ex=int(ttl))
+
+    def get(self, key):
+        v = self.r.get(self._k("kv", key))
+        return v.decode() if v is not None else None
+
+    def pop(self, key):
+        p = self.r.pipeline()
+        p.get(self._k("kv", key))
+        p.delete(self._k("kv", key))
+        v = p.execute()[0]
+        return v.decode() if v is not None else None
+
+    def bucket_take(self, key, rate, burst, cost=1):
+        """Same contract as ``TokenBuckets.take``; the bucket is a hash of
+        tokens and last-update time, updated under WATCH and left alone when
+        the request is refused."""
+        from redis.exceptions import WatchError
+        k = self._k("bucket", key)
+        with self.r.pipeline() as p:
+            while True:
+                try:
+                    p.watch(k)
+                    tokens, ts = p.hmget(k, "tokens", "ts")
+                    now = time.time()
+                    tokens = burst if tokens is None else min(burst, float(tokens) + max(0.0, now - float(ts)) * rate)
+                    if tokens < cost:
+                        p.unwatch()
+                        return (cost - tokens) / rate
+                    p.multi()
+                    p.hset(k, mapping={"tokens": tokens - cost, "ts": now})
+                    p.expire(k, int(burst / rate) + 1)
+                    p.execute()
+                    return 0.0
+                except WatchError:
+                    continue
+
+    def broadcast(self, channel, message):
+        self.r.publish(self._k("chan", channel), message)
+
+    def listen(self, channel, handler):
+        """Call ``handler(message)`` for every broadcast on ``channel``, from a
+        daemon thread. Broadcasts sent while the subscription is down are
+        lost, so ``handler(None)`` is called on every (re)subscribe."""
+        def run():
+            while True:
+                try:
+                    ps = self.r.pubsub(ignore_subscribe_messages=True)
+                    ps.subscribe(self._k("chan", channel))
+                    handler(None)
+                    for m in ps.listen():
+                        handler(m["data"].decode())
+                except Exception as e:
+                    logger.warning(f"state.listen {channel} error: {e}")
+                    time.sleep(1)
+        threading.Thread(target=run, name=f"listen-{channel}", daemon=True).start()
+
+def make_state(url):
+    if not url or url.startswith("memory://"):
+        return MemoryState()
+    if url.startswith(("redis://", "rediss://", "unix://")):
+        try:
+            import redis
+        except ImportError:
+            raise RuntimeError("STATE_BACKEND_URL is a redis URL but the 'redis' package is not installed")
+        return RedisState(redis.Redis.from_url(url))
+    raise ValueError(f"Unsupported STATE_BACKEND_URL: {url}")
+
+shared = make_state(cfg.STATE_BACKEND_URL)
@@ -1,10 +1,54 @@
-from sqlalchemy import create_engine, Column, Integer, String, Boolean, DateTime, ForeignKey, Text
+from sqlalchemy import create_engine, event, Column, Integer, String, Boolean, DateTime, ForeignKey, Text, Index, select, func, case, or_
 from sqlalchemy.orm import declarative_base, sessionmaker, relationship
-from datetime import datetime
+from datetime import datetime, timedelta
+from collections import OrderedDict, namedtuple
+from concurrent.futures import Future
+import atexit
+import json
+import logging
+import queue
+import threading
+import time
 from .config import cfg
+from .utils import offload, offloaded, native_lock
+from .state import shared
+from .metrics import instrument_engine
+
+logger = logging.getLogger(__name__)
 
 Base = declarative_base()
-engine = create_engine(cfg.DATABASE_URL, future=True)
+
+def make_engine(url):
+    """Engine tuned from Cfg. SQLite gets WAL, synchronous and busy_timeout
+    PRAGMAs on every new connection so concurrent writers wait instead of
+    failing with "database is locked"; server databases get a sized,
+    pre-pinged, recycled pool."""
+    if url.startswith("postgres://"):
+        # Heroku/Render style URLs; SQLAlchemy only accepts the postgresql scheme
+        url = "postgresql://" + url[len("postgres://"):]
+    kw = dict(future=True, pool_pre_ping=cfg.DB_POOL_PRE_PING, pool_recycle=cfg.DB_POOL_RECYCLE)
+    if url.startswith("sqlite"):
+        memory = url in ("sqlite://", "sqlite:///:memory:")
+        kw["connect_args"] = {"check_same_thread": False, "timeout": cfg.SQLITE_BUSY_TIMEOUT_MS / 1000.0}
+        if not memory:
+            kw.update(pool_size=cfg.DB_POOL_SIZE, max_overflow=cfg.DB_MAX_OVERFLOW, pool_timeout=cfg.DB_POOL_TIMEOUT)
+        eng = create_engine(url, **kw)
+
+        @event.listens_for(eng, "connect")
+        def _sqlite_pragmas(dbapi_conn, _):
+            cur = dbapi_conn.cursor()
+            if cfg.SQLITE_WAL and not memory:
+                cur.execute("PRAGMA journal_mode=WAL")
+            if cfg.SQLITE_SYNCHRONOUS in ("OFF", "NORMAL", "FULL", "EXTRA"):
+                cur.execute(f"PRAGMA synchronous={cfg.SQLITE_SYNCHRONOUS}")
+            cur.execute(f"PRAGMA busy_timeout={int(cfg.SQLITE_BUSY_TIMEOUT_MS)}")
+            cur.close()
+        return eng
+    kw.update(pool_size=cfg.DB_POOL_SIZE, max_overflow=cfg.DB_MAX_OVERFLOW, pool_timeout=cfg.DB_POOL_TIMEOUT)
+    return create_engine(url, **kw)
+
+engine = make_engine(cfg.DATABASE_URL)
+instrument_engine(engine)
 SessionLocal = sessionmaker(bind=engine, expire_on_commit=False)
 
 class ChatSession(Base):
@@ -16,8 +60,11 @@ class ChatSession(Base):
     room_key = Column(String)
     created_at = Column(DateTime, default=datetime.utcnow)
     active = Column(Boolean, default=True)
+    closed_at = Column(DateTime, nullable=True)
     messages = relationship("Message", back_populates="chat")
 
+    __table_args__ = (Index("ix_chat_sessions_active_id", "active", "id"),)
+
 class Message(Base):
     __tablename__ = "messages"
     id = Column(Integer, primary_key=True)
@@ -30,6 +77,18 @@ class Message(Base):
     deleted = Column(Boolean, default=False)
     chat = relationship("ChatSession", back_populates="messages")
 
+    __table_args__ = (
+        Index("ix_messages_chat_id_deleted_id", "chat_id", "deleted", "id"),
+        Index("ix_messages_chat_id_created_at", "chat_id", "created_at"),
+    )
+
+class ChatReadMarker(Base):
+    """Last message id the admin has seen in a chat; drives unread counts."""
+    __tablename__ = "chat_read_markers"
+    chat_id = Column(Integer, ForeignKey("chat_sessions.id"), primary_key=True)
+    last_read_id = Column(Integer, default=0)
+    updated_at = Column(DateTime, default=datetime.utcnow)
+
 class AdminSession(Base):
     __tablename__ = "admin_sessions"
     id = Column(Integer, primary_key=True)
@@ -47,11 +106,156 @@ class TestSchedule(Base):
     def to_dict(self):
         return dict(id=self.id, time_hhmm=self.time_hhmm, enabled=self.enabled, tz=self.tz)
 
+class ScheduleFire(Base):
+    """One row per (schedule, minute slot) that fired. The primary key is the
+    lock: whichever worker inserts it first runs the job, the rest back off."""
+    __tablename__ = "schedule_fires"
+    schedule_id = Column(Integer, primary_key=True)
+    slot = Column(String, primary_key=True)
+    holder = Column(String)
+    fired_at = Column(DateTime, default=datetime.utcnow)
+
+class SchemaMigration(Base):
+    __tablename__ = "schema_migrations"
+    version = Column(Integer, primary_key=True)
+    name = Column(String)
+    applied_at = Column(DateTime, default=datetime.utcnow)
+
+class JobRun(Base):
+    """One background test/repair run; kept as history for trending durations."""
+    __tablename__ = "job_runs"
+    id = Column(String, primary_key=True)
+    kind = Column(String, nullable=False)
+    dedup_key = Column(String, index=True)
+    params = Column(Text)
+    status = Column(String, default="queued")
+    progress = Column(Integer, default=0)
+    note = Column(String, nullable=True)
+    result = Column(Text, nullable=True)
+    error = Column(Text, nullable=True)
+    created_at = Column(DateTime, default=datetime.utcnow)
+    started_at = Column(DateTime, nullable=True)
+    finished_at = Column(DateTime, nullable=True)
+    duration_ms = Column(Integer, nullable=True)
+
+    __table_args__ = (Index("ix_job_runs_kind_created_at", "kind", "created_at"),)
+
+    def to_dict(self, with_result=True):
+        d = dict(id=self.id, kind=self.kind, params=json.loads(self.params or "{}"), status=self.status,
+                 progress=self.progress, note=self.note, error=self.error,
+                 created_at=self.created_at.isoformat() if self.created_at else None,
+                 started_at=self.started_at.isoformat() if self.started_at else None,
+                 finished_at=self.finished_at.isoformat() if self.finished_at else None,
+                 duration_ms=self.duration_ms)
+        if with_result:
+            d["result"] = json.loads(self.result) if self.result else None
+        return d
+
+ChatRef = namedtuple("ChatRef", "id cid room room_key active")
+
+class ChatCache:
+    """Bounded LRU/TTL cache of chat lookups, keyed by cid and by room."""
+
+    def __init__(self, maxsize, ttl):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._lock = native_lock()
+
+    def get(self, kind, key):
+        with self._lock:
+            hit = self._data.get((kind, key))
+            if hit is None:
+                return None
+            ref, expires = hit
+            if expires < time.monotonic():
+                del self._data[(kind, key)]
+                return None
+            self._data.move_to_end((kind, key))
+            return ref
+
+    def put(self, ref):
+        if self.maxsize <= 0:
+            return ref
+        expires = time.monotonic() + self.ttl
+        with self._lock:
+            for k in (("cid", ref.cid), ("room", ref.room)):
+                if k[1] is None:
+                    continue
+                self._data[k] = (ref, expires)
+                self._data.move_to_end(k)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+        return ref
+
+    def invalidate(self, chat_id=None, cid=None):
+        self.invalidate_many(() if chat_id is None else (chat_id,), () if cid is None else (cid,))
+
+    def invalidate_many(self, chat_ids=(), cids=()):
+        chat_ids, cids = set(chat_ids), set(cids)
+        if not chat_ids and not cids:
+            return
+        with self._lock:
+            for k, (ref, _) in list(self._data.items()):
+                if ref.id in chat_ids or ref.cid in cids:
+                    del self._data[k]
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+chat_cache = ChatCache(cfg.CHAT_CACHE_SIZE, cfg.CHAT_CACHE_TTL)
+
+def _ref(chat):
+    return ChatRef(chat.id, chat.cid, chat.room, chat.room_key, chat.active)
+
+def invalidate_chat_cache(chat_ids=(), cids=()):
+    chat_ids, cids = list(chat_ids), list(cids)
+    chat_cache.invalidate_many(chat_ids, cids)
+    if chat_ids or cids:
+        # every worker keeps its own cache; the message queue tells the others
+        shared.broadcast("chat-cache", json.dumps({"ids": chat_ids, "cids": cids}))
+
+def _on_cache_broadcast(message):
+    if message is None:
+        chat_cache.clear()
+        return
+    msg = json.loads(message)
+    chat_cache.invalidate_many(msg.get("ids", ()), msg.get("cids", ()))
+
+_listening = False
+
+def listen_for_cache_invalidations():
+    """Subscribe to other workers' invalidations, once. Runs at startup on the
+    hub: the listener thread must be a green thread there, not one started
+    from the native pool that the offloaded loaders run on."""
+    global _listening
+    if not _listening:
+        _listening = True
+        shared.listen("chat-cache", _on_cache_broadcast)
+
+def _cache_put(chat):
+    return chat_cache.put(_ref(chat))
+
 def init_db():
-    Base.metadata.create_all(engine)
+    from .migrations import migrate
+    migrate(engine)
+    listen_for_cache_invalidations()
 
-def get_or_create_chat(cid, customer_name=None, room=None, room_key=None):
+@offloaded
+def _load_ref(**by):
+    with SessionLocal() as s:
+        c = s.query(ChatSession).filter_by(**by).first()
+        return _cache_put(c) if c else None
+
+def get_chat_ref(cid):
+    ref = chat_cache.get("cid", cid)
+    return ref if ref is not None else _load_ref(cid=cid)
+
+@offloaded
+def _ensure_chat(cid, customer_name, room, room_key):
     from .utils import generate_secret
+    created = False
     with SessionLocal() as s:
         chat = s.query(ChatSession).filter_by(cid=cid).first()
         if not chat:
@@ -63,53 +267,247 @@ def get_or_create_chat(cid, customer_name=None, room=None, room_key=None):
             )
             s.add(chat)
             s.commit()
-            s.refresh(chat)
-        return chat.id
+            created = True
+        _cache_put(chat)
+        return chat.id, created
+
+def ensure_chat(cid, customer_name=None, room=None, room_key=None):
+    """Return ``(chat_id, created)`` for ``cid``, creating the session if needed."""
+    ref = chat_cache.get("cid", cid)
+    if ref is not None:
+        return ref.id, False
+    return _ensure_chat(cid, customer_name, room, room_key)
+
+def get_or_create_chat(cid, customer_name=None, room=None, room_key=None):
+    return ensure_chat(cid, customer_name, room, room_key)[0]
 
+@offloaded
 def get_chat_by_room(room):
     with SessionLocal() as s:
         chat = s.query(ChatSession).filter_by(room=room, active=True).first()
         return chat
 
 def verify_room_key(room, room_key):
-    with SessionLocal() as s:
-        chat = s.query(ChatSession).filter_by(room=room, room_key=room_key, active=True).first()
-        return chat is not None
+    ref = chat_cache.get("room", room)
+    if ref is None:
+        ref = _load_ref(room=room)
+        if ref is None:
+            return False
+    return bool(ref.active) and ref.room_key == room_key
 
 def get_room_key(cid):
-    with SessionLocal() as s:
-        c = s.query(ChatSession).filter_by(cid=cid).first()
-        return c.room_key if c else None
+    ref = get_chat_ref(cid)
+    return ref.room_key if ref else None
 
+@offloaded
 def add_message(chat_id, role, type_, text=None, media_url=None):
     with SessionLocal() as s:
         m = Message(chat_id=chat_id, role=role, type=type_, text=text, media_url=media_url)
         s.add(m)
         s.commit()
-        s.refresh(m)
         return m
 
-def list_chats():
+class MessageWriter:
+    """Group-commit writer: buffers messages and flushes them in one transaction
+    every ``max_delay_ms`` or ``max_batch`` rows. ``submit`` returns a Future
+    that resolves to the stored Message once its batch is committed. A failed
+    batch is retried row by row, so only the offending rows' futures fail."""
+
+    _STOP = object()
+
+    def __init__(self, session_factory, max_batch=200, max_delay_ms=20):
+        self.session_factory = session_factory
+        self.max_batch = max(max_batch, 1)
+        self.max_delay = max_delay_ms / 1000.0
+        self._q = queue.Queue()
+        self._closed = False
+        self._thread = threading.Thread(target=self._run, name="message-writer", daemon=True)
+        self._thread.start()
+
+    def submit(self, chat_id, role, type_, text=None, media_url=None):
+        fut = Future()
+        if self._closed:
+            fut.set_exception(RuntimeError("message writer is closed"))
+            return fut
+        m = Message(chat_id=chat_id, role=role, type=type_, text=text, media_url=media_url, created_at=datetime.utcnow())
+        self._q.put((m, fut))
+        return fut
+
+    def close(self, timeout=10):
+        if self._closed:
+            return
+        self._closed = True
+        self._q.put(self._STOP)
+        self._thread.join(timeout)
+
+    def _run(self):
+        stop = False
+        while not stop:
+            item = self._q.get()
+            if item is self._STOP:
+                break
+            batch = [item]
+            deadline = time.monotonic() + self.max_delay
+            while len(batch) < self.max_batch:
+                remaining = deadline - time.monotonic()
+                try:
+                    item = self._q.get(timeout=remaining) if remaining > 0 else self._q.get_nowait()
+                except queue.Empty:
+                    break
+                if item is self._STOP:
+                    stop = True
+                    break
+                batch.append(item)
+            self._flush(batch)
+        # drain whatever was submitted before close()
+        rest = []
+        while True:
+            try:
+                item = self._q.get_nowait()
+            except queue.Empty:
+                break
+            if item is not self._STOP:
+                rest.append(item)
+        if rest:
+            self._flush(rest)
+
+    def _commit(self, messages):
+        with self.session_factory() as s:
+            s.add_all(messages)
+            s.commit()
+
+    def _flush(self, batch):
+        try:
+            offload(self._commit, [m for m, _ in batch])
+        except Exception as e:
+            if len(batch) > 1:
+                # one bad row must not fail its neighbours: retry them one by one
+                logger.warning(f"message writer batch failed ({len(batch)} rows), retrying row by row: {e}")
+                for item in batch:
+                    self._flush([item])
+                return
+            logger.error(f"message writer flush failed: {e}")
+            batch[0][1].set_exception(e)
+            return
+        for m, fut in batch:
+            fut.set_result(m)
+
+_writer = None
+_writer_lock = threading.Lock()
+
+def get_message_writer():
+    global _writer
+    with _writer_lock:
+        if _writer is None:
+            _writer = MessageWriter(SessionLocal, cfg.MESSAGE_BATCH_SIZE, cfg.MESSAGE_BATCH_MS)
+            atexit.register(_writer.close)
+        return _writer
+
+def submit_message(chat_id, role, type_, text=None, media_url=None):
+    """Store a message, returning a Future for the durable write. Uses the
+    group-commit writer when MESSAGE_GROUP_COMMIT is on."""
+    if cfg.MESSAGE_GROUP_COMMIT:
+        return get_message_writer().submit(chat_id, role, type_, text, media_url)
+    fut = Future()
+    fut.set_result(add_message(chat_id, role, type_, text, media_url))
+    return fut
+
+def close_message_writer():
+    if _writer is not None:
+        _writer.close()
+
+MAX_PAGE = 200
+
+def _like_escape(term):
+    return term.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+
+@offloaded
+def list_chats(before_id=None, search=None, limit=50):
+    """One page of active chats, newest first, keyset-paginated on id.
+
+    Each row carries the last message preview and the number of user messages
+    after the admin's read marker, all computed in a single statement.
+    Returns ``(rows, next_cursor)``."""
+    limit = max(1, min(int(limit), MAX_PAGE))
+    last_id = (select(func.max(Message.id))
+               .where(Message.chat_id == ChatSession.id, Message.deleted == False)
+               .correlate(ChatSession).scalar_subquery())
+    unread = (select(func.count(Message.id))
+              .where(Message.chat_id == ChatSession.id, Message.deleted == False, Message.role == "user",
+                     Message.id > func.coalesce(ChatReadMarker.last_read_id, 0))
+              .correlate(ChatSession, ChatReadMarker).scalar_subquery())
+    preview = case((Message.type == "text", func.substr(Message.text, 1, 120)), else_=None)
     with SessionLocal() as s:
-        return [(c.id, c.cid, c.customer_name, c.created_at) for c in s.query(ChatSession).filter_by(active=True).order_by(ChatSession.created_at.desc()).all()]
+        q = (s.query(ChatSession.id, ChatSession.cid, ChatSession.customer_name, ChatSession.created_at,
+                     unread, Message.role, Message.type, preview, Message.created_at)
+             .outerjoin(ChatReadMarker, ChatReadMarker.chat_id == ChatSession.id)
+             .outerjoin(Message, Message.id == last_id)
+             .filter(ChatSession.active == True))
+        if before_id is not None:
+            q = q.filter(ChatSession.id < before_id)
+        if search:
+            pat = f"%{_like_escape(search)}%"
+            q = q.filter(or_(ChatSession.customer_name.ilike(pat, escape="\\"), ChatSession.cid.ilike(pat, escape="\\")))
+        rows = q.order_by(ChatSession.id.desc()).limit(limit + 1).all()
+    next_cursor = rows[limit - 1][0] if len(rows) > limit else None
+    return [tuple(r) for r in rows[:limit]], next_cursor
 
-def get_messages(chat_id):
+@offloaded
+def mark_chat_read(chat_id):
     with SessionLocal() as s:
-        rows = s.query(Message).filter_by(chat_id=chat_id, deleted=False).order_by(Message.created_at.desc()).limit(100).all()
-        rows.reverse()
-        return [(m.role, m.type, m.text, m.media_url, m.created_at) for m in rows]
+        last = s.query(func.max(Message.id)).filter_by(chat_id=chat_id).scalar() or 0
+        marker = s.get(ChatReadMarker, chat_id)
+        if marker is None:
+            marker = ChatReadMarker(chat_id=chat_id)
+            s.add(marker)
+        marker.last_read_id = max(marker.last_read_id or 0, last)
+        marker.updated_at = datetime.utcnow()
+        s.commit()
+        return marker.last_read_id
+
+@offloaded
+def get_messages(chat_id, before_id=None, after_id=None, since=None, limit=100):
+    """Page through a chat's history by message id.
 
+    Default and ``before_id`` return the newest ``limit`` rows older than the
+    cursor; ``after_id``/``since`` return the oldest rows newer than it, for
+    incremental sync. Rows are always in chronological order. Returns
+    ``(rows, has_more)``."""
+    limit = max(1, min(int(limit), MAX_PAGE))
+    with SessionLocal() as s:
+        q = s.query(Message).filter_by(chat_id=chat_id, deleted=False)
+        forward = after_id is not None or since is not None
+        if after_id is not None:
+            q = q.filter(Message.id > after_id)
+        if since is not None:
+            q = q.filter(Message.created_at > since)
+        if before_id is not None:
+            q = q.filter(Message.id < before_id)
+        q = q.order_by(Message.id.asc() if forward else Message.id.desc())
+        rows = q.limit(limit + 1).all()
+        has_more = len(rows) > limit
+        rows = rows[:limit]
+        if not forward:
+            rows.reverse()
+        return [(m.id, m.role, m.type, m.text, m.media_url, m.created_at) for m in rows], has_more
+
+@offloaded
 def delete_chat(chat_id):
     with SessionLocal() as s:
         chat = s.get(ChatSession, chat_id)
         if chat:
             chat.active = False
+            chat.closed_at = datetime.utcnow()
             s.commit()
+    invalidate_chat_cache(chat_ids=[chat_id])
+    return chat.cid if chat else None
 
+@offloaded
 def list_test_schedules():
     with SessionLocal() as s:
         return s.query(TestSchedule).order_by(TestSchedule.time_hhmm).all()
 
+@offloaded
 def add_test_schedule(time_hhmm, enabled=True, tz=None):
     with SessionLocal() as s:
         row = TestSchedule(time_hhmm=time_hhmm, enabled=enabled, tz=tz or cfg.TZ)
@@ -118,6 +516,7 @@ def add_test_schedule(time_hhmm, enabled=True, tz=None):
         s.refresh(row)
         return row
 
+@offloaded
 def update_test_schedule(rid, time_hhmm=None, enabled=None, tz=None):
     with SessionLocal() as s:
         row = s.get(TestSchedule, rid)
@@ -134,9 +533,26 @@ def update_test_schedule(rid, time_hhmm=None, enabled=None, tz=None):
         s.refresh(row)
         return row
 
+@offloaded
 def delete_test_schedule(rid):
     with SessionLocal() as s:
         row = s.get(TestSchedule, rid)
         if row:
             s.delete(row)
             s.commit()
+        return row
+
+@offloaded
+def claim_schedule_fire(schedule_id, slot, holder, keep_days=7):
+    """True if this caller won the right to run ``schedule_id`` for ``slot``."""
+    from sqlalchemy.exc import IntegrityError
+    with SessionLocal() as s:
+        s.add(ScheduleFire(schedule_id=schedule_id, slot=slot, holder=holder))
+        try:
+            s.commit()
+        except IntegrityError:
+            s.rollback()
+            return False
+        s.query(ScheduleFire).filter(ScheduleFire.fired_at < datetime.utcnow() - timedelta(days=keep_days)).delete()
+        s.commit()
+        return True
@@ -1,47 +1,176 @@
 from flask import Blueprint, request
 import requests
+from requests.adapters import HTTPAdapter
 from .config import cfg
-from .storage import SessionLocal, ChatSession, Message
-from datetime import datetime
+from .storage import get_chat_ref, add_message
+from .media import local_path
+from .metrics import OUTBOUND_HTTP_SECONDS, Gauge
+import itertools
+import logging
+import queue
+import threading
+import time
+
+logger = logging.getLogger(__name__)
 
 tg_bp = Blueprint("tg", __name__)
 
 API = f"https://api.telegram.org/bot{cfg.TELEGRAM_BOT_TOKEN}"
+MAX_TEXT = 4096
 
-def send_text(text, topic_id=None):
-    if not cfg.TELEGRAM_BOT_TOKEN or not cfg.TELEGRAM_ADMIN_CHAT_ID:
-        return
-    payload = {"chat_id": cfg.TELEGRAM_ADMIN_CHAT_ID, "text": text}
+# Delivery pipeline: socket handlers only enqueue, a small worker pool does the HTTP.
+# Text bursts for the same chat are merged into one sendMessage while they wait.
+_session = requests.Session()
+_session.mount("https://", HTTPAdapter(pool_connections=1, pool_maxsize=max(cfg.TELEGRAM_WORKERS, 1)))
+_queue = queue.Queue(maxsize=cfg.TELEGRAM_QUEUE_SIZE)
+_pending = {}
+_lock = threading.Lock()
+_workers = []
+_seq = itertools.count()
+_stats = {"enqueued": 0, "coalesced": 0, "sent": 0, "dropped": 0, "failed": 0, "retried": 0, "truncated": 0}
+
+Gauge("konusma_telegram_queue_depth", "Telegram deliveries waiting for a worker", fn=lambda: _queue.qsize())
+
+def _enabled():
+    return bool(cfg.TELEGRAM_BOT_TOKEN and cfg.TELEGRAM_ADMIN_CHAT_ID)
+
+def _post(method, payload, upload=None):
+    for attempt in range(cfg.TELEGRAM_MAX_RETRIES + 1):
+        t0 = time.perf_counter()
+        outcome = "error"
+        try:
+            if upload:
+                field, path = upload
+                with open(path, "rb") as fh:
+                    r = _session.post(f"{API}/{method}", data=payload, files={field: fh}, timeout=30)
+            else:
+                r = _session.post(f"{API}/{method}", json=payload, timeout=5)
+            outcome = str(r.status_code)
+            if r.status_code == 429:
+                try:
+                    wait = float(r.json().get("parameters", {}).get("retry_after", 1))
+                except ValueError:
+                    wait = 1.0
+            elif r.status_code >= 500:
+                wait = 0.5 * 2 ** attempt
+            else:
+                return r.ok
+        except (requests.RequestException, OSError) as e:
+            logger.warning(f"telegram.{method} error: {e}")
+            wait = 0.5 * 2 ** attempt
+        finally:
+            OUTBOUND_HTTP_SECONDS.observe(time.perf_counter() - t0, "telegram", method, outcome)
+        if attempt < cfg.TELEGRAM_MAX_RETRIES:
+            with _lock:
+                _stats["retried"] += 1
+            time.sleep(wait)
+    return False
+
+def _start_workers():
+    with _lock:
+        if _workers:
+            return
+        for i in range(max(cfg.TELEGRAM_WORKERS, 1)):
+            t = threading.Thread(target=_worker, name=f"tg-worker-{i}", daemon=True)
+            t.start()
+            _workers.append(t)
+
+def _split(texts):
+    """Coalesced ``texts`` as newline-joined messages of at most MAX_TEXT; only
+    a single text longer than that is cut, and counted."""
+    out = []
+    for t in texts:
+        if len(t) > MAX_TEXT:
+            logger.warning(f"telegram.truncated {len(t)} chars to {MAX_TEXT}")
+            with _lock:
+                _stats["truncated"] += 1
+            t = t[:MAX_TEXT]
+        if out and len(out[-1]) + 1 + len(t) <= MAX_TEXT:
+            out[-1] += "\n" + t
+        else:
+            out.append(t)
+    return out
+
+def _worker():
+    while True:
+        key = _queue.get()
+        try:
+            with _lock:
+                due = _pending[key]["due"]
+            delay = due - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            with _lock:
+                item = _pending.pop(key)
+            # a slow API lets bursts grow past one message; they go out in order
+            for text in _split(item["texts"]) if item["texts"] else [None]:
+                payload = dict(item["payload"])
+                if text is not None:
+                    payload["text"] = text
+                ok = _post(item["method"], payload, item["upload"])
+                with _lock:
+                    _stats["sent" if ok else "failed"] += 1
+        except Exception as e:
+            logger.error(f"telegram.worker error: {e}")
+        finally:
+            _queue.task_done()
+
+def _enqueue(method, payload, text=None, coalesce_key=None, upload=None):
+    if not _enabled():
+        return False
+    _start_workers()
+    with _lock:
+        if coalesce_key is not None and text is not None:
+            key = ("text", coalesce_key, payload.get("message_thread_id"))
+            item = _pending.get(key)
+            if item is not None:
+                item["texts"].append(text)
+                _stats["coalesced"] += 1
+                return True
+            due = time.monotonic() + cfg.TELEGRAM_COALESCE_MS / 1000.0
+        else:
+            key = ("once", next(_seq))
+            due = 0
+        _pending[key] = {"method": method, "payload": payload, "texts": [text] if text is not None else [], "due": due, "upload": upload}
+        try:
+            _queue.put_nowait(key)
+        except queue.Full:
+            del _pending[key]
+            _stats["dropped"] += 1
+            return False
+        _stats["enqueued"] += 1
+    return True
+
+def queue_stats():
+    with _lock:
+        return dict(_stats, depth=_queue.qsize(), pending=len(_pending), workers=len(_workers))
+
+def send_text(text, topic_id=None, coalesce_key=None):
+    payload = {"chat_id": cfg.TELEGRAM_ADMIN_CHAT_ID}
     if topic_id:
         payload["message_thread_id"] = topic_id
-    try:
-        requests.post(f"{API}/sendMessage", json=payload, timeout=5)
-    except:
-        pass
+    return _enqueue("sendMessage", payload, text=text, coalesce_key=coalesce_key)
 
 def send_text_for_room(cid, text):
-    send_text(f"[CID: {cid}]\n{text}")
+    send_text(f"[CID: {cid}]\n{text}", coalesce_key=cid)
 
 def notify_telegram(cid, msg_type, text=None, media_url=None, customer_name=None):
-    if not cfg.TELEGRAM_BOT_TOKEN or not cfg.TELEGRAM_ADMIN_CHAT_ID:
+    if not _enabled():
         return
-    
+
     prefix = f"💬 {customer_name or 'Customer'} [CID: {cid}]"
-    
-    try:
-        if msg_type == 'text' and text:
-            payload = {"chat_id": cfg.TELEGRAM_ADMIN_CHAT_ID, "text": f"{prefix}\n{text}"}
-            requests.post(f"{API}/sendMessage", json=payload, timeout=5)
-        elif msg_type == 'image' and media_url:
-            if media_url.startswith('data:image'):
-                payload = {"chat_id": cfg.TELEGRAM_ADMIN_CHAT_ID, "caption": prefix, "photo": media_url}
-                requests.post(f"{API}/sendPhoto", json=payload, timeout=5)
-        elif msg_type == 'audio' and media_url:
-            if media_url.startswith('data:audio'):
-                payload = {"chat_id": cfg.TELEGRAM_ADMIN_CHAT_ID, "caption": prefix, "audio": media_url}
-                requests.post(f"{API}/sendAudio", json=payload, timeout=5)
-    except Exception as e:
-        pass
+
+    if msg_type == 'text' and text:
+        send_text(f"{prefix}\n{text}", coalesce_key=cid)
+    elif msg_type in ('image', 'audio') and media_url:
+        path = local_path(media_url)
+        if path:
+            method, field = ("sendPhoto", "photo") if msg_type == 'image' else ("sendAudio", "audio")
+            _enqueue(method, {"chat_id": cfg.TELEGRAM_ADMIN_CHAT_ID, "caption": prefix}, upload=(field, path))
+
+@tg_bp.get("/stats")
+def stats():
+    return queue_stats()
 
 @tg_bp.post("/webhook")
 def webhook():
@@ -58,11 +187,7 @@ def webhook():
             pass
     if not cid:
         return {"ok": True}
-    with SessionLocal() as s:
-        chat = s.query(ChatSession).filter_by(cid=cid).first()
-        if not chat:
-            return {"ok": True}
-        m = Message(chat_id=chat.id, role="admin", type="text", text=text, created_at=datetime.utcnow())
-        s.add(m)
-        s.commit()
+    chat = get_chat_ref(cid)
+    if chat:
+        add_message(chat.id, "admin", "text", text)
     return {"ok": True}
@@ -1,5 +1,9 @@
 from __future__ import annotations
+import contextvars
 import os
+import re
+import time
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 from typing import Dict
 from .config import cfg
 from .storage import SessionLocal, ChatSession
@@ -10,25 +14,49 @@ def _no(msg="fail"): return False, msg
 
 BASE = os.getenv("BASE_URL", "http://localhost:10000")
 
+class _Remote:
+    """Probe a running instance over HTTP at BASE_URL."""
+    def __init__(self, base, timeout):
+        self.base = base
+        self.timeout = timeout
+
+    def get(self, path):
+        r = requests.get(f"{self.base}{path}", timeout=self.timeout)
+        return r.status_code, r.json
+
+class _InProcess:
+    """Probe the app through its Flask test client, without touching the network."""
+    def __init__(self, app):
+        self.app = app
+
+    def get(self, path):
+        r = self.app.test_client().get(path)
+        return r.status_code, r.get_json
+
+_http = contextvars.ContextVar("testsuite_http")
+
+def _get(path):
+    return _http.get().get(path)
+
 # Health & Ops
 def health_root(): 
     try:
-        r = requests.get(f"{BASE}/health", timeout=5)
-        return _ok("200") if r.status_code==200 else _no(f"/health {r.status_code}")
+        status, _ = _get("/health")
+        return _ok("200") if status==200 else _no(f"/health {status}")
     except Exception as e:
         return _no(str(e))
 
 def health_admin():
     try:
-        r = requests.get(f"{BASE}/admin", timeout=5)
-        return _ok("200") if r.status_code==200 else _no(f"/admin {r.status_code}")
+        status, _ = _get("/admin")
+        return _ok("200") if status==200 else _no(f"/admin {status}")
     except Exception as e:
         return _no(str(e))
 
 def health_ice():
     try:
-        r = requests.get(f"{BASE}/v1/api/ice-servers", timeout=5)
-        j = r.json()
+        _, body = _get("/v1/api/ice-servers")
+        j = body()
         assert "iceServers" in j
         return _ok(f"servers={len(j['iceServers'])}")
     except Exception as e:
@@ -58,12 +86,142 @@ def schema_columns():
         return _no(str(e))
 
 def backfill_idempotent():
+    try:
+        from .repair import count_missing_room
+        missing = count_missing_room()
+        return _ok("backfilled") if not missing else _no(f"{missing} chats missing room/room_key")
+    except Exception as e:
+        return _no(str(e))
+
+_capture = contextvars.ContextVar("testsuite_capture", default=None)
+
+def _captured_selects(fn):
+    """Run ``fn`` and return the SELECTs it sent to the database. Matched by
+    context rather than thread, since storage calls may be offloaded."""
+    from sqlalchemy import event
+    from .storage import engine
+    stmts = []
+
+    def rec(conn, cursor, statement, params, context, executemany):
+        if _capture.get() is stmts and statement.lstrip().upper().startswith("SELECT"):
+            stmts.append((statement, params))
+    event.listen(engine, "before_cursor_execute", rec)
+    token = _capture.set(stmts)
+    try:
+        fn()
+    finally:
+        _capture.reset(token)
+        event.remove(engine, "before_cursor_execute", rec)
+    return stmts
+
+_FULL_SCAN = {
+    "sqlite": re.compile(r"^SCAN (messages|chat_sessions)\b(?!.*USING)"),
+    "postgresql": re.compile(r"Seq Scan on (messages|chat_sessions)\b"),
+}
+
+def _full_scans(statement, params):
+    from .storage import engine
+    with engine.connect() as c:
+        if engine.dialect.name == "postgresql":
+            # tiny tables make seq scans cheapest; ask whether an index path exists at all
+            c.exec_driver_sql("SET LOCAL enable_seqscan = off")
+            lines = [r[0] for r in c.exec_driver_sql("EXPLAIN " + statement, params)]
+        else:
+            lines = [r[-1] for r in c.exec_driver_sql("EXPLAIN QUERY PLAN " + statement, params)]
+    pat = _FULL_SCAN.get(engine.dialect.name)
+    return [l.strip() for l in lines if pat and pat.search(l.strip())]
+
+def hot_queries_use_indexes():
+    from datetime import datetime
+    from .storage import engine, get_messages, list_chats, verify_room_key
+    from .search import search_messages
+    if engine.dialect.name not in _FULL_SCAN:
+        return _ok(f"skipped on {engine.dialect.name}")
+    probes = {
+        "messages.page": lambda: get_messages(0),
+        "messages.after": lambda: get_messages(0, after_id=0),
+        "messages.since": lambda: get_messages(0, since=datetime(2000, 1, 1)),
+        "chats.list": lambda: list_chats(),
+        "room_key.verify": lambda: verify_room_key("__plan_probe__", "-"),
+        "messages.search": lambda: search_messages("plan probe"),
+    }
+    try:
+        bad = []
+        for name, fn in probes.items():
+            for statement, params in _captured_selects(fn):
+                scans = _full_scans(statement, params)
+                if scans:
+                    bad.append(f"{name}: {'; '.join(scans)}")
+        return _no(" | ".join(bad)) if bad else _ok(f"{len(probes)} hot queries use indexes")
+    except Exception as e:
+        return _no(str(e))
+
+# built by migrations; a CONCURRENTLY build that fails leaves an invalid index behind
+EXPECTED_INDEXES = {
+    "messages": {"ix_messages_chat_id_deleted_id", "ix_messages_chat_id_created_at"},
+    "chat_sessions": {"ix_chat_sessions_active_id"},
+    "job_runs": {"ux_job_runs_active_dedup_key"},
+}
+
+def indexes_valid():
+    from sqlalchemy import inspect
+    from .storage import engine
+    try:
+        insp = inspect(engine)
+        want = {t: set(names) for t, names in EXPECTED_INDEXES.items()}
+        if engine.dialect.name == "postgresql":
+            want["messages"].add("ix_messages_search_tsv")
+        missing = sorted(n for t, names in want.items() for n in names - {i["name"] for i in insp.get_indexes(t)})
+        if engine.dialect.name == "sqlite" and not insp.has_table("messages_fts"):
+            missing.append("messages_fts")
+        invalid = []
+        if engine.dialect.name == "postgresql":
+            with engine.connect() as c:
+                invalid = [n for (n,) in c.exec_driver_sql("SELECT indexrelid::regclass::text FROM pg_index WHERE NOT indisvalid")]
+        if missing or invalid:
+            return _no(f"missing={missing} invalid={invalid}")
+        return _ok(f"{sum(map(len, want.values()))} indexes present and valid")
+    except Exception as e:
+        return _no(str(e))
+
+def search_index_current():
+    """The search triggers follow inserts and edits of a message."""
+    import secrets
+    from .storage import Message
+    from .search import search_messages
+    word = f"probe{secrets.token_hex(6)}"
     try:
         with SessionLocal() as s:
-            for c in s.query(ChatSession).all():
-                if not c.room: return _no("missing room")
-                if not c.room_key: return _no("missing room_key")
-        return _ok("backfilled")
+            cs = ChatSession(room=f"test-search-{word}", room_key="k", cid=f"test-search-{word}", customer_name="test")
+            s.add(cs)
+            s.flush()
+            m = Message(chat_id=cs.id, role="user", type="text", text=f"{word} first")
+            s.add(m)
+            s.commit()
+            chat_id, mid = cs.id, m.id
+        try:
+            hits = [h[0] for h in search_messages(word)]
+            if hits != [mid]:
+                return _no(f"insert not indexed: {hits}")
+            with SessionLocal() as s:
+                s.query(Message).filter(Message.id == mid).update({"text": "edited"})
+                s.commit()
+            hits = [h[0] for h in search_messages(word)]
+            return _ok("insert/edit indexed") if not hits else _no(f"edit not indexed: {hits}")
+        finally:
+            with SessionLocal() as s:
+                s.query(Message).filter(Message.chat_id == chat_id).delete()
+                s.query(ChatSession).filter(ChatSession.id == chat_id).delete()
+                s.commit()
+    except Exception as e:
+        return _no(str(e))
+
+def schema_up_to_date():
+    try:
+        from .migrations import pending
+        from .storage import engine
+        todo = pending(engine)
+        return _ok("no pending migrations") if not todo else _no(f"pending: {todo}")
     except Exception as e:
         return _no(str(e))
 
@@ -91,24 +249,97 @@ def upload_policy_note():
 TESTS = {
   "health":   [health_root, health_admin, health_ice],
   "security": [require_room_key, max_two_members, no_secret_leak],
-  "db":       [schema_columns, backfill_idempotent, read_write_cycle],
+  "db":       [schema_columns, schema_up_to_date, indexes_valid, backfill_idempotent, hot_queries_use_indexes,
+               search_index_current, read_write_cycle],
   "admin":    [otp_throttle_note],
   "upload":   [upload_policy_note],
   "chat":     [],
   "webrtc":   []
 }
 
-def run_tests(retry_failed=False) -> Dict:
+def _timed(f):
+    t0 = time.perf_counter()
+    try:
+        ok, msg = f()
+    except Exception as e:
+        ok, msg = False, str(e)
+    return ok, msg, round((time.perf_counter() - t0) * 1000, 1)
+
+def _run_round(pool, checks, suite_deadline):
+    """Run ``checks`` concurrently for at most TEST_CHECK_TIMEOUT (and never
+    past ``suite_deadline``). Checks still running then are reported as timed
+    out; their threads are abandoned, not killed."""
+    started = time.monotonic()
+    deadline = min(started + cfg.TEST_CHECK_TIMEOUT, suite_deadline)
+    pending = {pool.submit(contextvars.copy_context().run, _timed, f): key for key, f in checks}
+    results = {}
+    while pending:
+        done, _ = wait(pending, timeout=max(0.0, deadline - time.monotonic()), return_when=FIRST_COMPLETED)
+        for fut in done:
+            results[pending.pop(fut)] = fut.result()
+        if pending and time.monotonic() >= deadline:
+            ms = round((time.monotonic() - started) * 1000, 1)
+            for fut, key in pending.items():
+                fut.cancel()
+                results[key] = (False, f"timeout after {ms:.0f} ms", ms)
+            break
+    return results
+
+def run_tests(retry_failed=False, app=None, categories=None) -> Dict:
+    """Run every check (or those in ``categories``) on a thread pool, bounded by
+    TEST_CHECK_TIMEOUT per check and TEST_SUITE_TIMEOUT overall. With ``app``
+    the HTTP checks go through its test client instead of BASE_URL.
+    ``retry_failed`` reruns only the checks that failed, once, within the
+    remaining suite budget."""
+    _http.set(_InProcess(app) if app is not None else _Remote(BASE, cfg.TEST_CHECK_TIMEOUT))
+    tests = {cat: funcs for cat, funcs in TESTS.items() if not categories or cat in categories}
+    checks = [((cat, i), f) for cat, funcs in tests.items() for i, f in enumerate(funcs)]
+    deadline = time.monotonic() + cfg.TEST_SUITE_TIMEOUT
+    pool = ThreadPoolExecutor(max_workers=max(1, min(cfg.TEST_MAX_WORKERS, len(checks))), thread_name_prefix="testsuite")
+    try:
+        results = _run_round(pool, checks, deadline)
+        attempts = {key: 1 for key, _ in checks}
+        if retry_failed:
+            failed = [(key, f) for key, f in checks if not results[key][0]]
+            if failed and time.monotonic() < deadline:
+                results.update(_run_round(pool, failed, deadline))
+                for key, _ in failed:
+                    attempts[key] = 2
+    finally:
+        pool.shutdown(wait=False, cancel_futures=True)
     out = {}
-    for cat, funcs in TESTS.items():
+    for cat, funcs in tests.items():
         items = []
-        for f in funcs:
-            try:
-                ok, msg = f()
-            except Exception as e:
-                ok, msg = False, str(e)
-            items.append({"name": f.__name__, "ok": ok, "msg": msg})
+        for i, f in enumerate(funcs):
+            ok, msg, ms = results[(cat, i)]
+            items.append({"name": f.__name__, "ok": ok, "msg": msg, "ms": ms, "attempts": attempts[(cat, i)]})
         total = len(items)
         passed = sum(1 for i in items if i["ok"])
         out[cat] = {"total": total, "passed": passed, "items": items}
     return out
+
+if __name__ == "__main__":
+    # CI gate against a real database: migrate DATABASE_URL, optionally re-run
+    # every step to prove they are idempotent, run the checks in-process and
+    # exit non-zero on any failure, e.g.
+    #   DATABASE_URL=postgresql://... python -m server.testsuite --rerun-migrations db
+    import json
+    import logging
+    import sys
+    from .storage import engine, init_db
+    from .migrations import MIGRATIONS
+    logging.basicConfig(level=logging.INFO)
+    args = sys.argv[1:]
+    categories = [a for a in args if not a.startswith("--")]
+    unknown = [c for c in categories if c not in TESTS]
+    if unknown:
+        sys.exit(f"unknown categories: {unknown}")
+    init_db()
+    if "--rerun-migrations" in args:
+        for version, name, step in MIGRATIONS:
+            logging.info(f"re-running migration {version}: {name}")
+            step(engine)
+    from .app import app
+    res = run_tests(app=app, categories=categories)
+    print(json.dumps(res, indent=2, default=str))
+    sys.exit(0 if all(r["passed"] == r["total"] for r in res.values()) else 1)
@@ -0,0 +1,73 @@
+"""Token-bucket throttling of Socket.IO events.
+
+Rules are ``event=rate:burst`` lists (rate in tokens per second), e.g.
+``send=2:10,call:ring=0.2:3``; ``*`` covers events without their own rule.
+
+* per sid  - SOCKET_LIMITS_SID. A socket lives on one worker, so these
+             buckets stay in process memory.
+* per room - SOCKET_LIMITS_ROOM, counted against the room the event names
+             (``room``/``chat_id``) whether or not the socket joined it.
+             Members of a room may sit on different workers, so these
+             buckets live in the ``shared`` backend (Redis when configured).
+
+A refused event never reaches its handler: no fan-out, no DB write. The
+sender gets at most one ``error`` emit per second."""
+import logging
+from .config import cfg
+from .state import TokenBuckets, shared
+
+logger = logging.getLogger(__name__)
+
+def parse_rules(spec):
+    rules = {}
+    for part in (spec or "").split(","):
+        part = part.strip()
+        if not part:
+            continue
+        try:
+            event, limit = part.rsplit("=", 1)
+            rate, burst = limit.split(":")
+            rate, burst = float(rate), float(burst)
+        except ValueError:
+            raise ValueError(f"bad socket limit {part!r}, expected event=rate:burst")
+        if rate > 0 and burst >= 1:
+            rules[event.strip()] = (rate, burst)
+    return rules
+
+class EventThrottle:
+    def __init__(self, sid_rules, room_rules, room_backend, enabled=True):
+        self.sid_rules = sid_rules
+        self.room_rules = room_rules
+        self.rooms = room_backend
+        self.local = TokenBuckets()
+        self.enabled = enabled
+
+    def room_rule(self, event):
+        return self.room_rules.get(event)
+
+    def check(self, namespace, event, sid, room=None):
+        """``None`` if ``event`` may run, else ``(scope, retry_after)``."""
+        if not self.enabled:
+            return None
+        rule = self.sid_rules.get(event) or self.sid_rules.get("*")
+        if rule:
+            wait = self.local.take((sid, event if event in self.sid_rules else "*"), *rule)
+            if wait:
+                return "sid", wait
+        rule = self.room_rules.get(event)
+        if rule and room is not None:
+            try:
+                wait = self.rooms.bucket_take(f"sio:{namespace}:{room}:{event}", *rule)
+            except Exception as e:
+                # a backend outage must not take chat down with it
+                logger.warning(f"throttle.room_backend error: {e}")
+                return None
+            if wait:
+                return "room", wait
+        return None
+
+    def should_notify(self, sid):
+        return not self.local.take(("notice", sid), 1.0, 1)
+
+throttle = EventThrottle(parse_rules(cfg.SOCKET_LIMITS_SID), parse_rules(cfg.SOCKET_LIMITS_ROOM), shared,
+                         enabled=cfg.SOCKET_THROTTLE_ENABLED)
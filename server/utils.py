@@ -1,5 +1,7 @@
+import contextvars
 import secrets
 import string
+from functools import wraps
 
 def make_cid(name: str) -> str:
     suf = ''.join(secrets.choice(string.hexdigits.upper()) for _ in range(4))
@@ -8,3 +10,38 @@ def make_cid(name: str) -> str:
 
 def generate_secret(length=16):
     return secrets.token_urlsafe(length)
+
+def offload(fn, *args, **kwargs):
+    """Run a blocking call (SQLite commit, fsync) without stalling the green-thread
+    hub: on eventlet/gevent it goes to the native thread pool, otherwise it runs inline.
+    The caller's context variables go along, so the call sees the same context."""
+    from . import ASYNC_MODE
+    if ASYNC_MODE == "eventlet":
+        from eventlet import tpool
+        return tpool.execute(contextvars.copy_context().run, fn, *args, **kwargs)
+    if ASYNC_MODE == "gevent":
+        from gevent import get_hub
+        return get_hub().threadpool.apply(contextvars.copy_context().run, (fn,) + args, kwargs)
+    return fn(*args, **kwargs)
+
+def native_lock():
+    """A lock for state shared between the hub and offloaded calls. Under
+    eventlet/gevent a patched ``threading.Lock`` is hub-bound and hangs when
+    two native pool threads contend for it; this is the unpatched one, so
+    only guard sections that never block or yield with it."""
+    from . import ASYNC_MODE
+    if ASYNC_MODE == "eventlet":
+        from eventlet.patcher import original
+        return original("threading").Lock()
+    if ASYNC_MODE == "gevent":
+        from gevent.monkey import get_original
+        return get_original("_thread", "allocate_lock")()
+    import threading
+    return threading.Lock()
+
+def offloaded(fn):
+    """Decorator form of ``offload`` for functions that talk to the database."""
+    @wraps(fn)
+    def wrapper(*args, **kwargs):
+        return offload(fn, *args, **kwargs)
+    return wrapper
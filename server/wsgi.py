@@ -0,0 +1,10 @@
+"""WSGI entry point for gunicorn, e.g.
+
+    ASYNC_MODE=eventlet gunicorn -k eventlet -w 1 -b 0.0.0.0:$PORT server.wsgi:app
+
+ASYNC_MODE must match the worker class so Flask-SocketIO and the stdlib
+patching in ``server/__init__.py`` agree."""
+from .app import app, socketio, init_db, start_scheduler
+
+init_db()
+start_scheduler()
@@ -7,6 +7,9 @@ let currentChatId = null;
 let currentDbId = null;
 let currentRoomKey = null;
 let isLoggedIn = false;
+// per-chat history already loaded, so reopening a thread only fetches the delta
+const threadCache = {};
+let loadingOlder = false;
 
 document.getElementById('btnOtp').onclick = async () => {
   const otp = document.getElementById('otp').value.trim();
@@ -29,6 +32,7 @@ document.getElementById('btnOtp').onclick = async () => {
       document.getElementById('otpModal').style.display = 'none';
       document.querySelector('.admin-panel').style.display = 'flex';
       loadChats();
+      connectAdminFeed();
     } else {
       alert(data.error || 'Geçersiz OTP');
     }
@@ -66,53 +70,137 @@ document.getElementById('otp').addEventListener('keypress', (e) => {
   if (e.key === 'Enter') document.getElementById('btnOtp').click();
 });
 
-async function loadChats() {
+const threadItems = {};
+let chatsCursor = null;
+let loadingChats = false;
+let chatSearch = '';
+
+async function loadChats(append = false) {
+  if (append && (!chatsCursor || loadingChats)) return;
+  loadingChats = true;
   try {
-    const res = await fetch('/api/chats');
+    const params = new URLSearchParams({ limit: '50' });
+    if (chatSearch) params.set('q', chatSearch);
+    if (append) params.set('before_id', chatsCursor);
+    const res = await fetch(`/api/chats?${params}`);
     if (!res.ok) throw new Error('Failed to load chats');
     
     const chats = await res.json();
     if (!Array.isArray(chats)) throw new Error('Invalid response format');
+    chatsCursor = res.headers.get('X-Next-Cursor');
     
-    threads.innerHTML = '';
-    chats.forEach(c => {
-      const li = document.createElement('li');
-      li.className = 'thread-item';
-      
-      const avatar = document.createElement('div');
-      avatar.className = 'thread-avatar';
-      avatar.textContent = '👤';
-      
-      const info = document.createElement('div');
-      info.className = 'thread-info';
-      
-      const name = document.createElement('div');
-      name.className = 'thread-name';
-      name.textContent = c.name || 'Misafir';
-      
-      const preview = document.createElement('div');
-      preview.className = 'thread-preview';
-      preview.textContent = 'Son mesaj';
-      
-      const time = document.createElement('div');
-      time.className = 'thread-time';
-      time.textContent = new Date(c.created).toLocaleTimeString('tr-TR', {hour:'2-digit',minute:'2-digit'});
-      
-      info.appendChild(name);
-      info.appendChild(preview);
-      li.appendChild(avatar);
-      li.appendChild(info);
-      li.appendChild(time);
-      li.onclick = () => openThread(c.id, c.cid, c.name);
-      
-      threads.appendChild(li);
-    });
+    if (!append) {
+      threads.innerHTML = '';
+      Object.keys(threadItems).forEach(k => delete threadItems[k]);
+    }
+    chats.forEach(c => threads.appendChild(renderThread(c)));
+    if (!append && chatSearch) await loadMessageHits(chatSearch);
   } catch (error) {
     console.error('loadChats error:', error);
     alert('Sohbetler yüklenemedi: ' + error.message);
+  } finally {
+    loadingChats = false;
   }
 }
 
+function renderThread(c) {
+  const li = document.createElement('li');
+  li.className = 'thread-item';
+  
+  const avatar = document.createElement('div');
+  avatar.className = 'thread-avatar';
+  avatar.textContent = '👤';
+  
+  const info = document.createElement('div');
+  info.className = 'thread-info';
+  
+  const name = document.createElement('div');
+  name.className = 'thread-name';
+  name.textContent = c.name || 'Misafir';
+  
+  const preview = document.createElement('div');
+  preview.className = 'thread-preview';
+  preview.textContent = !c.last ? 'Henüz mesaj yok'
+    : c.last.type === 'text' ? c.last.text
+    : c.last.type === 'image' ? '📷 Fotoğraf' : '🎤 Ses';
+  
+  const time = document.createElement('div');
+  time.className = 'thread-time';
+  time.textContent = new Date(c.last ? c.last.time : c.created).toLocaleTimeString('tr-TR', {hour:'2-digit',minute:'2-digit'});
+  
+  info.appendChild(name);
+  info.appendChild(preview);
+  li.appendChild(avatar);
+  li.appendChild(info);
+  li.appendChild(time);
+  if (c.unread) {
+    const badge = document.createElement('div');
+    badge.className = 'thread-unread';
+    badge.textContent = c.unread;
+    li.appendChild(badge);
+  }
+  li.onclick = () => openThread(c.id, c.cid, c.name);
+  
+  threadItems[c.cid] = { li, chat: c };
+  return li;
+}
+
+// Message text matches from /api/search, listed under the chat matches.
+async function loadMessageHits(q) {
+  const res = await fetch(`/api/search?${new URLSearchParams({ q, limit: '20' })}`);
+  if (!res.ok || q !== chatSearch) return;
+  const hits = await res.json();
+  hits.forEach(h => {
+    const prev = threadItems[h.cid];
+    const li = renderThread({ id: h.chat_id, cid: h.cid, name: h.name, created: h.time, unread: 0,
+                              last: { role: h.role, type: 'text', text: h.snippet, time: h.time } });
+    li.classList.add('thread-hit');
+    if (prev) threadItems[h.cid] = prev; else delete threadItems[h.cid];
+    threads.appendChild(li);
+  });
+}
+
+// Inbox updates pushed by the server; replaces re-polling /api/chats.
+function connectAdminFeed() {
+  const adminSocket = io('/admin');
+  adminSocket.on('chat:created', (c) => {
+    if (chatSearch || threadItems[c.cid]) return;
+    threads.insertBefore(renderThread({ ...c, unread: 0, last: null }), threads.firstChild);
+  });
+  adminSocket.on('chat:message', (m) => {
+    const item = threadItems[m.cid];
+    const chat = item ? item.chat : { id: m.id, cid: m.cid, name: m.name, created: m.last.time, unread: 0 };
+    if (!item && chatSearch) return;
+    const unread = m.cid === currentChatId ? 0 : (chat.unread || 0) + (m.last.role === 'user' ? m.count : 0);
+    const li = renderThread({ ...chat, unread, last: m.last });
+    if (item) item.li.remove();
+    threads.insertBefore(li, threads.firstChild);
+  });
+  adminSocket.on('chat:closed', (c) => {
+    const item = threadItems[c.cid];
+    if (item) {
+      item.li.remove();
+      delete threadItems[c.cid];
+    }
+  });
+}
+
+const threadsSidebar = document.getElementById('threadsSidebar');
+threadsSidebar.addEventListener('scroll', () => {
+  if (threadsSidebar.scrollTop + threadsSidebar.clientHeight >= threadsSidebar.scrollHeight - 40) {
+    loadChats(true);
+  }
+});
+
+let searchTimer = null;
+document.getElementById('threadSearch').addEventListener('input', (e) => {
+  clearTimeout(searchTimer);
+  searchTimer = setTimeout(() => {
+    chatSearch = e.target.value.trim();
+    loadChats();
+  }, 300);
+});
+
 async function openThread(dbId, cid, name) {
   try {
     currentChatId = cid;
@@ -136,21 +224,66 @@ async function openThread(dbId, cid, name) {
     document.getElementById('threadsSidebar').classList.add('hidden');
     document.getElementById('chatPanel').classList.add('active');
 
-    const res = await fetch(`/api/chats/${dbId}/messages`);
-    if (!res.ok) throw new Error('Failed to load messages');
-    
-    const messages = await res.json();
-    if (!Array.isArray(messages)) throw new Error('Invalid messages format');
-    
-    messages.forEach(m => {
-      renderMsg(msgs, { role: m.role, type: m.type, text: m.text, time: new Date(m.time).toLocaleTimeString('tr-TR', { hour: '2-digit', minute: '2-digit' }) });
-    });
+    let cache = threadCache[dbId];
+    if (cache) {
+      cache.items.forEach(m => renderMsg(msgs, toRendered(m)));
+    }
+    const query = cache && cache.newestId ? `after_id=${cache.newestId}&limit=200` : 'limit=50';
+    const { messages, hasMore } = await fetchMessages(dbId, query);
+    if (!cache) {
+      cache = threadCache[dbId] = { items: [], oldestId: null, newestId: null, hasMore };
+    }
+    if (currentDbId !== dbId) return;
+    messages.forEach(m => renderMsg(msgs, toRendered(m)));
+    cache.items.push(...messages);
+    if (messages.length) {
+      cache.oldestId = cache.oldestId || messages[0].id;
+      cache.newestId = messages[messages.length - 1].id;
+    }
+    fetch(`/api/chats/${dbId}/read`, { method: 'POST' }).catch(() => {});
+    const item = threadItems[cid];
+    if (item && item.chat.unread) {
+      item.li.replaceWith(renderThread({ ...item.chat, unread: 0 }));
+    }
   } catch (error) {
     console.error('openThread error:', error);
     alert('Sohbet açılamadı: ' + error.message);
   }
 }
 
+function toRendered(m) {
+  return { role: m.role, type: m.type, text: m.media || m.text, time: new Date(m.time).toLocaleTimeString('tr-TR', { hour: '2-digit', minute: '2-digit' }) };
+}
+
+async function fetchMessages(dbId, query) {
+  const res = await fetch(`/api/chats/${dbId}/messages?${query}`);
+  if (!res.ok) throw new Error('Failed to load messages');
+  const messages = await res.json();
+  if (!Array.isArray(messages)) throw new Error('Invalid messages format');
+  return { messages, hasMore: res.headers.get('X-Has-More') === 'true' };
+}
+
+msgs.addEventListener('scroll', async () => {
+  const cache = threadCache[currentDbId];
+  if (msgs.scrollTop > 0 || !cache || !cache.hasMore || !cache.oldestId || loadingOlder) return;
+  loadingOlder = true;
+  const dbId = currentDbId;
+  try {
+    const { messages, hasMore } = await fetchMessages(dbId, `before_id=${cache.oldestId}&limit=50`);
+    if (currentDbId !== dbId) return;
+    const prevHeight = msgs.scrollHeight;
+    messages.slice().reverse().forEach(m => renderMsg(msgs, toRendered(m), true));
+    msgs.scrollTop = msgs.scrollHeight - prevHeight;
+    cache.items.unshift(...messages);
+    cache.hasMore = hasMore;
+    if (messages.length) cache.oldestId = messages[0].id;
+  } catch (error) {
+    console.error('load older error:', error);
+  } finally {
+    loadingOlder = false;
+  }
+});
+
 document.getElementById('btnSend').onclick = () => {
   if (!currentChatId || !isLoggedIn) return;
   const text = txt.value.trim();
@@ -169,7 +302,6 @@ socket.on('chat:message', (m) => {
   if (m.chat_id === currentChatId) {
     renderMsg(msgs, { ...m, role: 'user', time: ts() });
   }
-  loadChats();
 });
 
 document.getElementById('btnPhone').onclick = async () => {
@@ -209,6 +341,7 @@ document.getElementById('btnDelete').onclick = async () => {
       const res = await fetch(`/api/chats/${currentDbId}`, { method: 'DELETE' });
       if (!res.ok) throw new Error('Delete failed');
       
+      delete threadCache[currentDbId];
       currentChatId = null;
       currentDbId = null;
       currentRoomKey = null;
@@ -242,13 +375,11 @@ document.getElementById('fileImg').onchange = (e) => {
   if (!file) return;
   if (!file.type.startsWith('image/')) { alert('Images only'); return; }
   if (file.size > 5 * 1024 * 1024) { alert('Max 5MB'); return; }
-  const reader = new FileReader();
-  reader.onload = () => {
-    const m = { role: 'admin', type: 'image', text: reader.result, time: ts() };
-    renderMsg(msgs, m);
-    socket.emit('send', { chat_id: currentChatId, ...m });
-  };
-  reader.readAsDataURL(file);
+  renderMsg(msgs, { role: 'admin', type: 'image', text: URL.createObjectURL(file), time: ts() });
+  uploadMedia(socket, currentChatId, file, 'image', { role: 'admin' }).catch((error) => {
+    console.error('Upload error:', error);
+    alert('Dosya gönderilemedi: ' + error.message);
+  });
 };
 
 document.getElementById('fileAud').onchange = (e) => {
@@ -257,13 +388,11 @@ document.getElementById('fileAud').onchange = (e) => {
   if (!file) return;
   if (!file.type.startsWith('audio/')) { alert('Audio only'); return; }
   if (file.size > 10 * 1024 * 1024) { alert('Max 10MB'); return; }
-  const reader = new FileReader();
-  reader.onload = () => {
-    const m = { role: 'admin', type: 'audio', text: reader.result, time: ts() };
-    renderMsg(msgs, m);
-    socket.emit('send', { chat_id: currentChatId, ...m });
-  };
-  reader.readAsDataURL(file);
+  renderMsg(msgs, { role: 'admin', type: 'audio', text: URL.createObjectURL(file), time: ts() });
+  uploadMedia(socket, currentChatId, file, 'audio', { role: 'admin' }).catch((error) => {
+    console.error('Upload error:', error);
+    alert('Dosya gönderilemedi: ' + error.message);
+  });
 };
 
 setupEmojiPicker(txt);
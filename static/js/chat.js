@@ -1,4 +1,4 @@
-function renderMsg(listEl, { role, type, text, time }) {
+function renderMsg(listEl, { role, type, text, time }, prepend = false) {
   const li = document.createElement('li');
   li.className = `msg ${role}`;
   
@@ -10,6 +10,10 @@ function renderMsg(listEl, { role, type, text, time }) {
     li.innerHTML = `<div><audio controls src="${text}"></audio></div>`;
   }
   
+  if (prepend) {
+    listEl.insertBefore(li, listEl.firstChild);
+    return;
+  }
   listEl.appendChild(li);
   listEl.scrollTop = listEl.scrollHeight;
 }
@@ -24,3 +28,40 @@ function escapeHtml(text) {
   div.textContent = text;
   return div.innerHTML;
 }
+
+const UPLOAD_ACK_MS = 15000;
+const UPLOAD_RETRIES = 5;
+
+function waitConnected(socket) {
+  return socket.connected ? Promise.resolve() : new Promise(resolve => socket.once('connect', resolve));
+}
+
+async function uploadMedia(socket, chatId, file, type, extra = {}) {
+  const start = await socket.emitWithAck('upload:start', { chat_id: chatId, type, mime: file.type, size: file.size });
+  if (!start.ok) throw new Error(start.error || 'Upload failed');
+  const { upload_id, chunk_size } = start;
+  let offset = start.offset;
+  let retries = 0;
+  while (offset < file.size) {
+    const data = await file.slice(offset, offset + chunk_size).arrayBuffer();
+    let r;
+    try {
+      r = await socket.timeout(UPLOAD_ACK_MS).emitWithAck('upload:chunk', { chat_id: chatId, upload_id, offset, data });
+    } catch (err) {
+      // connection dropped or the ack timed out: once reconnected, ask the
+      // server how much it holds and continue from there
+      if (++retries > UPLOAD_RETRIES) throw new Error('Upload failed');
+      await waitConnected(socket);
+      const resume = await socket.timeout(UPLOAD_ACK_MS).emitWithAck('upload:start', { chat_id: chatId, upload_id }).catch(() => null);
+      if (resume && !resume.ok) throw new Error(resume.error || 'Upload failed');
+      if (resume) offset = resume.offset;
+      continue;
+    }
+    if (!r.ok) throw new Error(r.error || 'Upload failed');
+    offset = r.offset;
+    retries = 0;
+  }
+  const done = await socket.emitWithAck('upload:finish', { chat_id: chatId, upload_id, ...extra });
+  if (!done.ok) throw new Error(done.error || 'Upload failed');
+  return done.media;
+}
@@ -79,13 +79,11 @@ document.getElementById('fileImg').onchange = (e) => {
   if (!file) return;
   if (!file.type.startsWith('image/')) { alert('Images only'); return; }
   if (file.size > 5 * 1024 * 1024) { alert('Max 5MB'); return; }
-  const reader = new FileReader();
-  reader.onload = () => {
-    const m = { role: 'user', type: 'image', text: reader.result, name: userName, time: ts() };
-    renderMsg(msgs, m);
-    socket.emit('send', { chat_id: chatId, ...m });
-  };
-  reader.readAsDataURL(file);
+  renderMsg(msgs, { role: 'user', type: 'image', text: URL.createObjectURL(file), time: ts() });
+  uploadMedia(socket, chatId, file, 'image', { role: 'user', name: userName }).catch((error) => {
+    console.error('Upload error:', error);
+    alert('Dosya gönderilemedi: ' + error.message);
+  });
 };
 
 document.getElementById('fileAud').onchange = (e) => {
@@ -93,13 +91,11 @@ document.getElementById('fileAud').onchange = (e) => {
   if (!file) return;
   if (!file.type.startsWith('audio/')) { alert('Audio only'); return; }
   if (file.size > 10 * 1024 * 1024) { alert('Max 10MB'); return; }
-  const reader = new FileReader();
-  reader.onload = () => {
-    const m = { role: 'user', type: 'audio', text: reader.result, name: userName, time: ts() };
-    renderMsg(msgs, m);
-    socket.emit('send', { chat_id: chatId, ...m });
-  };
-  reader.readAsDataURL(file);
+  renderMsg(msgs, { role: 'user', type: 'audio', text: URL.createObjectURL(file), time: ts() });
+  uploadMedia(socket, chatId, file, 'audio', { role: 'user', name: userName }).catch((error) => {
+    console.error('Upload error:', error);
+    alert('Dosya gönderilemedi: ' + error.message);
+  });
 };
 
 socket.on('chat:message', (m) => {
@@ -60,11 +60,30 @@ function setHeaderState(okCount, totalCount) {
   meta.textContent = `${okCount}/${totalCount} passed`;
 }
 
+// Start a background job and poll until it finishes; resolves to its result.
+async function runJob(url, body, label) {
+  const res = await fetch(url, { method:'POST', headers:{'Content-Type':'application/json'}, body: JSON.stringify({ ...body, async:true }) });
+  let job = await res.json();
+  if (!res.ok) throw new Error(job.error || `HTTP ${res.status}`);
+  while (job.status === 'queued' || job.status === 'running') {
+    if (label) report.textContent = `${label}… ${job.progress || 0}% ${job.note || ''}`;
+    await new Promise(r => setTimeout(r, 500));
+    job = await (await fetch(`/api/jobs/${job.id}`)).json();
+  }
+  if (job.status !== 'succeeded') throw new Error(job.error || 'job failed');
+  return job.result;
+}
+
 async function runAll(retryFailed=false) {
   report.textContent = 'Running…';
   const body = retryFailed ? { retryFailed:true } : {};
-  const res = await fetch('/api/test/run', { method:'POST', headers:{'Content-Type':'application/json'}, body: JSON.stringify(body) });
-  const out = await res.json();
+  let out;
+  try {
+    out = await runJob('/api/test/run', body, 'Running');
+  } catch (e) {
+    report.textContent = `Test run failed: ${e.message}`;
+    return;
+  }
 
   let grandTotal = 0, grandPass = 0;
 
@@ -89,8 +108,13 @@ async function runAll(retryFailed=false) {
 
 async function repairSafe() {
   report.textContent = 'Repair (dry-run)…';
-  let res = await fetch('/api/repair/run', { method:'POST', headers:{'Content-Type':'application/json'}, body: JSON.stringify({ mode:'safe', dryRun:true }) });
-  let plan = await res.json();
+  let plan, applied;
+  try {
+    plan = await runJob('/api/repair/run', { mode:'safe', dryRun:true }, 'Planning');
+  } catch (e) {
+    report.textContent = `Repair failed: ${e.message}`;
+    return;
+  }
   
   report.innerHTML = '';
   const metaDiv1 = document.createElement('div');
@@ -102,8 +126,11 @@ async function repairSafe() {
   pre1.textContent = JSON.stringify(plan, null, 2);
   report.appendChild(pre1);
 
-  res = await fetch('/api/repair/run', { method:'POST', headers:{'Content-Type':'application/json'}, body: JSON.stringify({ mode:'safe', dryRun:false }) });
-  const applied = await res.json();
+  try {
+    applied = await runJob('/api/repair/run', { mode:'safe', dryRun:false });
+  } catch (e) {
+    applied = { error: e.message };
+  }
   
   const metaDiv2 = document.createElement('div');
   metaDiv2.className = 'meta';
@@ -32,6 +32,15 @@ async function initCall(socket, chatId) {
     }
   };
   
+  // lets the server time ring -> connected; it counts the first report only
+  let connectedReported = false;
+  pc.onconnectionstatechange = () => {
+    if (pc.connectionState === 'connected' && !connectedReported) {
+      connectedReported = true;
+      socket.emit('call:connected', { chat_id: chatId });
+    }
+  };
+  
     return pc;
   } catch (error) {
     console.error('initCall hatası:', error);
@@ -140,4 +149,15 @@ function bindAnswering(socket, pc, chatId) {
       console.error('ICE candidate hatası:', err);
     }
   });
+  
+  // batched form, sent when the server runs with RTC_CANDIDATE_BATCH_MS
+  socket.on('rtc:candidates', async ({ candidates }) => {
+    for (const candidate of candidates || []) {
+      try {
+        await pc.addIceCandidate(candidate);
+      } catch (err) {
+        console.error('ICE candidate hatası:', err);
+      }
+    }
+  });
 }